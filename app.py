@@ -1,21 +1,57 @@
 import random
 import streamlit as st
-from utils.expert import ExpertAgent, get_responses_async, generate_summary
+import streamlit.components.v1 as components
+from utils.expert import (
+    ExpertAgent,
+    get_responses_async,
+    get_batched_responses_async,
+    get_followup_response_async,
+    find_mentioned_expert,
+    generate_summary,
+    start_warmup,
+    DEFAULT_BATCH_SIZE
+)
 from utils.quota import (
     check_quota,
-    use_quota,
     get_quota_display,
     initialize_quota,
     MODEL_QUOTAS,
     calculate_conversation_quota
 )
-from utils.document_loader import load_experts
+from utils.document_loader import (
+    load_experts,
+    refresh_knowledge_store,
+    sync_expert_knowledge
+)
+from utils.admission import get_admission_scheduler, admission_ticket
+from utils.avatar import load_avatar_data_uri, publish_avatar
+from utils.messages import (
+    ChatMessage,
+    register_avatar,
+    render_message_html,
+    render_user_message_html,
+    sanitize_content
+)
+from utils.conversation_store import get_conversation_store, PAGE_SIZE
+from utils.usage_ledger import get_usage_ledger, GROUP_BY_COLUMNS
+from utils.tracing import trace_span
+from utils.profiling import profiled
+from utils.settings import is_enabled
+from utils.memory_diagnostics import (
+    get_memory_diagnostics,
+    process_memory,
+    shared_footprint
+)
 import os
 import asyncio
 import logging
 from utils.dropbox_handler import download_and_extract_dropbox
 from datetime import datetime, timedelta
 import time
+import json
+import secrets
+import re
+import hashlib
 
 # 设置日志
 logger = logging.getLogger(__name__)
@@ -34,6 +70,82 @@ EXPERT_COLORS = [
     "#E6E6FA"   # 淡紫色
 ]
 
+# 自动滚动控制器：以 <script> 元素装入父页面，函数和定时器属于父页面本身，
+# 不会随 components.html 的 iframe 被替换而失效；滚动请求经过防抖合并
+SCROLL_CONTROLLER_JS = """
+(function () {
+    let timer = null;
+    const containers = [
+        '[data-testid="stMain"]',
+        '[data-testid="stAppViewContainer"]',
+        '.stChatMessageContainer'
+    ];
+
+    function scrollToBottom() {
+        timer = null;
+        containers.forEach(selector => {
+            document.querySelectorAll(selector).forEach(element => {
+                element.scrollTop = element.scrollHeight;
+            });
+        });
+        window.scrollTo({
+            top: document.body.scrollHeight,
+            behavior: 'smooth'
+        });
+    }
+
+    window.__titansScroll = {
+        version: __VERSION__,
+        request: function () {
+            if (timer !== null) {
+                window.clearTimeout(timer);
+            }
+            timer = window.setTimeout(scrollToBottom, 150);
+        }
+    };
+})();
+"""
+
+# 控制器脚本改动时递增，父页面中的旧控制器会被替换
+SCROLL_CONTROLLER_VERSION = 2
+
+SCROLL_CONTROLLER_HTML = """
+<script>
+    (function () {
+        const parentWindow = window.parent;
+        const controller = parentWindow.__titansScroll;
+        if (!controller || controller.version !== __VERSION__) {
+            const script = parentWindow.document.createElement('script');
+            script.textContent = __CONTROLLER__;
+            parentWindow.document.head.appendChild(script);
+            script.remove();
+        }
+        // signal: __SIGNAL__
+        parentWindow.__titansScroll.request();
+    })();
+</script>
+"""
+
+# 对话 id 保存在 cookie 中（不放进 URL，分享链接不会带上对话历史）
+SESSION_COOKIE_NAME = "titans_session"
+SESSION_COOKIE_MAX_AGE = 365 * 24 * 3600
+SESSION_ID_RE = re.compile(r"[A-Za-z0-9_-]{32,64}")
+
+SESSION_COOKIE_HTML = """
+<script>
+    (function () {
+        const parentWindow = window.parent;
+        const secure = parentWindow.location.protocol === 'https:' ? '; Secure' : '';
+        parentWindow.document.cookie = '__NAME__=__VALUE__; path=/; max-age=__MAX_AGE__; SameSite=Lax' + secure;
+    })();
+</script>
+"""
+
+# 配额显示片段的刷新间隔（秒）：有配额等待重置时快速刷新，空闲时慢速刷新，
+# 以便看到共享同一配额账本的其他会话的用量
+QUOTA_REFRESH_SECONDS = 5
+QUOTA_IDLE_REFRESH_SECONDS = 30
+
 st.set_page_config(
     page_title="Investment Titans Chat",
     page_icon="💭",
@@ -85,6 +197,11 @@ st.markdown("""
         box-sizing: border-box !important;
     }
     
+    /* 折叠历史中的用户消息 */
+    .chat-message.user-message {
+        background-color: #F0F2F6 !important;
+    }
+    
     /* 专家名字样式 */
     .expert-name {
         font-size: 24px !important;
@@ -185,6 +302,126 @@ def add_model_selector():
         st.session_state.current_model = models[selected_model]
 
 
+def add_batch_mode_selector():
+    """添加批量模式开关：多位专家共用一个请求以节省配额"""
+    with st.sidebar:
+        batch_mode = st.checkbox(
+            "批量模式",
+            key="batch_mode",
+            help="多位专家合并到同一个请求中回答，每次对话只需 ⌈专家数/每批人数⌉+1 个配额"
+        )
+        batch_size = st.number_input(
+            "每批专家数",
+            min_value=1,
+            max_value=max(1, len(st.session_state.experts)),
+            value=min(DEFAULT_BATCH_SIZE,
+                      max(1, len(st.session_state.experts))),
+            key="batch_size_input",
+            disabled=not batch_mode
+        )
+        st.session_state.batch_size = int(batch_size) if batch_mode else None
+
+
+def add_usage_report():
+    """侧边栏用量报表：按天、专家、模型或会话汇总 tokens 和费用"""
+    with st.sidebar:
+        if not st.toggle("显示用量报表", key="show_usage_report"):
+            return
+        group_by = st.radio(
+            "汇总维度",
+            options=list(GROUP_BY_COLUMNS.keys()),
+            format_func=lambda x: {"day": "按天", "expert": "按专家",
+                                   "model": "按模型", "session": "按会话"}[x],
+            horizontal=True,
+            key="usage_group_by"
+        )
+        rows = get_usage_ledger().aggregate(group_by)
+        if not rows:
+            st.caption("暂无用量记录")
+            return
+        total_cost = sum(row["cost_usd"] for row in rows)
+        st.caption(f"累计费用: ${total_cost:.4f}")
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+
+
+def format_bytes(size):
+    """以 KB / MB 为单位显示字节数"""
+    if size is None:
+        return "-"
+    if size >= 1024 * 1024:
+        return f"{size / 1024 / 1024:.1f} MB"
+    return f"{size / 1024:.1f} KB"
+
+
+def add_memory_diagnostics():
+    """侧边栏内存诊断：进程和各会话的内存占用，以及快照间的增长位置"""
+    diagnostics = get_memory_diagnostics()
+    diagnostics.record_session(st.session_state.session_id,
+                               st.session_state.experts + [st.session_state.titans],
+                               st.session_state.older_messages
+                               + st.session_state.messages)
+    if not diagnostics.enabled:
+        return
+
+    with st.sidebar:
+        if not st.toggle("显示内存诊断", key="show_memory_diagnostics"):
+            return
+        memory = process_memory()
+        st.caption(f"进程常驻内存: {format_bytes(memory['rss_bytes'])}，"
+                   f"峰值: {format_bytes(memory['peak_rss_bytes'])}")
+
+        st.markdown("**共享数据**")
+        st.dataframe(
+            [{**row, "bytes": format_bytes(row["bytes"])}
+             for row in shared_footprint()],
+            hide_index=True, use_container_width=True)
+
+        st.markdown("**会话**")
+        st.dataframe(
+            [{"session": row["session"][:8],
+              "experts": format_bytes(row["expert_state_bytes"]),
+              "history": format_bytes(row["chat_history_bytes"]),
+              "messages": f"{row['messages']} / {format_bytes(row['message_bytes'])}",
+              "total": format_bytes(row["total_bytes"])}
+             for row in diagnostics.sessions()],
+            hide_index=True, use_container_width=True)
+
+        if st.button("拍摄内存快照", key="take_memory_snapshot",
+                     help="与上一次快照对比，找出内存增长最多的代码位置"):
+            st.session_state.memory_snapshot = diagnostics.take_snapshot()
+        if "memory_snapshot" in st.session_state:
+            top, growth = st.session_state.memory_snapshot
+            st.markdown("**增长最多的位置**")
+            if growth:
+                st.dataframe(growth, hide_index=True, use_container_width=True)
+            else:
+                st.caption("再拍一次快照即可对比增长")
+            st.markdown("**占用最多的位置**")
+            st.dataframe(top, hide_index=True, use_container_width=True)
+
+
+def add_data_refresh():
+    """侧边栏资料刷新：重新下载 Dropbox 资料，只重建内容有变化的专家"""
+    if not is_enabled("DATA_REFRESH_ENABLED"):
+        return
+    with st.sidebar:
+        if not st.button("更新专家资料", key="refresh_expert_data",
+                         help="重新下载 Dropbox 资料，只重建内容有变化的专家"):
+            return
+        with st.spinner("正在更新专家资料..."):
+            if not download_and_extract_dropbox(st.secrets["DROPBOX_DATA_URL"]):
+                st.error("无法从Dropbox下载数据")
+                return
+            changes = refresh_knowledge_store()
+        if changes:
+            labels = {"added": "新增", "changed": "已更新", "removed": "已移除"}
+            st.success("，".join(f"{name}{labels[change]}"
+                                for name, change in sorted(changes.items())))
+        else:
+            st.info("专家资料没有变化")
+        sync_expert_knowledge(st.session_state.experts)
+
+
 def get_expert_color(expert_name, index):
     """根据专家名称和索引生成颜色"""
     # 预定义的柔和色彩列表
@@ -209,11 +446,49 @@ def get_expert_color(expert_name, index):
     return colors[index % len(colors)]
 
 
+def get_session_id():
+    """获取对话 id：随机生成并保存在浏览器 cookie 中，刷新页面后可以恢复历史
+
+    对话 id 相当于读取和续写对话的凭据，不放进 URL，复制或分享链接不会泄露对话
+    """
+    # 旧版本把对话 id 放在 URL 参数中，不再采用并从地址栏移除
+    if "sid" in st.query_params:
+        del st.query_params["sid"]
+
+    session_id = st.context.cookies.get(SESSION_COOKIE_NAME)
+    if not isinstance(session_id, str) or not SESSION_ID_RE.fullmatch(session_id):
+        session_id = secrets.token_urlsafe(32)
+    return session_id
+
+
+def persist_session_cookie():
+    """浏览器还没有对话 cookie 时写入（cookie 在会话开始时读取，本会话内每次运行都写入）"""
+    if st.context.cookies.get(SESSION_COOKIE_NAME) == st.session_state.session_id:
+        return
+    with st.sidebar:
+        components.html(
+            SESSION_COOKIE_HTML
+            .replace("__NAME__", SESSION_COOKIE_NAME)
+            .replace("__VALUE__", st.session_state.session_id)
+            .replace("__MAX_AGE__", str(SESSION_COOKIE_MAX_AGE)),
+            height=0
+        )
+
+
 def initialize_session_state():
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = get_session_id()
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        # 只把最近一页消息放在内存中，更早的消息按需加载
+        st.session_state.messages = get_conversation_store().load_page(
+            st.session_state.session_id)
+        # 按需加载的更早消息，折叠显示
+        st.session_state.older_messages = []
     if "experts" not in st.session_state:
         st.session_state.experts = load_experts()
+    else:
+        # 资料刷新后换用新版本的知识（版本未变的专家不受影响）
+        sync_expert_knowledge(st.session_state.experts)
     if "expert_colors" not in st.session_state:
         # 动态为每个专家分配颜色
         st.session_state.expert_colors = {
@@ -222,49 +497,179 @@ def initialize_session_state():
         }
         # 添加总结专家的颜色
         st.session_state.expert_colors["Investment Masters Summary"] = "#f6d365"
+    if "followup_expert" not in st.session_state:
+        st.session_state.followup_expert = None  # 当前追问的专家名
+    if "batch_size" not in st.session_state:
+        st.session_state.batch_size = None  # None 表示逐个专家请求
     if "current_model" not in st.session_state:
         st.session_state.current_model = "gemini-2.0-flash-exp"  # 默认使用 Gemini 2.0
-    if "quota_info" not in st.session_state:
-        st.session_state.quota_info = {
-            "gemini-2.0-flash-exp": {"limit": 10, "remaining": 10, "reset_time": None},
-            "grok-beta": {"limit": 60, "remaining": 60, "reset_time": None},
-            "gemini-1.5-flash": {"limit": 10, "remaining": 10, "reset_time": None}
-        }
+    initialize_quota()
     # 添加总结专家到会话状态
     if "titans" not in st.session_state:
         st.session_state.titans = ExpertAgent(
             name="Investment Masters",
             knowledge_base="",  # 不需要知识库
-            avatar="masters_logo.png"  # 使用logo作为头像
+            avatar=load_avatar_data_uri("masters_logo.png")  # 使用logo作为头像
         )
-
-
-def display_chat_history():
-    for message in st.session_state.messages:
-        if message["role"] == "user":
-            with st.chat_message("user"):
-                st.write(message["content"])
+        # 登记头像，恢复的历史消息按专家 id 查找头像
+        for expert in st.session_state.experts + [st.session_state.titans]:
+            register_avatar(expert.name, expert.avatar)
+
+
+def save_message(message):
+    """持久化消息并加入内存中的最近消息窗口"""
+    message = get_conversation_store().append(
+        st.session_state.session_id, message)
+    messages = st.session_state.messages
+    messages.append(message)
+
+    # 最近消息窗口只保留一页；已加载过更早的消息时，移出窗口的消息并入折叠的历史，
+    # 否则只保存在数据库中，之后仍可按需加载
+    overflow = len(messages) - PAGE_SIZE
+    if overflow > 0:
+        if st.session_state.older_messages:
+            st.session_state.older_messages.extend(messages[:overflow])
+        del messages[:overflow]
+
+
+def older_history_anchor():
+    """最早一条已加载的消息，更早的消息从它之前开始加载"""
+    loaded = st.session_state.older_messages or st.session_state.messages
+    if not loaded or loaded[0].id is None:
+        return None
+    return loaded[0]
+
+
+def display_older_history():
+    """更早的消息：放在折叠面板中，每页合并为一个 HTML 片段，渲染耗时不随历史增长"""
+    anchor = older_history_anchor()
+    if anchor is None:
+        return
+    if not st.session_state.older_messages and not get_conversation_store().has_older(
+            st.session_state.session_id, anchor.id):
+        return
+
+    with st.expander("🕘 更早的消息", expanded=False):
+        st.fragment(render_older_history)()
+
+
+def load_older_page():
+    """加载更早的一页消息（按钮回调，在片段重跑之前执行）"""
+    anchor = older_history_anchor()
+    page = get_conversation_store().load_page(
+        st.session_state.session_id, before_id=anchor.id)
+    st.session_state.older_messages = page + st.session_state.older_messages
+
+
+def render_older_history():
+    """渲染已加载的更早消息和“加载更早的消息”按钮（片段内部，加载时只重跑片段）"""
+    if get_conversation_store().has_older(
+            st.session_state.session_id, older_history_anchor().id):
+        st.button("⬆️ 加载更早的消息", key="load_older_messages",
+                  on_click=load_older_page)
+
+    older = st.session_state.older_messages
+    for start in range(0, len(older), PAGE_SIZE):
+        st.markdown(render_history_page_html(older[start:start + PAGE_SIZE]),
+                    unsafe_allow_html=True)
+
+
+def render_history_page_html(messages):
+    """把一页消息拼接为一个 HTML 片段（专家消息的 HTML 按消息 id 缓存）"""
+    parts = []
+    for message in messages:
+        if message.role == "user":
+            parts.append(render_user_message_html(message))
         else:
             expert_color = st.session_state.expert_colors.get(
-                message["role"], "#F0F0F0")
-            with st.chat_message(message["role"], avatar=message.get("avatar")):
-                # 清理消息内容中的HTML标签
-                content = message["content"]
-                content = content.replace('</div>', '')
-                content = content.replace('<div>', '')
-                content = content.replace('<code>', '')
-                content = content.replace('</code>', '')
-                content = content.replace('<span>', '')
-                content = content.replace('</span>', '')
+                message.role, "#F0F0F0")
+            parts.append(render_message_html(message, expert_color))
+    return "\n\n".join(parts)
 
-                st.markdown(
-                    f"""<div style="background-color: {expert_color};" class="chat-message">
-                        <div class="expert-name">{message["role"]}</div>
-                        <div class="divider"></div>
-                        {content}
-                    </div>""".strip(),
-                    unsafe_allow_html=True
-                )
+
+def display_chat_history():
+    start_time = time.perf_counter()
+    with trace_span("ui.render", view="history",
+                    messages=len(st.session_state.messages),
+                    older_messages=len(st.session_state.older_messages)):
+        display_older_history()
+        for message in st.session_state.messages:
+            if message.role == "user":
+                with st.chat_message("user"):
+                    st.write(message.content)
+            else:
+                expert_color = st.session_state.expert_colors.get(
+                    message.role, "#F0F0F0")
+                with st.chat_message(message.role, avatar=message.avatar):
+                    # HTML 片段按消息 id 缓存，只有新消息需要清理和拼接
+                    st.markdown(
+                        render_message_html(message, expert_color),
+                        unsafe_allow_html=True
+                    )
+
+    # 记录渲染耗时，确认其不随历史增长
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    st.session_state.history_render_ms = elapsed_ms
+    logger.info(f"渲染聊天历史: {len(st.session_state.messages)} 条消息"
+                f"（更早的 {len(st.session_state.older_messages)} 条折叠显示），"
+                f"耗时 {elapsed_ms:.1f}ms")
+
+
+def get_roster_version(experts):
+    """专家名单的版本：专家、知识版本（决定头像）或颜色变化时改变"""
+    colors = st.session_state.expert_colors
+    roster = "\n".join(f"{expert.name}\t{expert.knowledge.version}\t{colors.get(expert.name)}"
+                       for expert in experts)
+    return hashlib.sha256(roster.encode("utf-8")).hexdigest()[:16]
+
+
+@st.cache_resource(max_entries=256)
+def render_expert_card_html(roster_version, name, _color, _avatar):
+    """渲染专家卡片 HTML：按（名单版本, 专家名）缓存，名单变化时才重新渲染
+
+    头像写成静态文件，卡片中只引用其 URL
+    """
+    avatar = publish_avatar(_avatar)
+    return f"""
+    <div class="expert-card" style="
+        background-color: {_color};
+        padding: 20px;
+        border-radius: 20px;
+        text-align: center;
+        margin: 10px 5px;
+        color: #1A1A1A;
+        height: 100%;
+    ">
+        <div style="
+            width: 100%;
+            padding-bottom: 100%;
+            position: relative;
+            margin-bottom: 15px;
+        ">
+            <div class="expert-avatar" style="
+                position: absolute;
+                top: 0;
+                left: 0;
+                right: 0;
+                bottom: 0;
+                overflow: hidden;
+                background-color: transparent;
+            ">
+                <img src="{avatar if avatar and avatar.startswith(('data:', './')) else ''}" 
+                     style="width: 100%; height: 100%; object-fit: contain; background: transparent;"
+                     onerror="this.style.backgroundColor='transparent';">
+            </div>
+        </div>
+        <div style="
+            font-size: 1.2vw;
+            font-weight: bold;
+            margin-top: 10px;
+            word-wrap: break-word;
+        ">
+            {name}
+        </div>
+    </div>
+    """
 
 
 def display_experts_gallery():
@@ -295,6 +700,7 @@ def display_experts_gallery():
 
     sorted_experts = sorted(st.session_state.experts, key=sort_key)
     total_experts = len(sorted_experts)
+    roster_version = get_roster_version(sorted_experts)
 
     # 计算布局
     max_per_row = 6
@@ -317,102 +723,65 @@ def display_experts_gallery():
                 expert_color = st.session_state.expert_colors.get(
                     expert.name, "#F0F0F0")
                 st.markdown(
-                    f"""
-                    <div class="expert-card" style="
-                        background-color: {expert_color};
-                        padding: 20px;
-                        border-radius: 20px;
-                        text-align: center;
-                        margin: 10px 5px;
-                        color: #1A1A1A;
-                        height: 100%;
-                    ">
-                        <div style="
-                            width: 100%;
-                            padding-bottom: 100%;
-                            position: relative;
-                            margin-bottom: 15px;
-                        ">
-                            <div class="expert-avatar" style="
-                                position: absolute;
-                                top: 0;
-                                left: 0;
-                                right: 0;
-                                bottom: 0;
-                                overflow: hidden;
-                                background-color: transparent;
-                            ">
-                                <img src="{expert.avatar if expert.avatar.startswith('data:') else ''}" 
-                                     style="width: 100%; height: 100%; object-fit: contain; background: transparent;"
-                                     onerror="this.style.backgroundColor='transparent';">
-                            </div>
-                        </div>
-                        <div style="
-                            font-size: 1.2vw;
-                            font-weight: bold;
-                            margin-top: 10px;
-                            word-wrap: break-word;
-                        ">
-                            {expert.name}
-                        </div>
-                    </div>
-                    """,
+                    render_expert_card_html(
+                        roster_version, expert.name, expert_color, expert.avatar),
                     unsafe_allow_html=True
                 )
+                # 点击按钮后，下一条输入只发给这位专家
+                if st.button("💬 追问", key=f"followup_{expert.name}",
+                             use_container_width=True):
+                    st.session_state.followup_expert = expert.name
 
 
-def add_auto_scroll():
-    """添加自动滚动 JavaScript"""
-    st.markdown("""
-        <script>
-            function scrollToBottom() {
-                // 立即滚动整个页面
-                window.scrollTo({
-                    top: document.body.scrollHeight,
-                    behavior: 'smooth'
-                });
-                
-                // 滚动所有可能的容器
-                const containers = [
-                    '.stChatMessageContainer',
-                    '.main.css-uf99v8.ea3mdgi5',
-                    '.st-emotion-cache-1v0mbdj',
-                    '.element-container'
-                ];
-                
-                containers.forEach(selector => {
-                    const elements = document.querySelectorAll(selector);
-                    elements.forEach(element => {
-                        element.scrollTop = element.scrollHeight;
-                    });
-                });
-            }
+def display_followup_banner():
+    """显示当前的追问对象，并提供退出追问的按钮"""
+    followup_name = st.session_state.followup_expert
+    if not followup_name:
+        return
 
-            // 立即执行
-            scrollToBottom();
-            
-            // 延迟执行几次以确保内容加载
-            [100, 300, 500, 1000].forEach(delay => {
-                setTimeout(scrollToBottom, delay);
-            });
+    col1, col2 = st.columns([5, 1])
+    with col1:
+        st.info(f"💬 正在单独追问 {followup_name}（不生成总结，只消耗 1 个配额）。"
+                f"也可以在输入框中使用 @专家名 进行一次性追问。")
+    with col2:
+        if st.button("退出追问", key="exit_followup", use_container_width=True):
+            st.session_state.followup_expert = None
+            st.rerun()
 
-            // 创建观察器
-            const observer = new MutationObserver((mutations) => {
-                mutations.forEach((mutation) => {
-                    if (mutation.addedNodes.length || mutation.type === 'childList') {
-                        scrollToBottom();
-                    }
-                });
-            });
 
-            // 观察整个文档的变化
-            observer.observe(document.body, {
-                childList: true,
-                subtree: true,
-                attributes: true
-            });
-        </script>
-    """, unsafe_allow_html=True)
+def get_expert_by_name(name):
+    """按名称查找专家"""
+    for expert in st.session_state.experts:
+        if expert.name == name:
+            return expert
+    return None
+
+
+def mount_scroll_controller():
+    """挂载唯一的自动滚动控制器（每次运行只创建一个占位符）"""
+    if "scroll_signal" not in st.session_state:
+        st.session_state.scroll_signal = 0
+    with st.sidebar:
+        st.session_state.scroll_placeholder = st.empty()
+    _render_scroll_controller()
+
+
+def add_auto_scroll():
+    """请求滚动到底部：只更新信号，由控制器防抖后统一滚动"""
+    st.session_state.scroll_signal += 1
+    _render_scroll_controller()
+
+
+def _render_scroll_controller():
+    # 信号变化时 iframe 内容才会变化，浏览器才会重新执行脚本
+    with st.session_state.scroll_placeholder:
+        components.html(
+            SCROLL_CONTROLLER_HTML
+            .replace("__CONTROLLER__", json.dumps(SCROLL_CONTROLLER_JS))
+            .replace("__VERSION__", str(SCROLL_CONTROLLER_VERSION))
+            .replace("__SIGNAL__", str(st.session_state.scroll_signal)),
+            height=0
+        )
 
 
 def display_quota_info():
@@ -440,61 +809,104 @@ def display_quota_info():
         st.session_state.current_model = model_info["name"]
 
     with col3:
-        # 使用 st.empty() 创建一个容器
-        quota_container = st.empty()
-
-        # 获取配额信息
-        quota_info = get_quota_display(st.session_state.current_model)
-
-        # 添加自动刷新脚本
-        st.markdown("""
-            <script>
-                function updateQuotaDisplay() {
-                    const now = new Date();
-                    const quotaElements = document.querySelectorAll('.quota-time');
-                    quotaElements.forEach(element => {
-                        const resetTime = new Date(element.getAttribute('data-reset-time'));
-                        const timeLeft = Math.max(0, Math.floor((resetTime - now) / 1000));
-                        if (timeLeft > 0) {
-                            element.textContent = `${timeLeft}秒后重置一个配额`;
-                        } else {
-                            element.textContent = '每分钟重置';
-                        }
-                    });
-                }
-                
-                // 每秒更新一次
-                setInterval(updateQuotaDisplay, 1000);
-                
-                // 每5秒重新加载页面以获取最新配额
-                setInterval(() => {
-                    window.parent.document.querySelector('iframe').contentWindow.location.reload();
-                }, 5000);
-            </script>
-        """, unsafe_allow_html=True)
-
-        # 显示配额信息
-        if quota_info["requests"] and quota_info["oldest_request_time"]:
-            reset_time = quota_info["oldest_request_time"] + \
-                timedelta(minutes=1)
-            time_left = max(
-                0, int((reset_time - datetime.now()).total_seconds()))
-            time_display = f"""<span class="quota-time" data-reset-time="{reset_time.isoformat()}">{time_left}秒后重置一个配额</span>"""
-        else:
-            time_display = """<span class="quota-time">每60秒重置</span>"""
-
-        quota_container.markdown(
-            f"""<div style="text-align: right; font-size: 0.8em;">
-                每分鐘问题数: {quota_info['remaining']}/{quota_info['limit']}<br>
-                {time_display}
-            </div>""",
-            unsafe_allow_html=True
-        )
+        display_quota_widget()
+
+
+def display_quota_widget():
+    """配额显示：作为独立片段局部刷新，有配额等待重置时快速刷新，空闲时慢速刷新"""
+    # 是否有配额等待重置由片段上次运行时记录，配额只在片段内部查询
+    refreshing = st.session_state.get("quota_widget_refreshing", False)
+
+    st.fragment(
+        render_quota_widget,
+        run_every=QUOTA_REFRESH_SECONDS if refreshing
+        else QUOTA_IDLE_REFRESH_SECONDS
+    )()
+
+
+def format_tokens(tokens):
+    """以 k / M 为单位显示 token 数"""
+    if tokens >= 1000000:
+        return f"{tokens / 1000000:.1f}M"
+    if tokens >= 1000:
+        return f"{tokens / 1000:.0f}k"
+    return str(tokens)
+
+
+def render_quota_widget():
+    """渲染配额信息（片段内部）"""
+    quota_info = get_quota_display(st.session_state.current_model)
+
+    # 开始有配额等待重置或已全部重置：整页重跑一次，以切换片段的刷新间隔
+    refreshing = bool(quota_info["requests"])
+    if refreshing != st.session_state.get("quota_widget_refreshing", False):
+        st.session_state.quota_widget_refreshing = refreshing
+        st.rerun()
+
+    # 显示配额信息
+    if quota_info["requests"] and quota_info["oldest_request_time"]:
+        reset_time = quota_info["oldest_request_time"] + \
+            timedelta(minutes=1)
+        time_left = max(
+            0, int((reset_time - datetime.now()).total_seconds()))
+        time_display = f"""<span class="quota-time">{time_left}秒后重置一个配额</span>"""
+    else:
+        time_display = """<span class="quota-time">每60秒重置</span>"""
+
+    st.markdown(
+        f"""<div style="text-align: right; font-size: 0.8em;">
+            每分鐘问题数: {quota_info['remaining']}/{quota_info['limit']}<br>
+            每分鐘 tokens: {format_tokens(quota_info['tokens_remaining'])}/{format_tokens(quota_info['token_limit'])}<br>
+            {time_display}
+        </div>""",
+        unsafe_allow_html=True
+    )
+
+
+def wait_admission(scheduler, ticket, required_quota):
+    """等待对话拿到第一个请求配额，期间显示排队位置和预计等待时间
+
+    用户离开或触发重跑时脚本会被中断，finally 中取消排队
+    """
+    if scheduler.is_ready(ticket):
+        return
+
+    status = st.empty()
+    try:
+        while not scheduler.is_ready(ticket):
+            # 显示其他可用模型的建议
+            available_models = [
+                f"- {model_name}: 剩余 {get_quota_display(model_name)['remaining']} 次对话"
+                for model_name in MODEL_QUOTAS
+                if model_name != ticket.model_name
+                and check_quota(model_name, required_quota)
+            ]
+            message = f"""⏳ 已达到每分钟问答限制，正在排队
+- 前面还有 {scheduler.position(ticket)} 个请求，预计 {scheduler.eta(ticket)} 秒后开始
+- 本次对话需要 {required_quota} 个配额，配额空出后会自动逐个发送"""
+            if available_models:
+                message += "\n\n💡 也可以切换到以下当前可用的模型：\n" + \
+                    "\n".join(available_models)
+            status.warning(message)
+            time.sleep(1)
+    except BaseException:
+        scheduler.cancel(ticket)
+        raise
+    status.empty()
 
 
+@profiled("rerun")
 def main():
     # 先初始化会话状态
     initialize_session_state()
+    persist_session_cookie()
+    mount_scroll_controller()
+
+    # 批量模式设置需要在计算配额前完成
+    add_batch_mode_selector()
+    add_usage_report()
+    add_memory_diagnostics()
+    add_data_refresh()
 
     # 再显示配额信息
     display_quota_info()
@@ -503,147 +915,161 @@ def main():
     display_experts_gallery()
     st.markdown("---")
     display_chat_history()
+    display_followup_banner()
 
     # 用户输入
     if user_input := st.chat_input("Share your thesis for analysis..."):
         # 添加用户消息到历史记录并显示
-        st.session_state.messages.append({
-            "role": "user",
-            "content": user_input
-        })
+        save_message(ChatMessage.from_user(user_input))
 
         # 显示用户消息
         with st.chat_message("user"):
             st.write(user_input)
             add_auto_scroll()
 
-        current_model = st.session_state.current_model
-        total_experts = len(st.session_state.experts)
-        required_quota = calculate_conversation_quota(total_experts)
-
-        logger.info(f"当前专家数量: {total_experts}, 需要配额: {required_quota}")
-
-        # 检查配额并显示警告（但不阻止请求）
-        if not check_quota(current_model, required_quota):
-            quota_info = get_quota_display(current_model)
-
-            # 获取下一个配额重置的时间
-            if quota_info["oldest_request_time"]:
-                reset_time = quota_info["oldest_request_time"] + \
-                    timedelta(minutes=1)
-                time_left = max(
-                    0, int((reset_time - datetime.now()).total_seconds()))
-                warning_message = f"""⚠️ 已超出每分钟问答限制
-- 等待 {time_left} 秒后将重置一个配额
-- 或切换到其他模型继续对话
-- 需要 {required_quota} 个配额，当前剩余 {quota_info['remaining']} 个"""
+        # 整次对话作为一条链路：排队、各专家请求、总结和渲染都挂在其下
+        with trace_span("conversation", session=st.session_state.session_id,
+                        model=st.session_state.current_model) as conversation_span:
+            # 追问模式：@专家名 或者在画廊中点击了“追问”
+            followup_expert, followup_question = find_mentioned_expert(
+                user_input, st.session_state.experts)
+            if followup_expert is None and st.session_state.followup_expert:
+                followup_expert = get_expert_by_name(
+                    st.session_state.followup_expert)
+                followup_question = user_input
+
+            current_model = st.session_state.current_model
+            total_experts = len(st.session_state.experts)
+            batch_size = st.session_state.batch_size
+            required_quota = calculate_conversation_quota(
+                total_experts, batch_size, followup=followup_expert is not None)
+
+            logger.info(f"当前专家数量: {total_experts}, 需要配额: {required_quota}")
+            conversation_span.set_attribute("experts", total_experts)
+            conversation_span.set_attribute(
+                "mode", "followup" if followup_expert
+                else "batch" if batch_size else "parallel")
+
+            # 排队等待配额：配额空出时逐个发放请求，而不是直接触发 429
+            scheduler = get_admission_scheduler()
+            ticket = scheduler.enqueue(
+                st.session_state.session_id, current_model, required_quota)
+            with trace_span("quota.admission_wait", units=required_quota):
+                wait_admission(scheduler, ticket, required_quota)
+
+            if followup_expert:
+                logger.info(f"对话准入：{required_quota} 个请求（追问: {followup_expert.name}）")
             else:
-                warning_message = f"""⚠️ 已超出每分钟问答限制
-- 请等待配额重置后再试
-- 或切换到其他模型继续对话
-- 需要 {required_quota} 个配额，当前剩余 {quota_info['remaining']} 个"""
-
-            st.warning(warning_message)
-            add_auto_scroll()
-
-            # 显示其他可用模型的建议
-            available_models = []
-            for model_name in MODEL_QUOTAS:
-                if model_name != current_model and check_quota(model_name, required_quota):
-                    model_info = get_quota_display(model_name)
-                    available_models.append(
-                        f"- {model_name}: 剩余 {model_info['remaining']} 次对话")
-
-            if available_models:
-                st.info("💡 以下模型当前可用：\n" + "\n".join(available_models))
-                add_auto_scroll()
-
-        # 记录配额使用（不管是否超限）
-        for _ in range(required_quota):
-            use_quota(current_model)
-
-        logger.info(f"记录配额使用：{required_quota} 个（专家: {total_experts}, 总结: 1）")
+                logger.info(f"对话准入：{required_quota} 个请求（专家: {total_experts}, "
+                            f"批量: {batch_size or '关闭'}, 总结: 1）")
 
-        # 对专家进行排序
-        def sort_key(expert):
-            if expert.name.lower() == "warren buffett":
-                return (0, "")
-            return (1 if not expert.name[0].isascii() else 0, expert.name.lower())
+            # 对专家进行排序
+            def sort_key(expert):
+                if expert.name.lower() == "warren buffett":
+                    return (0, "")
+                return (1 if not expert.name[0].isascii() else 0, expert.name.lower())
 
-        sorted_experts = sorted(st.session_state.experts, key=sort_key)
+            sorted_experts = sorted(st.session_state.experts, key=sort_key)
 
-        # 构建完整的提示词
-        prompt = f"""你看完我以下的thesis後，你會提出什麼問題，說出thesis裡不夠深入需要加強的？並以說出你過去的經驗，要怎樣才能投資，提出一個解決方案。以關鍵問題group：  （如果沒有輸入thesis就根據先前閱讀的資料純聊天就好）
+            # 构建完整的提示词
+            prompt = f"""你看完我以下的thesis後，你會提出什麼問題，說出thesis裡不夠深入需要加強的？並以說出你過去的經驗，要怎樣才能投資，提出一個解決方案。以關鍵問題group：  （如果沒有輸入thesis就根據先前閱讀的資料純聊天就好）
 
 {user_input}"""
 
-        try:
-            # 创建新的事件循环
-            async def run_async():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    await process_responses(sorted_experts)
-                finally:
-                    loop.close()
-
-            async def process_responses(sorted_experts):
-                """处理专家回应"""
-                responses = []
-                experts_responded = set()
-                placeholders = {}
-
-                # 创建所有占位符（包括总结）
-                for expert in sorted_experts + [st.session_state.titans]:
-                    expert_color = st.session_state.expert_colors.get(
-                        expert.name, "#F0F0F0")
-                    with st.chat_message(expert.name, avatar=expert.avatar):
-                        placeholders[expert.name] = st.empty()
-                        placeholders[expert.name].markdown(
-                            f"""<div style="background-color: {expert_color};" class="chat-message">
-                                <div class="expert-name">{expert.name}</div>
-                                <div class="divider"></div>
-                                <div class="thinking-animation">思考中...</div>
-                            </div>""",
-                            unsafe_allow_html=True
-                        )
-
-                try:
-                    # 并发处理所有回应（包括总结）
-                    async for expert, response in get_responses_async(sorted_experts, prompt):
+            try:
+                # 创建新的事件循环
+                async def run_async():
+                    loop = asyncio.new_event_loop()
+                    asyncio.set_event_loop(loop)
+                    try:
+                        await process_responses(sorted_experts)
+                    finally:
+                        loop.close()
+
+                async def process_responses(sorted_experts):
+                    """处理专家回应"""
+                    # 子任务继承该上下文，每个请求发出前从票据领取配额
+                    admission_ticket.set(ticket)
+                    responses = []
+                    experts_responded = set()
+                    placeholders = {}
+
+                    # 追问时只有一位专家回应，且不生成总结
+                    if followup_expert:
+                        responders = [followup_expert]
+                    else:
+                        responders = sorted_experts + [st.session_state.titans]
+
+                    # 创建所有占位符（包括总结）
+                    for expert in responders:
                         expert_color = st.session_state.expert_colors.get(
                             expert.name, "#F0F0F0")
-
-                        # 更新对应的占位符
-                        if expert.name in placeholders:
+                        with st.chat_message(expert.name, avatar=expert.avatar):
+                            placeholders[expert.name] = st.empty()
                             placeholders[expert.name].markdown(
                                 f"""<div style="background-color: {expert_color};" class="chat-message">
                                     <div class="expert-name">{expert.name}</div>
                                     <div class="divider"></div>
-                                    {response.replace('</div>', '').replace('<div>', '')}
+                                    <div class="thinking-animation">思考中...</div>
                                 </div>""",
                                 unsafe_allow_html=True
                             )
 
-                        # 保存到会话状态
-                        st.session_state.messages.append({
-                            "role": expert.name,
-                            "content": response,
-                            "avatar": expert.avatar
-                        })
-
-                        add_auto_scroll()
-
-                except Exception as e:
-                    logger.error(f"处理回应时出错: {str(e)}")
-                    st.error(f"处理回应时出现错误: {str(e)}")
-
-            # 运行异步处理
-            asyncio.run(run_async())
-
-        except Exception as e:
-            st.error(f"处理请求时发生错误: {str(e)}")
-            logger.error(f"处理请求时发生错误: {str(e)}", exc_info=True)
+                    if followup_expert:
+                        responses_iter = get_followup_response_async(
+                            followup_expert, followup_question)
+                    elif batch_size:
+                        responses_iter = get_batched_responses_async(
+                            sorted_experts, prompt, batch_size)
+                    else:
+                        responses_iter = get_responses_async(sorted_experts, prompt)
+
+                    try:
+                        # 并发处理所有回应（包括总结）
+                        async for expert, response in responses_iter:
+                            expert_color = st.session_state.expert_colors.get(
+                                expert.name, "#F0F0F0")
+
+                            # 更新对应的占位符
+                            if expert.name in placeholders:
+                                with trace_span("ui.render", view="response",
+                                                expert=expert.name):
+                                    placeholders[expert.name].markdown(
+                                        f"""<div style="background-color: {expert_color};" class="chat-message">
+                                            <div class="expert-name">{expert.name}</div>
+                                            <div class="divider"></div>
+                                            {sanitize_content(response)}
+                                        </div>""",
+                                        unsafe_allow_html=True
+                                    )
+
+                            # 保存到会话状态
+                            save_message(
+                                ChatMessage.from_expert(expert, response))
+
+                            add_auto_scroll()
+
+                    except Exception as e:
+                        logger.error(f"处理回应时出错: {str(e)}")
+                        st.error(f"处理回应时出现错误: {str(e)}")
+
+                # 运行异步处理
+                asyncio.run(run_async())
+
+            except Exception as e:
+                st.error(f"处理请求时发生错误: {str(e)}")
+                logger.error(f"处理请求时发生错误: {str(e)}", exc_info=True)
+            finally:
+                # 释放未使用的排队名额
+                scheduler.cancel(ticket)
+
+        # 对话用掉了配额：整页重跑一次，配额显示立即更新并开始快速刷新
+        st.session_state.quota_widget_refreshing = True
+        st.rerun()
+
+
+# 编码表和模型客户端在后台预热，与数据下载并行
+start_warmup()
 
 
 # 在应用启动时下载并解压文件
@@ -0,0 +1,448 @@
+"""离线微基准测试：覆盖知识截断、专家初始化、文档解析和配额计算等 CPU 热点
+
+    python tools/benchmark.py run --output baseline.json
+    python tools/benchmark.py run --output current.json
+    python tools/benchmark.py compare baseline.json current.json --threshold 0.1
+
+compare 在任何基准的中位数耗时变慢超过阈值时以非零状态退出，可以作为回归门禁。
+"""
+import argparse
+from datetime import datetime
+from io import BytesIO
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 语料规模（单词数，约等于 token 数）
+SIZES = {
+    "small": 5000,
+    "medium": 50000,
+    "large": 200000,
+}
+# 配额基准中，窗口内预先填入的请求数
+QUOTA_SIZES = {
+    "small": 10,
+    "medium": 60,
+    "large": 600,
+}
+WORDS_PER_PAGE = 400
+DEFAULT_OUTPUT_DIR = os.path.join(".cache", "benchmarks")
+
+VOCABULARY = ("the company business value price margin safety moat earnings "
+              "cash flow capital return equity management market risk growth "
+              "investor shareholders compounding patience cycle debt").split()
+
+
+def make_corpus(words, seed=0):
+    """生成可复现的英文语料，每 12 个词一行"""
+    rng = random.Random(seed)
+    tokens = [rng.choice(VOCABULARY) for _ in range(words)]
+    return "\n".join(" ".join(tokens[i:i + 12]) for i in range(0, words, 12))
+
+
+def make_pdf(text, words_per_page=WORDS_PER_PAGE):
+    """把文本排成多页的最小 PDF（Helvetica，只支持 ASCII）"""
+    lines = text.split("\n")
+    lines_per_page = max(1, words_per_page // 12)
+    pages = [lines[i:i + lines_per_page]
+             for i in range(0, len(lines), lines_per_page)] or [[""]]
+
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    kids = []
+    for index, page in enumerate(pages):
+        page_id, content_id = 4 + index * 2, 5 + index * 2
+        escaped = (line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+                   for line in page)
+        stream = ("BT /F1 10 Tf 12 TL 50 750 Td " +
+                  "".join(f"({line}) Tj T* " for line in escaped) + "ET").encode()
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode()
+        objects[content_id] = (f"<< /Length {len(stream)} >>\nstream\n".encode() +
+                               stream + b"\nendstream")
+        kids.append(f"{page_id} 0 R")
+    objects[2] = (f"<< /Type /Pages /Kids [{' '.join(kids)}] "
+                  f"/Count {len(kids)} >>").encode()
+
+    output = BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = output.tell()
+        output.write(f"{object_id} 0 obj\n".encode() + objects[object_id] +
+                     b"\nendobj\n")
+    xref = output.tell()
+    count = max(objects) + 1
+    output.write(f"xref\n0 {count}\n0000000000 65535 f \n".encode())
+    for object_id in range(1, count):
+        output.write(f"{offsets[object_id]:010d} 00000 n \n".encode())
+    output.write(f"trailer\n<< /Size {count} /Root 1 0 R >>\n"
+                 f"startxref\n{xref}\n%%EOF\n".encode())
+    return output.getvalue()
+
+
+def make_epub(text, path, words_per_chapter=2000):
+    """把文本按章节写成 EPUB 文件"""
+    from ebooklib import epub
+
+    book = epub.EpubBook()
+    book.set_identifier("benchmark")
+    book.set_title("Benchmark Corpus")
+    book.set_language("en")
+    lines = text.split("\n")
+    lines_per_chapter = max(1, words_per_chapter // 12)
+    chapters = []
+    for index in range(0, len(lines), lines_per_chapter):
+        chapter = epub.EpubHtml(title=f"Chapter {len(chapters) + 1}",
+                                file_name=f"chapter_{len(chapters) + 1}.xhtml")
+        chapter.content = "".join(f"<p>{line}</p>"
+                                  for line in lines[index:index + lines_per_chapter])
+        book.add_item(chapter)
+        chapters.append(chapter)
+    book.toc = chapters
+    book.spine = chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(path, book)
+
+
+# ---- 基准定义：每个函数接收规模名称，完成准备工作后返回被计时的无参函数 ----
+
+def bench_truncate_text(size):
+    from utils.expert import truncate_text
+    text = make_corpus(SIZES[size])
+    return lambda: truncate_text(text, SIZES[size] // 2)
+
+
+def bench_expert_init(size):
+    from utils.expert import ExpertAgent
+    text = make_corpus(SIZES[size])
+    return lambda: ExpertAgent("Benchmark", text)
+
+
+def bench_expert_init_shared(size):
+    """每个会话创建专家时的开销（知识已经在共享存储中）"""
+    from utils.expert import ExpertAgent
+    from utils.knowledge_store import ExpertKnowledge
+    knowledge = ExpertKnowledge.from_text("Benchmark", make_corpus(SIZES[size]))
+    return lambda: ExpertAgent("Benchmark", knowledge)
+
+
+def bench_adjust_knowledge_base(size):
+    from utils.expert import ExpertAgent
+    agent = ExpertAgent("Benchmark", make_corpus(SIZES[size]))
+    return agent.adjust_knowledge_base
+
+
+def bench_system_prompt(size):
+    """按当前预算截断知识并拼接系统提示词"""
+    from utils.expert import ExpertAgent
+    agent = ExpertAgent("Benchmark", make_corpus(SIZES[size]))
+    return agent.get_system_prompt
+
+
+def bench_update_chat_history(size):
+    from utils.expert import ExpertAgent
+    agent = ExpertAgent("Benchmark", make_corpus(SIZES[size]))
+    question = make_corpus(60, seed=1)
+    answer = make_corpus(500, seed=2)
+    return lambda: agent.update_chat_history(question, answer)
+
+
+def bench_read_pdf(size):
+    from utils.document_loader import read_pdf
+    data = make_pdf(make_corpus(SIZES[size]))
+    return lambda: read_pdf(BytesIO(data))
+
+
+def bench_read_epub(size):
+    from utils.document_loader import read_epub
+    path = os.path.join(tempfile.mkdtemp(prefix="benchmark-"), "corpus.epub")
+    make_epub(make_corpus(SIZES[size]), path)
+    with open(path, "rb") as f:
+        data = f.read()
+    return lambda: read_epub(BytesIO(data))
+
+
+def bench_normalize_pages(size):
+    """PDF 文本规范化：去掉页眉页脚、合并断词和折行"""
+    from utils.text_normalizer import normalize_pages
+    lines = make_corpus(SIZES[size]).split("\n")
+    lines_per_page = WORDS_PER_PAGE // 12
+    pages = [
+        f"THE ESSAYS OF WARREN BUFFETT\n" +
+        "\n".join(lines[i:i + lines_per_page]) + f"\n- {i // lines_per_page + 1} -"
+        for i in range(0, len(lines), lines_per_page)
+    ]
+    return lambda: normalize_pages(pages)
+
+
+def bench_dedupe_passages(size):
+    """段落切分和近重复检测：同一份语料的两个版本（换行位置不同）"""
+    from utils.dedup import dedupe_passages, split_passages
+    corpus = make_corpus(SIZES[size] // 2)
+    copy = corpus.replace("\n", " ")
+    return lambda: dedupe_passages(split_passages(corpus) + split_passages(copy))
+
+
+def prepare_data_dir(size, experts=3):
+    """在临时目录中生成 data/<专家>/ 的 PDF 和 EPUB 语料"""
+    root = tempfile.mkdtemp(prefix="benchmark-data-")
+    for index in range(experts):
+        expert_dir = os.path.join(root, "data", f"Expert {index + 1}")
+        os.makedirs(expert_dir)
+        corpus = make_corpus(SIZES[size] // 2, seed=index)
+        with open(os.path.join(expert_dir, "book.pdf"), "wb") as f:
+            f.write(make_pdf(corpus))
+        make_epub(corpus, os.path.join(expert_dir, "book.epub"))
+    return root
+
+
+def bench_load_experts_cold(size):
+    """首次加载：解析文档、编码、构建共享知识库并写入知识包"""
+    from utils.document_loader import load_experts, load_knowledge_store
+    from utils.knowledge_bundle import DEFAULT_BUNDLE_DIR
+    os.chdir(prepare_data_dir(size))
+
+    def run():
+        shutil.rmtree(DEFAULT_BUNDLE_DIR, ignore_errors=True)
+        load_knowledge_store.clear()
+        return load_experts()
+    return run
+
+
+def bench_load_experts_bundle(size):
+    """首次加载：从预编译的知识包 mmap 打开，不解析也不编码"""
+    from build_knowledge import build_expert
+    from utils.document_loader import load_experts, load_knowledge_store
+    from utils.knowledge_bundle import DEFAULT_BUNDLE_DIR
+    os.chdir(prepare_data_dir(size))
+    for name in os.listdir("data"):
+        build_expert(name, os.path.join("data", name), DEFAULT_BUNDLE_DIR)
+
+    def run():
+        load_knowledge_store.clear()
+        return load_experts()
+    return run
+
+
+def bench_load_experts_warm(size):
+    """新会话加载：共享知识库已缓存，只创建专家代理"""
+    from utils.document_loader import load_experts, load_knowledge_store
+    os.chdir(prepare_data_dir(size))
+    load_knowledge_store.clear()
+    load_experts()
+    return load_experts
+
+
+def prefill_quota(size, model="grok-beta"):
+    """重建配额账本并在窗口内填入指定数量的请求"""
+    from utils.quota_ledger import get_quota_ledger
+    get_quota_ledger.clear()
+    ledger = get_quota_ledger()
+    for _ in range(QUOTA_SIZES[size]):
+        ledger.reserve(model, 1, QUOTA_SIZES[size])
+    return model
+
+
+def bench_check_quota(size):
+    from utils.quota import check_quota
+    model = prefill_quota(size)
+    return lambda: check_quota(model, 6)
+
+
+def bench_reserve_quota(size):
+    from utils.quota import reserve_quota
+    model = prefill_quota(size)
+    return lambda: reserve_quota(model, 1)
+
+
+def bench_reserve_tokens(size):
+    from utils.quota import reserve_tokens, settle_token_usage
+    model = prefill_quota(size)
+
+    def run():
+        reservation = reserve_tokens(model, 1000)
+        settle_token_usage(reservation, 0)  # 归还，保持窗口内的 tokens 稳定
+    return run
+
+
+def bench_quota_display(size):
+    import streamlit as st
+    from utils.quota import get_quota_display
+    model = prefill_quota(size)
+    st.session_state.experts = [None] * 5
+    st.session_state.batch_size = None
+    return lambda: get_quota_display(model)
+
+
+def bench_sliding_window(size):
+    """限流器在窗口持续滚动时的准入开销"""
+    from utils.quota_ledger import SlidingWindowLimiter
+    limiter = SlidingWindowLimiter(QUOTA_SIZES[size], window_seconds=0.001)
+    return limiter.reserve
+
+
+BENCHMARKS = {
+    "truncate_text": bench_truncate_text,
+    "expert_init": bench_expert_init,
+    "expert_init_shared": bench_expert_init_shared,
+    "adjust_knowledge_base": bench_adjust_knowledge_base,
+    "system_prompt": bench_system_prompt,
+    "update_chat_history": bench_update_chat_history,
+    "read_pdf": bench_read_pdf,
+    "read_epub": bench_read_epub,
+    "normalize_pages": bench_normalize_pages,
+    "dedupe_passages": bench_dedupe_passages,
+    "load_experts_cold": bench_load_experts_cold,
+    "load_experts_bundle": bench_load_experts_bundle,
+    "load_experts_warm": bench_load_experts_warm,
+    "check_quota": bench_check_quota,
+    "reserve_quota": bench_reserve_quota,
+    "reserve_tokens": bench_reserve_tokens,
+    "quota_display": bench_quota_display,
+    "sliding_window": bench_sliding_window,
+}
+
+
+def measure(func, repeat):
+    """自动确定循环次数（每轮至少 0.2 秒），返回每次调用的耗时统计（秒）"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def run_benchmarks(args):
+    # 日志输出会淹没计时结果，并且不属于被测的计算开销
+    logging.disable(logging.WARNING)
+    cwd = os.getcwd()
+    results = {}
+    for name, factory in BENCHMARKS.items():
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        for size in args.sizes:
+            key = f"{name}[{size}]"
+            try:
+                func = factory(size)
+                results[key] = measure(func, args.repeat)
+            finally:
+                os.chdir(cwd)
+            print(f"{key:40s} {format_time(results[key]['median']):>10s} "
+                  f"± {format_time(results[key]['stdev'])}", flush=True)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        DEFAULT_OUTPUT_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+def compare_results(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key]["median"], current[key]["median"]
+        ratio = after / before if before else float("inf")
+        if ratio > 1 + args.threshold:
+            status = "回归"
+            regressions.append(key)
+        elif ratio < 1 - args.threshold:
+            status = "提升"
+        else:
+            status = ""
+        print(f"{key:40s} {format_time(before):>10s} -> {format_time(after):>10s} "
+              f"{ratio:6.2f}x {status}")
+
+    for key in sorted(set(baseline) ^ set(current)):
+        print(f"{key:40s} 只存在于{'基线' if key in baseline else '当前结果'}中")
+
+    if regressions:
+        print(f"\n{len(regressions)} 项基准变慢超过 {args.threshold:.0%}: "
+              f"{', '.join(regressions)}")
+        return 1
+    print(f"\n没有超过 {args.threshold:.0%} 的回归")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="CPU 热点微基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="运行基准并保存 JSON 结果")
+    run_parser.add_argument("--sizes", nargs="+", choices=list(SIZES),
+                            default=["small", "medium"])
+    run_parser.add_argument("--filter", nargs="+",
+                            help="只运行名称包含这些字符串的基准")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--output", help="结果文件（默认保存到 .cache/benchmarks/）")
+
+    compare_parser = subparsers.add_parser("compare", help="与基线对比，标记回归")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="中位数变慢超过该比例视为回归")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.command == "run":
+        run_benchmarks(args)
+    else:
+        sys.exit(compare_results(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""把 ./data 中的专家资料预编译为知识包，应用启动时直接 mmap 打开，不再解析和编码
+
+    python tools/build_knowledge.py
+    python tools/build_knowledge.py --expert "Warren Buffett" --force
+    python tools/build_knowledge.py --force --report   # 每个文档规范化、去重前后的 token 数
+
+每位专家生成一个 .kb 文件（文本、token 数组、知识片段偏移和头像缩略图）。
+内容版本（源文件哈希 + 解析器 / 编码器版本）没有变化的专家会被跳过，
+耗时只与有变化的专家数量成正比。构建完成后跨专家去重：多位专家共有的段落
+只在共享段落库 _shared.kb 中保存一份。
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def build_expert(name, expert_path, bundle_dir, force=False, report=None):
+    """构建单个专家的知识包，返回 (状态, 知识包头部)"""
+    from utils.document_loader import build_expert_bundle
+    bundle, rebuilt = build_expert_bundle(name, expert_path, bundle_dir, force,
+                                          report)
+    return ("built" if rebuilt else "skipped"), bundle.header
+
+
+def print_normalization_report(report):
+    """每个文档规范化（去掉页眉页脚、合并断词、压缩空白）和专家内去重前后的 token 数"""
+    if not report:
+        return
+    print("\n规范化、去重前后的 token 数:")
+    for row in report:
+        deduped = row["tokens_after"] - row["duplicate_tokens"]
+        saved = 1 - deduped / row["tokens_before"] if row["tokens_before"] else 0
+        print(f"  {row['expert']:<24} {row['file']:<40} "
+              f"{row['tokens_before']:>9} -> {row['tokens_after']:>9} -> {deduped:>9}"
+              f"  (-{saved:.1%})")
+    before = sum(row["tokens_before"] for row in report)
+    after = sum(row["tokens_after"] for row in report)
+    deduped = after - sum(row["duplicate_tokens"] for row in report)
+    print(f"  合计 {before} -> {after} -> {deduped}"
+          f"  (-{1 - deduped / before if before else 0:.1%})")
+
+
+def print_sharing_report(report, bundle_dir):
+    """每位专家引用的共享段落，以及共享段落库只保存一份所节省的 token 数"""
+    from utils.knowledge_bundle import open_shared_bundle
+    print("\n跨专家共享段落:")
+    for row in report:
+        print(f"  {row['expert']:<24} {row['passages']:>7} 个段落，"
+              f"引用共享段落 {row['shared_passages']:>6} 个 / {row['shared_tokens']:>9} tokens")
+    shared = open_shared_bundle(bundle_dir)
+    if shared is None:
+        print("  没有共享段落")
+        return
+    referenced = sum(row["shared_tokens"] for row in report)
+    print(f"  共享段落库 {shared.header['passage_count']} 个段落 / "
+          f"{shared.header['token_count']} tokens，"
+          f"少保存 {referenced - shared.header['token_count']} tokens")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="预编译专家知识包")
+    parser.add_argument("--data-dir", default="./data", help="专家资料目录")
+    parser.add_argument("--output", help="知识包目录（默认为 KNOWLEDGE_BUNDLE_DIR 配置）")
+    parser.add_argument("--expert", action="append",
+                        help="只构建指定的专家（可重复）")
+    parser.add_argument("--force", action="store_true",
+                        help="源文件没有变化也重新构建")
+    parser.add_argument("--report", action="store_true",
+                        help="报告重建的每个文档规范化、去重前后的 token 数"
+                             "（配合 --force 报告所有文档）和跨专家共享的段落")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s [%(levelname)s] %(message)s')
+    from utils.document_loader import share_expert_passages
+    from utils.knowledge_bundle import DEFAULT_BUNDLE_DIR, bundle_path
+    from utils.settings import get_setting
+
+    bundle_dir = args.output or get_setting("KNOWLEDGE_BUNDLE_DIR", DEFAULT_BUNDLE_DIR)
+    if not os.path.isdir(args.data_dir):
+        sys.exit(f"找不到专家资料目录: {args.data_dir}")
+    all_experts = sorted(
+        f for f in os.listdir(args.data_dir)
+        if os.path.isdir(os.path.join(args.data_dir, f)))
+    experts = all_experts
+    if args.expert:
+        missing = set(args.expert) - set(experts)
+        if missing:
+            sys.exit(f"找不到专家: {', '.join(sorted(missing))}")
+        experts = [name for name in experts if name in args.expert]
+
+    failed = False
+    report = []
+    for name in experts:
+        start_time = time.perf_counter()
+        documents = [] if args.report else None
+        try:
+            status, header = build_expert(
+                name, os.path.join(args.data_dir, name), bundle_dir, args.force,
+                documents)
+        except Exception as e:
+            failed = True
+            print(f"{name:<24} 失败: {str(e)}")
+            continue
+        elapsed = time.perf_counter() - start_time
+        label = "已构建" if status == "built" else "未变化"
+        print(f"{name:<24} {label}  版本 {header['version']}  "
+              f"{header['token_count']:>9} tokens  "
+              f"{len(header['sources'])} 个源文件  {elapsed:.2f}s")
+        report.extend({"expert": name, **row} for row in documents or [])
+
+    # 跨专家去重覆盖所有已构建的专家（不只是本次指定的）
+    built = [name for name in all_experts
+             if os.path.exists(bundle_path(bundle_dir, name))]
+    sharing = []
+    try:
+        rewritten = share_expert_passages(built, bundle_dir, sharing)
+        if rewritten:
+            print(f"重写引用共享段落的知识包: {', '.join(rewritten)}")
+    except Exception as e:
+        failed = True
+        print(f"跨专家去重失败: {str(e)}")
+    print(f"知识包目录: {bundle_dir}")
+    print_normalization_report(report)
+    if args.report and sharing:
+        print_sharing_report(sharing, bundle_dir)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
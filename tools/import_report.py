@@ -0,0 +1,138 @@
+"""导入耗时报告：统计应用模块的冷启动导入时间，并检查重型依赖是否被提前导入
+
+    python tools/import_report.py
+    python tools/import_report.py --repeat 5 --top 30
+    python tools/import_report.py --check   # 有重型依赖在导入时被加载则返回非 0
+
+基于 python -X importtime，每次在新的子进程中导入，结果不受已缓存模块影响。
+"""
+import argparse
+from collections import defaultdict
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py 启动时导入的模块
+DEFAULT_MODULES = [
+    "utils.expert",
+    "utils.quota",
+    "utils.document_loader",
+    "utils.admission",
+    "utils.avatar",
+    "utils.messages",
+    "utils.conversation_store",
+    "utils.usage_ledger",
+    "utils.tracing",
+    "utils.profiling",
+    "utils.memory_diagnostics",
+    "utils.dropbox_handler",
+]
+
+# 应该在首次使用时才导入的重型依赖
+HEAVY_MODULES = ["openai", "tiktoken", "PyPDF2", "ebooklib", "bs4", "requests",
+                 "PIL", "httpx", "backoff"]
+
+
+def parse_importtime(stderr):
+    """解析 -X importtime 的输出，返回 [(模块名, 自身耗时 us, 累计耗时 us, 深度), ...]"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def measure(modules):
+    """在新进程中导入 modules，返回导入明细"""
+    code = "import " + ", ".join(modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"导入失败:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def summarize(runs, modules, top):
+    """多次运行取中位数：总耗时、耗时最多的模块、按顶层包汇总和已加载的重型依赖"""
+    totals = [sum(self_us for _, self_us, _, _ in rows) for rows in runs]
+    rows = runs[totals.index(sorted(totals)[len(totals) // 2])]
+
+    by_package = defaultdict(int)
+    for name, self_us, _, _ in rows:
+        by_package[name.split(".")[0]] += self_us
+    loaded = {name for name, _, _, _ in rows}
+
+    return {
+        "modules": modules,
+        "runs": len(runs),
+        "total_ms": statistics.median(totals) / 1000,
+        "requested": [
+            {"module": name, "cumulative_ms": cumulative_us / 1000}
+            for name, _, cumulative_us, _ in rows if name in modules
+        ],
+        "slowest": [
+            {"module": name, "self_ms": self_us / 1000,
+             "cumulative_ms": cumulative_us / 1000}
+            for name, self_us, cumulative_us, _ in
+            sorted(rows, key=lambda row: row[2], reverse=True)[:top]
+        ],
+        "packages": [
+            {"package": package, "self_ms": self_us / 1000}
+            for package, self_us in
+            sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+        ],
+        "heavy_loaded": [name for name in HEAVY_MODULES if name in loaded],
+    }
+
+
+def print_report(report):
+    print(f"导入 {len(report['modules'])} 个模块，共 {report['total_ms']:.0f} ms"
+          f"（{report['runs']} 次运行的中位数）")
+    print("\n应用模块（累计耗时）:")
+    for row in report["requested"]:
+        print(f"  {row['cumulative_ms']:8.1f} ms  {row['module']}")
+    print("\n按顶层包汇总（自身耗时）:")
+    for row in report["packages"]:
+        print(f"  {row['self_ms']:8.1f} ms  {row['package']}")
+    print("\n累计耗时最多的模块:")
+    for row in report["slowest"]:
+        print(f"  {row['cumulative_ms']:8.1f} ms  (自身 {row['self_ms']:6.1f})  "
+              f"{row['module']}")
+    heavy = report["heavy_loaded"]
+    print(f"\n导入时加载的重型依赖: {', '.join(heavy) if heavy else '无'}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="应用模块导入耗时报告")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES,
+                        help="要导入的模块（默认为 app.py 导入的 utils 模块）")
+    parser.add_argument("--repeat", type=int, default=3, help="运行次数")
+    parser.add_argument("--top", type=int, default=20, help="显示的模块数量")
+    parser.add_argument("--check", action="store_true",
+                        help="有重型依赖在导入时被加载则返回非 0")
+    parser.add_argument("--json", help="把报告另存为 JSON 文件")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    runs = [measure(args.modules) for _ in range(args.repeat)]
+    report = summarize(runs, args.modules, args.top)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.check and report["heavy_loaded"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
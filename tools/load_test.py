@@ -0,0 +1,263 @@
+"""并发压测：模拟 M 个会话 × N 位专家，走真实的 ExpertAgent 和并发回应流程
+
+先启动本地模拟服务，再运行压测：
+
+    python tools/mock_llm_server.py --error-rate 0.05
+    python tools/load_test.py --sessions 8 --experts 5 --conversations 3
+
+报告吞吐量、请求和对话耗时的 p50/p95/p99、排队等待时间和错误率。
+"""
+import argparse
+from collections import Counter
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ("value investing margin of safety moat free cash flow compounding "
+         "management capital allocation valuation cycle risk patience "
+         "价值 安全边际 护城河 现金流 复利 估值 周期 风险").split()
+
+PROMPT = "请评价这个投资 thesis：一家拥有强大品牌和稳定现金流的消费公司，估值处于历史低位。"
+
+
+def percentile(values, p):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    return {f"p{p}": percentile(values, p) for p in (50, 95, 99)} | {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+    }
+
+
+class Recorder:
+    """收集压测过程中的耗时和错误"""
+
+    def __init__(self):
+        self.requests = []  # 每次模型调用的耗时（秒）
+        self.errors = Counter()  # 异常类型 -> 次数
+        self.conversations = []  # 每次对话从排队到总结完成的耗时
+        self.queue_waits = []  # 每次对话的排队等待时间
+        self.first_responses = []  # 对话开始到第一位专家回应的时间
+
+    def wrap_call_model(self, call_model):
+        """包装 call_model，记录每次请求的耗时和异常（含重试）"""
+        async def timed_call_model(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await call_model(*args, **kwargs)
+            except Exception as e:
+                self.errors[type(e).__name__] += 1
+                raise
+            finally:
+                self.requests.append(time.perf_counter() - start_time)
+        return timed_call_model
+
+    def report(self, elapsed, args, server_stats=None):
+        total_calls = len(self.requests)
+        return {
+            "sessions": args.sessions,
+            "experts": args.experts,
+            "conversations": len(self.conversations),
+            "elapsed_seconds": elapsed,
+            "throughput": {
+                "conversations_per_second": len(self.conversations) / elapsed,
+                "requests_per_second": total_calls / elapsed,
+            },
+            "request_latency": summarize(self.requests),
+            "conversation_latency": summarize(self.conversations),
+            "first_response_latency": summarize(self.first_responses),
+            "queue_wait": summarize(self.queue_waits),
+            "errors": {
+                "total": sum(self.errors.values()),
+                "rate": sum(self.errors.values()) / total_calls if total_calls else 0,
+                "by_type": dict(self.errors),
+            },
+            # 服务端注入的故障（包括被 SDK 自动重试掉、应用层看不到的部分）
+            "server": server_stats,
+        }
+
+
+def make_knowledge(tokens):
+    """生成大约 tokens 个 token 的模拟知识库文本"""
+    return " ".join(random.choice(WORDS) for _ in range(tokens))
+
+
+def configure_environment(args):
+    """把应用指向模拟服务；必须在导入 utils.expert 之前设置"""
+    base_url = args.base_url.rstrip("/")
+    os.environ["XAI_API_BASE"] = f"{base_url}/v1"
+    os.environ["GEMINI_API_BASE"] = f"{base_url}/v1beta"
+    os.environ.setdefault("XAI_API_KEY", "mock")
+    os.environ.setdefault("GOOGLE_API_KEY", "mock")
+    # 压测产生的用量记录不写入正式账本
+    os.environ["USAGE_DB_PATH"] = os.path.join(
+        tempfile.mkdtemp(prefix="load-test-"), "usage.db")
+
+
+async def run_session(index, args, recorder):
+    """模拟一个会话：依次进行 args.conversations 次对话"""
+    from utils.admission import POLL_INTERVAL_SECONDS, admission_ticket, \
+        get_admission_scheduler
+    from utils.expert import ExpertAgent, get_batched_responses_async, \
+        get_responses_async
+    from utils.quota import calculate_conversation_quota
+
+    session_id = f"load-test-{index}"
+    # 每个会话的提问不同，录制 / 回放时各会话的请求才能一一对应
+    prompt = f"{PROMPT}（会话 {index + 1}）"
+    # 和应用一样，每个会话持有自己的专家对象
+    experts = [ExpertAgent(f"Expert {i + 1}", args.knowledge[i])
+               for i in range(args.experts)]
+    scheduler = get_admission_scheduler()
+
+    for _ in range(args.conversations):
+        start_time = time.perf_counter()
+        ticket = None
+        if not args.no_admission:
+            units = calculate_conversation_quota(len(experts), args.batch_size)
+            ticket = scheduler.enqueue(session_id, args.model, units)
+            while not scheduler.is_ready(ticket):
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+            admission_ticket.set(ticket)
+        recorder.queue_waits.append(time.perf_counter() - start_time)
+
+        try:
+            if args.batch_size:
+                responses = get_batched_responses_async(
+                    experts, prompt, args.batch_size)
+            else:
+                responses = get_responses_async(experts, prompt)
+            first = True
+            async for _expert, _response in responses:
+                if first:
+                    recorder.first_responses.append(
+                        time.perf_counter() - start_time)
+                    first = False
+        finally:
+            if ticket is not None:
+                scheduler.cancel(ticket)
+        recorder.conversations.append(time.perf_counter() - start_time)
+
+        if args.think_time:
+            await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+
+
+async def fetch_server_stats(base_url):
+    """读取模拟服务的计数器，失败时返回 None"""
+    import aiohttp
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{base_url.rstrip('/')}/stats") as response:
+                return await response.json()
+    except aiohttp.ClientError:
+        return None
+
+
+async def run(args):
+    import streamlit as st
+    import utils.expert as expert_module
+
+    recorder = Recorder()
+    expert_module.call_model = recorder.wrap_call_model(expert_module.call_model)
+    if args.requests_per_second:
+        expert_module.rate_limiter.requests_per_second = args.requests_per_second
+
+    st.session_state.current_model = args.model
+    st.session_state.titans = expert_module.ExpertAgent(
+        name="Investment Masters", knowledge_base="")
+    args.knowledge = [make_knowledge(args.knowledge_tokens)
+                      for _ in range(args.experts)]
+
+    before = await fetch_server_stats(args.base_url)
+    start_time = time.perf_counter()
+    await asyncio.gather(*(run_session(i, args, recorder)
+                           for i in range(args.sessions)))
+    elapsed = time.perf_counter() - start_time
+    after = await fetch_server_stats(args.base_url)
+
+    server_stats = None
+    if before and after:
+        server_stats = {key: after[key] - before.get(key, 0) for key in after}
+    return recorder.report(elapsed, args, server_stats)
+
+
+def format_latency(stats):
+    if not stats["count"]:
+        return "无数据"
+    return (f"p50 {stats['p50']:.2f}s  p95 {stats['p95']:.2f}s  "
+            f"p99 {stats['p99']:.2f}s  (n={stats['count']})")
+
+
+def print_report(report):
+    throughput = report["throughput"]
+    errors = report["errors"]
+    print(f"会话 {report['sessions']} × 专家 {report['experts']}，"
+          f"共 {report['conversations']} 次对话，耗时 {report['elapsed_seconds']:.1f}s")
+    print(f"吞吐量:     {throughput['conversations_per_second']:.2f} 对话/s，"
+          f"{throughput['requests_per_second']:.2f} 请求/s")
+    print(f"请求耗时:   {format_latency(report['request_latency'])}")
+    print(f"首个回应:   {format_latency(report['first_response_latency'])}")
+    print(f"对话耗时:   {format_latency(report['conversation_latency'])}")
+    print(f"排队等待:   {format_latency(report['queue_wait'])}")
+    print(f"错误率:     {errors['rate']:.1%} ({errors['total']} 次) {errors['by_type']}")
+    if report["server"]:
+        server = report["server"]
+        print(f"服务端:     {server['requests']} 个请求，注入 429 {server['rate_limited']} 次，"
+              f"超时 {server['timeouts']} 次")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="专家并发流程压测")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8900",
+                        help="模拟服务地址")
+    parser.add_argument("--sessions", type=int, default=4, help="并发会话数")
+    parser.add_argument("--experts", type=int, default=5, help="每个会话的专家数")
+    parser.add_argument("--conversations", type=int, default=2,
+                        help="每个会话的对话次数")
+    parser.add_argument("--model", default="grok-beta",
+                        choices=["grok-beta", "gemini-1.5-flash", "gemini-2.0-flash-exp"])
+    parser.add_argument("--batch-size", type=int, help="开启批量模式时每批的专家数")
+    parser.add_argument("--knowledge-tokens", type=int, default=2000,
+                        help="每位专家的模拟知识库大小")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="两次对话之间的平均间隔（秒）")
+    parser.add_argument("--requests-per-second", type=float,
+                        help="覆盖 Grok 的客户端限速（默认每秒 1 个请求）")
+    parser.add_argument("--no-admission", action="store_true",
+                        help="跳过配额排队，直接发送请求")
+    parser.add_argument("--json", help="把报告另存为 JSON 文件")
+    parser.add_argument("--seed", type=int, help="随机种子")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    configure_environment(args)
+    logging.disable(logging.WARNING)  # 应用日志和 Streamlit 的裸模式警告会淹没报告
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""本地模拟 LLM 服务：兼容 OpenAI chat-completions 和 Gemini generateContent 接口
+
+用于压测和本地调试，不消耗真实的 Grok / Gemini 配额。
+
+    python tools/mock_llm_server.py --port 8900 --latency lognormal:0.8,0.4 \\
+        --tokens-per-second 60 --error-rate 0.05 --timeout-rate 0.01
+
+然后把应用指向本服务：
+
+    XAI_API_BASE=http://127.0.0.1:8900/v1
+    GEMINI_API_BASE=http://127.0.0.1:8900/v1beta
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+import uuid
+from aiohttp import web
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+LOREM = ("价值 投资 安全边际 护城河 现金流 复利 风险 估值 管理层 竞争优势 "
+         "margin of safety moat cash flow compounding valuation").split()
+
+
+def parse_distribution(spec):
+    """解析延迟分布，如 fixed:0.5、uniform:0.2,1.5、normal:1,0.3、lognormal:0.8,0.4（秒）"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",")] if params else []
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        # 参数为中位数和对数标准差，便于直观配置
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    raise ValueError(f"不支持的延迟分布: {spec}")
+
+
+# 批量模式的提示词：一次请求包含多位专家，要求按 JSON 回答
+BATCH_NAMES_RE = re.compile(r"你将同时扮演以下几位投资大师：(.+?)。")
+
+
+def estimate_tokens(text):
+    """粗略估计 token 数（约 4 个字符一个 token）"""
+    return max(1, len(text) // 4)
+
+
+class MockLLM:
+    """模拟模型行为：首字节延迟、输出速度、错误注入和用量统计"""
+
+    def __init__(self, args):
+        self.latency = parse_distribution(args.latency)
+        self.tokens_per_second = args.tokens_per_second
+        self.completion_tokens = args.completion_tokens
+        self.error_rate = args.error_rate
+        self.timeout_rate = args.timeout_rate
+        self.timeout_seconds = args.timeout_seconds
+        self.stats = {"requests": 0, "rate_limited": 0, "timeouts": 0}
+
+    def completion_length(self, max_tokens):
+        low, high = self.completion_tokens
+        length = random.randint(low, high)
+        return min(length, max_tokens) if max_tokens else length
+
+    def pieces(self, count):
+        """生成 count 个 token 的回复片段"""
+        return [random.choice(LOREM) + " " for _ in range(count)]
+
+    async def inject_faults(self):
+        """按概率注入故障：返回 429 响应，或者挂起直到客户端超时"""
+        self.stats["requests"] += 1
+        if random.random() < self.error_rate:
+            self.stats["rate_limited"] += 1
+            return True
+        if random.random() < self.timeout_rate:
+            self.stats["timeouts"] += 1
+            await asyncio.sleep(self.timeout_seconds)
+        return False
+
+    async def generate(self, count, prompt=""):
+        """模拟完整生成：首字节延迟 + 按输出速度生成 count 个 token"""
+        await asyncio.sleep(self.latency() + count / self.tokens_per_second)
+        match = BATCH_NAMES_RE.search(prompt)
+        if match:
+            # 批量请求按约定的 JSON 格式回答，每位专家平分输出
+            names = match.group(1).split("、")
+            share = max(1, count // len(names))
+            return json.dumps({"answers": [
+                {"name": name, "answer": "".join(self.pieces(share))}
+                for name in names]}, ensure_ascii=False)
+        return "".join(self.pieces(count))
+
+    async def stream(self, count, chunk_tokens=8):
+        """模拟流式生成，每次产出 chunk_tokens 个 token"""
+        await asyncio.sleep(self.latency())
+        pieces = self.pieces(count)
+        for i in range(0, count, chunk_tokens):
+            chunk = pieces[i:i + chunk_tokens]
+            await asyncio.sleep(len(chunk) / self.tokens_per_second)
+            yield "".join(chunk)
+
+
+def rate_limit_response(gemini=False):
+    if gemini:
+        body = {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                          "message": "Resource has been exhausted (mock)."}}
+    else:
+        body = {"error": {"type": "rate_limit_error", "code": "rate_limit_exceeded",
+                          "message": "Rate limit exceeded (mock)."}}
+    return web.json_response(body, status=429, headers={"retry-after": "1"})
+
+
+async def start_sse(request):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    return response
+
+
+async def chat_completions(request):
+    """OpenAI 兼容的 /v1/chat/completions（支持 stream）"""
+    mock = request.app["mock"]
+    body = await request.json()
+    if await mock.inject_faults():
+        return rate_limit_response()
+
+    prompt = "\n".join(str(m.get("content", ""))
+                       for m in body.get("messages", []))
+    prompt_tokens = estimate_tokens(prompt)
+    count = mock.completion_length(body.get("max_tokens"))
+    completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+    model = body.get("model", "mock")
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": count,
+             "total_tokens": prompt_tokens + count}
+
+    if not body.get("stream"):
+        text = await mock.generate(count, prompt)
+        return web.json_response({
+            "id": completion_id, "object": "chat.completion",
+            "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": usage,
+        })
+
+    response = await start_sse(request)
+
+    def event(delta, finish_reason=None, with_usage=False):
+        data = {"id": completion_id, "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta,
+                             "finish_reason": finish_reason}]}
+        if with_usage:
+            data["usage"] = usage
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+    await response.write(event({"role": "assistant", "content": ""}))
+    async for piece in mock.stream(count):
+        await response.write(event({"content": piece}))
+    include_usage = (body.get("stream_options") or {}).get("include_usage")
+    await response.write(event({}, "stop", with_usage=include_usage))
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+def gemini_payload(text, prompt_tokens, count, finish_reason=None):
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]},
+                 "index": 0}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return {"candidates": [candidate],
+            "usageMetadata": {"promptTokenCount": prompt_tokens,
+                              "candidatesTokenCount": count,
+                              "totalTokenCount": prompt_tokens + count}}
+
+
+async def gemini_generate(request):
+    """Gemini 兼容的 models/{model}:generateContent 和 :streamGenerateContent"""
+    mock = request.app["mock"]
+    model, _, method = request.match_info["target"].partition(":")
+    if method not in ("generateContent", "streamGenerateContent"):
+        raise web.HTTPNotFound()
+    body = await request.json()
+    if await mock.inject_faults():
+        return rate_limit_response(gemini=True)
+
+    prompt = "\n".join(part.get("text", "")
+                       for content in body.get("contents", [])
+                       for part in content.get("parts", []))
+    prompt_tokens = estimate_tokens(prompt)
+    max_tokens = body.get("generationConfig", {}).get("maxOutputTokens")
+    count = mock.completion_length(max_tokens)
+
+    if method == "generateContent":
+        text = await mock.generate(count, prompt)
+        return web.json_response(gemini_payload(text, prompt_tokens, count, "STOP"))
+
+    # alt=sse 时按 SSE 推送，否则返回 JSON 数组（与官方接口一致）
+    if request.query.get("alt") == "sse":
+        response = await start_sse(request)
+        async for piece in mock.stream(count):
+            payload = gemini_payload(piece, prompt_tokens, count)
+            await response.write(
+                f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode())
+        payload = gemini_payload("", prompt_tokens, count, "STOP")
+        await response.write(
+            f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode())
+        return response
+
+    chunks = [gemini_payload(piece, prompt_tokens, count)
+              async for piece in mock.stream(count)]
+    chunks[-1]["candidates"][0]["finishReason"] = "STOP"
+    return web.json_response(chunks)
+
+
+async def stats(request):
+    return web.json_response(request.app["mock"].stats)
+
+
+def create_app(args):
+    app = web.Application()
+    app["mock"] = MockLLM(args)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1beta/models/{target}", gemini_generate)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="本地模拟 LLM 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", default="lognormal:0.8,0.4",
+                        help="首字节延迟分布（秒），如 fixed:0.5、uniform:0.2,1.5、"
+                             "normal:1,0.3、lognormal:中位数,sigma")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0,
+                        help="输出速度（tokens/秒）")
+    parser.add_argument("--completion-tokens", type=int, nargs=2,
+                        default=(150, 400), metavar=("MIN", "MAX"),
+                        help="每次回复的 token 数范围")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="返回 429 的概率")
+    parser.add_argument("--timeout-rate", type=float, default=0.0,
+                        help="挂起请求（模拟超时）的概率")
+    parser.add_argument("--timeout-seconds", type=float, default=120.0,
+                        help="挂起请求的时长")
+    parser.add_argument("--seed", type=int, help="随机种子（便于复现）")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(levelname)s] %(message)s')
+    web.run_app(create_app(args), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
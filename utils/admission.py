@@ -0,0 +1,206 @@
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+import asyncio
+import itertools
+import logging
+import threading
+import time
+import streamlit as st
+from .quota import get_limit, reserve_tokens
+from .quota_ledger import get_quota_ledger, WINDOW_SECONDS
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 排队中的票据超过这么久没有心跳，视为用户已离开
+TICKET_TIMEOUT_SECONDS = 30
+# 等待配额时的轮询间隔
+POLL_INTERVAL_SECONDS = 0.5
+
+# 当前异步任务所属的准入票据，call_model 发请求前从这里领取配额
+admission_ticket = ContextVar("admission_ticket", default=None)
+
+
+class AdmissionCancelled(Exception):
+    """排队被取消（用户离开或主动取消）"""
+
+
+class AdmissionTicket:
+    """一次对话的准入票据：需要 units 个请求，配额空出时逐个发放"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, scheduler, session_id, model_name, units):
+        self.id = next(self._ids)
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.model_name = model_name
+        self.pending = units  # 尚未发放的请求数
+        self.grants = deque()  # 已发放、尚未使用的请求（账本中预留记录的句柄）
+        self.started = False  # 是否已经拿到过请求（对话已开始）
+        self.cancelled = False
+        self.created_at = time.monotonic()
+        self.last_seen = self.created_at
+
+    def heartbeat(self):
+        self.last_seen = time.monotonic()
+
+    def try_take(self):
+        """尝试领取一个已发放的请求（不等待）"""
+        with self.scheduler.lock:
+            if self.cancelled:
+                raise AdmissionCancelled(f"票据 {self.id} 已取消")
+            self.heartbeat()
+            if not self.grants and self.pending == 0:
+                # 重试等额外请求：追加到自己的队尾
+                self.pending = 1
+                self.scheduler._enqueue_locked(self)
+            if self.grants:
+                self.grants.popleft()
+                return True
+        return False
+
+    async def acquire(self, tokens=0, token_model=None):
+        """等待并领取一个请求配额，再等待 tokens 预算；返回 TokenReservation（不需要时为 None）
+
+        请求数（RPM）记在票据的模型上，tokens（TPM）记在 token_model（实际调用的模型）上
+        """
+        while True:
+            self.scheduler.pump(self.model_name)
+            if self.try_take():
+                break
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+        # 每分钟 token 预算（TPM）：按发送前的预估预留
+        while tokens:
+            reservation = reserve_tokens(token_model or self.model_name, tokens)
+            if reservation is not None:
+                return reservation
+            if self.cancelled:
+                raise AdmissionCancelled(f"票据 {self.id} 已取消")
+            self.heartbeat()
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+        return None
+
+
+class AdmissionScheduler:
+    """准入调度器：按会话轮询（公平）发放配额，同一会话内先来先服务"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._queues = {}  # 模型 -> OrderedDict(会话 id -> deque[票据])
+
+    def enqueue(self, session_id, model_name, units):
+        """为一次对话排队，返回票据"""
+        ticket = AdmissionTicket(self, session_id, model_name, units)
+        with self.lock:
+            self._enqueue_locked(ticket)
+        logger.info(f"会话 {session_id} 排队：{model_name} 需要 {units} 个请求")
+        return ticket
+
+    def _enqueue_locked(self, ticket):
+        sessions = self._queues.setdefault(ticket.model_name, OrderedDict())
+        queue = sessions.setdefault(ticket.session_id, deque())
+        if ticket not in queue:
+            queue.append(ticket)
+
+    def cancel(self, ticket):
+        """取消票据：未发放的请求不再占用队列，已发放但没有用到的请求归还给账本"""
+        with self.lock:
+            ticket.cancelled = True
+            ticket.pending = 0
+            self._remove_locked(ticket)
+            self._release_locked(ticket)
+
+    def _release_locked(self, ticket):
+        limit = get_limit(ticket.model_name)
+        while ticket.grants:
+            get_quota_ledger().adjust(
+                ticket.model_name, ticket.grants.popleft(), 0, limit)
+
+    def _remove_locked(self, ticket):
+        sessions = self._queues.get(ticket.model_name, {})
+        queue = sessions.get(ticket.session_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del sessions[ticket.session_id]
+
+    def _expire_locked(self, model_name):
+        """移除还在排队、但长时间没有心跳的票据（用户已离开）"""
+        cutoff = time.monotonic() - TICKET_TIMEOUT_SECONDS
+        for queue in list(self._queues.get(model_name, {}).values()):
+            for ticket in list(queue):
+                if not ticket.started and ticket.last_seen < cutoff:
+                    logger.info(f"票据 {ticket.id} 超时未响应，取消排队")
+                    ticket.cancelled = True
+                    ticket.pending = 0
+                    self._remove_locked(ticket)
+
+    def pump(self, model_name):
+        """在配额允许的范围内，按会话轮流发放请求"""
+        with self.lock:
+            self._expire_locked(model_name)
+            sessions = self._queues.get(model_name)
+            while sessions:
+                session_id, queue = next(iter(sessions.items()))
+                ticket = queue[0]
+                grant = get_quota_ledger().reserve_entry(
+                    model_name, 1, get_limit(model_name))
+                if grant is None:
+                    break
+                ticket.pending -= 1
+                ticket.grants.append(grant)
+                ticket.started = True
+                if ticket.pending == 0:
+                    queue.popleft()
+                # 发放一个请求后，该会话排到队尾
+                if queue:
+                    sessions.move_to_end(session_id)
+                else:
+                    del sessions[session_id]
+
+    def is_ready(self, ticket):
+        """票据是否已经拿到第一个请求（可以开始对话）"""
+        self.pump(ticket.model_name)
+        with self.lock:
+            ticket.heartbeat()
+            return bool(ticket.grants) or ticket.cancelled
+
+    def position(self, ticket):
+        """票据拿到下一个请求之前，排在前面的请求数"""
+        with self.lock:
+            sessions = self._queues.get(ticket.model_name, {})
+            ahead = 0
+            for session_id, queue in sessions.items():
+                if session_id == ticket.session_id:
+                    # 同一会话内排在前面的票据需要先发完
+                    for other in queue:
+                        if other is ticket:
+                            break
+                        ahead += other.pending
+                    break
+                ahead += 1  # 轮询：每个排在前面的会话先发一个
+            return ahead
+
+    def eta(self, ticket):
+        """预计多少秒后可以拿到下一个请求"""
+        limit = get_limit(ticket.model_name)
+        used, request_times = get_quota_ledger().snapshot(
+            ticket.model_name, limit)
+        needed = self.position(ticket) + 1 - (limit - used)
+        if needed <= 0:
+            return 0
+        if needed > len(request_times):
+            # 需要等待超过一个窗口
+            rounds = (needed - 1) // max(limit, 1)
+            return WINDOW_SECONDS * (rounds + 1)
+        release_time = request_times[needed - 1] + timedelta(seconds=WINDOW_SECONDS)
+        return max(0, int((release_time - datetime.now()).total_seconds()) + 1)
+
+
+@st.cache_resource
+def get_admission_scheduler():
+    """获取进程内共享的准入调度器"""
+    return AdmissionScheduler()
@@ -0,0 +1,98 @@
+import base64
+from functools import lru_cache
+import hashlib
+from io import BytesIO
+import logging
+import os
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 头像缩略图的最长边（页面上显示为 10rem，按 2 倍像素密度取整）
+AVATAR_SIZE = 256
+AVATAR_FORMAT = "WEBP"
+AVATAR_QUALITY = 80
+
+# 缩略图缓存目录：文件名包含原图内容哈希，原图变化后自动失效
+AVATAR_CACHE_DIR = os.path.join(".cache", "avatars")
+
+# 画廊头像作为静态文件提供（.streamlit/config.toml 开启 enableStaticServing），
+# 页面只引用短 URL，不再每次重跑都发送 base64 图片
+AVATAR_STATIC_DIR = os.path.join("static", "avatars")
+AVATAR_STATIC_URL = "./app/static/avatars"
+
+
+def make_avatar_thumbnail(image_path, size=AVATAR_SIZE):
+    """生成头像缩略图（保留透明背景），按内容哈希缓存到磁盘"""
+    with open(image_path, "rb") as f:
+        data = f.read()
+
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    cache_path = os.path.join(
+        AVATAR_CACHE_DIR, f"{digest}_{size}.{AVATAR_FORMAT.lower()}")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return f.read()
+
+    from PIL import Image  # 只有缓存未命中时才需要 Pillow
+    image = Image.open(BytesIO(data))
+    image = image.convert("RGBA")
+    image.thumbnail((size, size), Image.LANCZOS)
+
+    buffer = BytesIO()
+    image.save(buffer, format=AVATAR_FORMAT, quality=AVATAR_QUALITY)
+    thumbnail = buffer.getvalue()
+
+    try:
+        os.makedirs(AVATAR_CACHE_DIR, exist_ok=True)
+        with open(cache_path, "wb") as f:
+            f.write(thumbnail)
+    except OSError as e:
+        logger.warning(f"写入头像缓存失败 {cache_path}: {str(e)}")
+
+    logger.info(f"生成头像缩略图 {image_path}: "
+                f"{len(data)} bytes -> {len(thumbnail)} bytes")
+    return thumbnail
+
+
+def load_avatar_data_uri(image_path):
+    """加载头像缩略图的 data URI（同一文件只编码一次）"""
+    try:
+        return _load_avatar_data_uri(image_path, os.path.getmtime(image_path))
+    except Exception as e:
+        logger.error(f"加载头像图片失败 {image_path}: {str(e)}")
+        return None
+
+
+@lru_cache(maxsize=256)
+def _load_avatar_data_uri(image_path, mtime):
+    encoded = base64.b64encode(make_avatar_thumbnail(image_path)).decode()
+    return f"data:image/{AVATAR_FORMAT.lower()};base64,{encoded}"
+
+
+def publish_avatar(avatar):
+    """把 data URI 形式的头像写成静态文件（文件名为内容哈希），返回其 URL
+
+    不是 base64 data URI 的头像（emoji、内联 SVG 等）原样返回；写入失败时退回 data URI
+    """
+    if not avatar or not avatar.startswith("data:image/"):
+        return avatar
+    header, _, encoded = avatar.partition(",")
+    if not header.endswith(";base64"):
+        return avatar
+    # 扩展名决定静态文件的 Content-Type：image/svg+xml -> .svg
+    extension = header[len("data:image/"):-len(";base64")].split("+")[0]
+    data = base64.b64decode(encoded)
+    filename = f"{hashlib.sha256(data).hexdigest()[:16]}.{extension}"
+    path = os.path.join(AVATAR_STATIC_DIR, filename)
+    if not os.path.exists(path):
+        try:
+            os.makedirs(AVATAR_STATIC_DIR, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"写入静态头像失败 {path}: {str(e)}")
+            return avatar
+    return f"{AVATAR_STATIC_URL}/{filename}"
@@ -0,0 +1,287 @@
+from collections import defaultdict
+from datetime import timedelta
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import streamlit as st
+from .settings import get_setting
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+DEFAULT_CASSETTE_PATH = os.path.join(".cache", "cassettes", "default.jsonl")
+
+# 回放时保留的响应头（其余的如 content-length、date 没有意义）
+KEPT_HEADERS = ("content-type", "retry-after", "x-request-id")
+
+# 传输层必须和 OpenAI SDK 使用同一个 HTTP 库：openai 3 起 SDK 基于 httpx2，之前基于 httpx
+try:
+    import httpx2 as httpx
+except ImportError:
+    import httpx
+
+
+class CassetteMiss(Exception):
+    """回放模式下找不到匹配的录制请求"""
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def describe_request(provider, method, path, body):
+    """请求的元数据：只保存提示词的哈希，不保存原文"""
+    try:
+        payload = json.loads(body) if body else {}
+    except ValueError:
+        payload = {}
+    if provider == "openai":
+        prompt = "\n".join(str(m.get("content", ""))
+                           for m in payload.get("messages", []))
+        model = payload.get("model")
+    else:
+        prompt = "\n".join(part.get("text", "")
+                           for content in payload.get("contents", [])
+                           for part in content.get("parts", []))
+        model = path.rsplit("/", 1)[-1].split(":")[0]
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False) \
+        if payload else body.decode("utf-8", "replace") if body else ""
+    return {
+        "provider": provider,
+        "method": method,
+        "path": path,
+        "model": model,
+        "stream": bool(payload.get("stream")) or ":stream" in path,
+        "prompt_sha256": hash_text(prompt),
+        "prompt_chars": len(prompt),
+        "key": hash_text(f"{provider} {method} {path} {canonical}"),
+    }
+
+
+class Cassette:
+    """录制 / 回放 LLM 请求：每行一条 JSON 记录，按请求内容的哈希匹配
+
+    speed 为回放时的时间缩放系数：1 为原始节奏，0.5 为两倍速，0 为不等待
+    """
+
+    def __init__(self, path, mode, speed=1.0):
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._entries = defaultdict(list)  # key -> 按录制顺序排列的记录
+        self._served = defaultdict(int)  # key -> 已回放的次数
+        if mode == "replay":
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["request"]["key"]].append(entry)
+            logger.info(f"回放 LLM 请求: {path}, "
+                        f"{sum(map(len, self._entries.values()))} 条记录, 速度 {speed}")
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            logger.info(f"录制 LLM 请求到: {path}")
+
+    def next_entry(self, request_info):
+        """取出下一条匹配的记录；同一请求被回放的次数多于录制次数时重复最后一条"""
+        with self._lock:
+            entries = self._entries.get(request_info["key"])
+            if not entries:
+                raise CassetteMiss(
+                    f"没有录制过该请求: {request_info['provider']} "
+                    f"{request_info['path']} (prompt {request_info['prompt_sha256'][:12]})")
+            index = min(self._served[request_info["key"]], len(entries) - 1)
+            self._served[request_info["key"]] += 1
+            return entries[index]
+
+    def record(self, request_info, status, headers, chunks, ttfb):
+        """追加一条记录；chunks 为 [(距请求开始的秒数, 原始字节), ...]"""
+        entry = {
+            "request": request_info,
+            "response": {
+                "status": status,
+                "headers": {k: v for k, v in headers.items()
+                            if k.lower() in KEPT_HEADERS},
+                "ttfb": ttfb,
+                "chunks": [[round(offset, 6), base64.b64encode(data).decode()]
+                           for offset, data in chunks],
+            },
+            "recorded_at": time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def scaled(self, seconds):
+        return seconds * self.speed
+
+
+def decode_chunks(entry):
+    return [(offset, base64.b64decode(data))
+            for offset, data in entry["response"]["chunks"]]
+
+
+class RecordingStream(httpx.AsyncByteStream):
+    """边读边记录响应分块及其时间，读完后写入 cassette"""
+
+    def __init__(self, stream, on_complete, start_time):
+        self._stream = stream
+        self._on_complete = on_complete
+        self._start_time = start_time
+        self._chunks = []
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._chunks.append((time.monotonic() - self._start_time, chunk))
+            yield chunk
+
+    async def aclose(self):
+        await self._stream.aclose()
+        if self._on_complete is not None:
+            self._on_complete(self._chunks)
+            self._on_complete = None
+
+
+class ReplayStream(httpx.AsyncByteStream):
+    """按录制时的节奏（乘以速度系数）逐块返回响应"""
+
+    def __init__(self, cassette, chunks, start_time):
+        self._cassette = cassette
+        self._chunks = chunks
+        self._start_time = start_time
+
+    async def __aiter__(self):
+        for offset, chunk in self._chunks:
+            delay = self._cassette.scaled(offset) - (time.monotonic() - self._start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """OpenAI 客户端（Grok）的传输层：录制或回放 HTTP 请求"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self._transport = httpx.AsyncHTTPTransport() if cassette.mode == "record" else None
+
+    async def handle_async_request(self, request):
+        start_time = time.monotonic()
+        request_info = describe_request(
+            "openai", request.method, request.url.path, await request.aread())
+
+        if self.cassette.mode == "replay":
+            entry = self.cassette.next_entry(request_info)
+            response = entry["response"]
+            delay = self.cassette.scaled(response["ttfb"])
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return httpx.Response(
+                response["status"], headers=response["headers"],
+                stream=ReplayStream(self.cassette, decode_chunks(entry), start_time),
+                request=request)
+
+        # 录制原始字节：要求服务端不压缩，回放时无需处理 content-encoding
+        request.headers["accept-encoding"] = "identity"
+        response = await self._transport.handle_async_request(request)
+        ttfb = time.monotonic() - start_time
+
+        def on_complete(chunks):
+            self.cassette.record(request_info, response.status_code,
+                                 response.headers, chunks, ttfb)
+
+        return httpx.Response(
+            response.status_code, headers=response.headers,
+            stream=RecordingStream(response.stream, on_complete, start_time),
+            request=request, extensions=response.extensions)
+
+    async def aclose(self):
+        if self._transport is not None:
+            await self._transport.aclose()
+
+
+class CassetteAdapter:
+    """requests 的传输适配器（Gemini REST 接口）：录制或回放 HTTP 请求
+
+    录制时把请求交给内部的 HTTPAdapter 发送；requests 只在创建适配器时导入
+    """
+
+    def __init__(self, cassette):
+        from requests.adapters import HTTPAdapter
+        self.cassette = cassette
+        self._adapter = HTTPAdapter() if cassette.mode == "record" else None
+
+    def send(self, request, stream=False, **kwargs):
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        start_time = time.monotonic()
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        path = requests.utils.urlparse(request.url).path
+        request_info = describe_request("gemini", request.method, path, body)
+
+        if self.cassette.mode == "replay":
+            entry = self.cassette.next_entry(request_info)
+            recorded = entry["response"]
+            chunks = decode_chunks(entry)
+            total = chunks[-1][0] if chunks else recorded["ttfb"]
+            time.sleep(self.cassette.scaled(total))
+            response = requests.Response()
+            response.status_code = recorded["status"]
+            response.headers = CaseInsensitiveDict(recorded["headers"])
+            response._content = b"".join(data for _, data in chunks)
+            response.encoding = "utf-8"
+            response.url = request.url
+            response.request = request
+            response.elapsed = timedelta(seconds=self.cassette.scaled(recorded["ttfb"]))
+            return response
+
+        request.headers["Accept-Encoding"] = "identity"
+        response = self._adapter.send(request, stream=True, **kwargs)
+        ttfb = time.monotonic() - start_time
+        chunks = [(time.monotonic() - start_time, chunk)
+                  for chunk in response.raw.stream(8192, decode_content=False)]
+        response._content = b"".join(data for _, data in chunks)
+        self.cassette.record(request_info, response.status_code,
+                             response.headers, chunks, ttfb)
+        return response
+
+    def close(self):
+        if self._adapter is not None:
+            self._adapter.close()
+
+
+@st.cache_resource
+def get_cassette():
+    """按配置创建 cassette（LLM_CASSETTE_MODE = "record" 或 "replay"，否则返回 None）"""
+    mode = (get_setting("LLM_CASSETTE_MODE") or "").lower()
+    if mode not in ("record", "replay"):
+        return None
+    return Cassette(get_setting("LLM_CASSETTE_PATH", DEFAULT_CASSETTE_PATH), mode,
+                    float(get_setting("LLM_REPLAY_SPEED", 1.0)))
+
+
+def get_cassette_transport():
+    """OpenAI 客户端使用的传输层；未开启录制 / 回放时返回 None（使用默认传输层）"""
+    cassette = get_cassette()
+    return CassetteTransport(cassette) if cassette else None
+
+
+def create_http_session():
+    """Gemini 请求使用的 requests 会话；开启录制 / 回放时挂载 cassette 适配器"""
+    import requests
+    session = requests.Session()
+    cassette = get_cassette()
+    if cassette:
+        adapter = CassetteAdapter(cassette)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    return session
@@ -0,0 +1,87 @@
+from dataclasses import replace
+import logging
+import sqlite3
+import threading
+import time
+import streamlit as st
+from .messages import ChatMessage
+from .settings import get_setting
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 每页加载的消息数量
+PAGE_SIZE = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    expert_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session
+    ON messages (session_id, created_at, id);
+"""
+
+
+class ConversationStore:
+    """基于 SQLite 的对话存储（只追加），按会话分页读取"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        logger.info(f"对话存储已打开: {path}")
+
+    def append(self, session_id, message):
+        """追加一条消息，返回带有 id 和时间戳的消息"""
+        created_at = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO messages (session_id, created_at, role, content, expert_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, created_at, message.role, message.content,
+                 message.expert_id)
+            )
+        return replace(message, id=cursor.lastrowid, created_at=created_at)
+
+    def load_page(self, session_id, before_id=None, limit=PAGE_SIZE):
+        """读取一页消息（按时间正序），before_id 为空时读取最新一页"""
+        query = ("SELECT id, created_at, role, content, expert_id FROM messages "
+                 "WHERE session_id = ?")
+        params = [session_id]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        return [
+            ChatMessage(id=row_id, created_at=created_at, role=role,
+                        content=content, expert_id=expert_id)
+            for row_id, created_at, role, content, expert_id in reversed(rows)
+        ]
+
+    def has_older(self, session_id, before_id):
+        """是否还有更早的消息"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM messages WHERE session_id = ? AND id < ? LIMIT 1",
+                (session_id, before_id)
+            ).fetchone()
+        return row is not None
+
+
+@st.cache_resource
+def get_conversation_store():
+    """获取进程内共享的对话存储"""
+    return ConversationStore(get_setting("CONVERSATION_DB_PATH", "conversations.db"))
@@ -0,0 +1,148 @@
+from array import array
+from collections import defaultdict, deque
+import logging
+import re
+import zlib
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 段落切分：在词边界切分，最近 SHINGLE_WORDS 个词的哈希满足条件时作为段落边界。
+# 边界只由内容决定，与标点、换行和文档格式无关，同一本书的 PDF 和 EPUB 版本会切出相同的段落
+PASSAGE_BOUNDARY_MODULUS = 100  # 达到最小长度后平均每 100 个词一个边界
+MIN_PASSAGE_WORDS = 40
+MAX_PASSAGE_WORDS = 400
+
+# 近重复检测：按词的 shingle 计算 MinHash 签名，LSH 分段找候选，再用精确的 Jaccard 相似度确认
+SHINGLE_WORDS = 5
+MINHASH_BINS = 32  # 单次哈希的 MinHash（one permutation hashing）：按哈希值分桶取最小值
+LSH_BANDS = 8  # 每段 MINHASH_BINS // LSH_BANDS 个桶，整段相同即为候选
+DUPLICATE_THRESHOLD = 0.8  # Jaccard 相似度达到此值视为近重复
+MIN_SHINGLES = 8  # shingle 太少的段落（标题、结尾残句）不参与去重
+
+_EMPTY_BIN = 1 << 32
+_HASH_MULTIPLIER = 0x9E3779B1  # 打散 CRC32 的线性规律
+
+# 词：连续的字母数字，汉字按单字计
+WORD_RE = re.compile(r"[\u4e00-\u9fff]|[^\W\u4e00-\u9fff]+")
+
+
+def words(text):
+    return WORD_RE.findall(text.lower())
+
+
+def _stable_hash(text):
+    return zlib.crc32(text.encode("utf-8")) * _HASH_MULTIPLIER & 0xFFFFFFFF
+
+
+def split_passages(text):
+    """把文本切分为段落（首尾相接，''.join(段落) == text），段落在下一个词之前切开"""
+    passages = []
+    window = deque(maxlen=SHINGLE_WORDS)
+    start = word_count = 0
+    boundary = False
+    for match in WORD_RE.finditer(text):
+        if boundary:
+            passages.append(text[start:match.start()])
+            start, word_count, boundary = match.start(), 0, False
+        window.append(match.group().lower())
+        word_count += 1
+        boundary = word_count >= MAX_PASSAGE_WORDS or (
+            word_count >= MIN_PASSAGE_WORDS
+            and _stable_hash(" ".join(window)) % PASSAGE_BOUNDARY_MODULUS == 0)
+    if start < len(text):
+        passages.append(text[start:])
+    return passages
+
+
+def shingles(text):
+    """段落的 shingle 哈希（连续 SHINGLE_WORDS 个词），按值排序的 uint32 数组"""
+    tokens = words(text)
+    return array("I", sorted({
+        _stable_hash(" ".join(tokens[i:i + SHINGLE_WORDS]))
+        for i in range(len(tokens) - SHINGLE_WORDS + 1)
+    }))
+
+
+def minhash(shingle_hashes):
+    """MinHash 签名：按哈希的低位分桶，每桶取高位的最小值（一次遍历，不需要多个哈希函数）"""
+    signature = [_EMPTY_BIN] * MINHASH_BINS
+    for value in shingle_hashes:
+        bin_index, rank = value % MINHASH_BINS, value // MINHASH_BINS
+        if rank < signature[bin_index]:
+            signature[bin_index] = rank
+    if _EMPTY_BIN not in signature or min(signature) == _EMPTY_BIN:
+        return signature
+    # 短段落会有空桶：借用其后第一个非空桶的值（加上距离以示区别），空桶不再互相误配
+    original = signature[:]
+    for bin_index, rank in enumerate(original):
+        step = 0
+        while rank == _EMPTY_BIN:
+            step += 1
+            rank = original[(bin_index + step) % MINHASH_BINS]
+        signature[bin_index] = rank + step * _EMPTY_BIN
+    return signature
+
+
+def jaccard(a, b):
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class PassageIndex:
+    """近重复段落的 LSH 索引：签名相同的段为候选，再用精确的 Jaccard 相似度确认"""
+
+    def __init__(self, threshold=DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self._buckets = defaultdict(list)  # (段号, 段内签名) -> 段落编号
+        self._shingles = []
+        self._payloads = []
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def _bands(self, signature):
+        rows = MINHASH_BINS // LSH_BANDS
+        return [(band, tuple(signature[band * rows:(band + 1) * rows]))
+                for band in range(LSH_BANDS)]
+
+    def match(self, shingle_hashes, payload, exclude=None):
+        """查找已加入的近重复段落并返回其 payload；没有时加入本段落并返回 None
+
+        exclude(payload) 为真的候选不算重复（例如同一专家自己的段落）
+        """
+        if len(shingle_hashes) < MIN_SHINGLES:
+            return None
+        bands = self._bands(minhash(shingle_hashes))
+        checked = set()
+        for key in bands:
+            for index in self._buckets.get(key, ()):
+                if index in checked:
+                    continue
+                checked.add(index)
+                candidate = self._payloads[index]
+                if exclude is not None and exclude(candidate):
+                    continue
+                if jaccard(shingle_hashes, self._shingles[index]) >= self.threshold:
+                    return candidate
+
+        index = len(self._payloads)
+        self._shingles.append(shingle_hashes)
+        self._payloads.append(payload)
+        for key in bands:
+            self._buckets[key].append(index)
+        return None
+
+
+def dedupe_passages(passages):
+    """去掉近重复的段落（保留第一次出现的），返回 (保留的段落, 被去掉的段落编号)"""
+    index = PassageIndex()
+    kept, removed = [], []
+    for position, passage in enumerate(passages):
+        if index.match(shingles(passage), position) is not None:
+            removed.append(position)
+        else:
+            kept.append(passage)
+    if removed:
+        logger.debug(f"去掉近重复段落 {len(removed)} / {len(passages)}")
+    return kept, removed
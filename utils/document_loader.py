@@ -1,12 +1,19 @@
 import os
-import PyPDF2
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
 from .expert import ExpertAgent
+from .knowledge_store import ExpertKnowledge
+from .knowledge_store import get_encoding, truncation_cache
+from .text_normalizer import normalize_pages, normalize_text
+from .dedup import PassageIndex, dedupe_passages, shingles, split_passages
+from .knowledge_bundle import DEFAULT_BUNDLE_DIR, SHARED_BUNDLE_NAME, BundleError, \
+    bundle_path, content_version, open_bundle, open_shared_bundle, shared_version, \
+    source_manifest, write_bundle
+from .avatar import load_avatar_data_uri, make_avatar_thumbnail
+from .settings import get_setting
+from array import array
+from types import MappingProxyType
 import logging
+import threading
 import base64
-import requests
 from io import BytesIO
 import streamlit as st
 
@@ -17,9 +24,19 @@ logger = logging.getLogger(__name__)
 # 检查是否在 Streamlit Cloud 环境运行
 IS_CLOUD = st.secrets.get("DEPLOY_ENV") == "cloud"
 
+# 作为专家知识库读取的文档类型
+KNOWLEDGE_EXTENSIONS = ('.pdf', '.epub')
+
+# 解析器版本：read_pdf / read_epub、段落切分或去重的输出变化时加 1，所有专家随之重建
+PARSER_VERSION = 3
+
+# 没有 head.png 时使用的空白头像
+DEFAULT_AVATAR = "data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg'/>"
+
 
 def download_file(url):
     """从 Dropbox 下载文件"""
+    import requests
     try:
         # 构建正确的 Dropbox 下载链接
         base_url = url.split('?')[0]  # 移除所有参数
@@ -44,55 +61,82 @@ def get_expert_folders():
         return None
 
 
-def read_pdf(file_path):
-    """读取 PDF 文件内容"""
+def read_pdf_pages(file_path):
+    """读取 PDF 各页的原始文本"""
+    # 解析库较重，只在真正解析文档时才导入
+    import PyPDF2
     try:
-        if IS_CLOUD:
+        if IS_CLOUD or not isinstance(file_path, (str, os.PathLike)):
             # file_path 已经是 BytesIO 对象
             if not file_path:
-                return ''
+                return []
             reader = PyPDF2.PdfReader(file_path)
         else:
             with open(file_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
+                reader = PyPDF2.PdfReader(BytesIO(file.read()))
 
-        text = ''
-        for page in reader.pages:
-            text += page.extract_text() + '\n'
-        return text
+        return [page.extract_text() for page in reader.pages]
     except Exception as e:
         logger.error(f"读取 PDF 文件出错: {str(e)}")
-        return ''
+        return []
 
 
-def read_epub(file_path):
-    """读取 EPUB 文件内容"""
+def read_epub_pages(file_path):
+    """读取 EPUB 各章节的原始文本"""
+    import ebooklib
+    from ebooklib import epub
+    from bs4 import BeautifulSoup
     try:
         book = epub.read_epub(file_path)
-        text = ''
+        pages = []
         for item in book.get_items():
             if item.get_type() == ebooklib.ITEM_DOCUMENT:
                 soup = BeautifulSoup(item.get_content(), 'html.parser')
-                text += soup.get_text() + '\n'
-        return text
+                pages.append(soup.get_text())
+        return pages
     except Exception as e:
         logger.error(f"读取 EPUB 文件出错 {file_path}: {str(e)}")
-        return ''
+        return []
+
 
+def read_pdf(file_path):
+    """读取 PDF 文件内容（去掉页眉页脚、合并断词并压缩空白）"""
+    return normalize_pages(read_pdf_pages(file_path))
+
+
+def read_epub(file_path):
+    """读取 EPUB 文件内容（合并断词并压缩空白）"""
+    return normalize_text('\n'.join(read_epub_pages(file_path)))
 
-def load_document(file_path):
-    """加载单个文档"""
+
+def load_document(file_path, report=None):
+    """加载单个文档
+
+    report 不为 None 时追加该文档规范化前后的 token 数
+    """
     file_extension = os.path.splitext(file_path)[1].lower()
     if file_extension == '.pdf':
         with open(file_path, 'rb') as f:
-            return read_pdf(BytesIO(f.read()))
+            pages = read_pdf_pages(BytesIO(f.read()))
+        text = normalize_pages(pages)
     elif file_extension == '.epub':
         with open(file_path, 'rb') as f:
-            return read_epub(BytesIO(f.read()))
+            pages = read_epub_pages(BytesIO(f.read()))
+        text = normalize_text('\n'.join(pages))
     else:
         logger.warning(f"不支持的文件格式: {file_path}")
         return ''
 
+    if report is not None:
+        encoding = get_encoding()
+        tokens_before = len(encoding.encode('\n'.join(pages)))
+        tokens_after = len(encoding.encode(text))
+        report.append({"file": os.path.basename(file_path),
+                       "tokens_before": tokens_before,
+                       "tokens_after": tokens_after})
+        logger.info(f"规范化 {file_path}: {tokens_before} -> {tokens_after} tokens")
+    return text
+
 
 def load_image_as_base64(image_path):
     """加载图片并转换为 base64"""
@@ -105,11 +149,192 @@ def load_image_as_base64(image_path):
         return None
 
 
-def load_experts():
+def load_expert_passages(expert_path, report=None):
+    """读取专家文件夹中的所有文档，切分为段落并去掉近重复的段落
+
+    同一本书的 PDF 和 EPUB 版本等重复内容只保留第一次出现的（按文件名顺序）。
+    report 见 load_document，每行另外记录该文档被去掉的重复 token 数
     """
-    从data目录加载专家数据
+    passages, rows = [], []
+    for file_name in sorted(os.listdir(expert_path)):
+        if os.path.splitext(file_name)[1].lower() not in KNOWLEDGE_EXTENSIONS:
+            continue
+        text = load_document(os.path.join(expert_path, file_name), report)
+        row = None
+        if report is not None:
+            row = report[-1]
+            row["duplicate_tokens"] = 0
+        if text:
+            document_passages = split_passages(text + '\n\n')
+            passages.extend(document_passages)
+            rows.extend([row] * len(document_passages))
+
+    kept, removed = dedupe_passages(passages)
+    if removed:
+        logger.info(f"{expert_path}: 去掉近重复段落 {len(removed)} / {len(passages)}")
+    if report is not None:
+        encoding = get_encoding()
+        for position in removed:
+            rows[position]["duplicate_tokens"] += len(encoding.encode(passages[position]))
+    return kept
+
+
+def expert_version(expert_path, bundle=None):
+    """专家资料的内容版本和源文件清单（沿用知识包中记录的哈希，避免重复读取未变化的文件）"""
+    manifest = source_manifest(expert_path, KNOWLEDGE_EXTENSIONS,
+                               previous=bundle.sources if bundle else None)
+    return content_version(manifest, PARSER_VERSION), manifest
+
+
+def parse_expert(expert_path, report=None):
+    """解析、去重并逐段编码专家资料（最慢的一步），返回 [(UTF-8 文本, token 数组), ...]
+
+    逐段编码使各段落的 token 首尾相接即为全文的 token，共享段落可以直接拼接
     """
-    experts = []
+    encoding = get_encoding()
+    return [(passage.encode('utf-8'), array("I", encoding.encode(passage)))
+            for passage in load_expert_passages(expert_path, report)]
+
+
+def write_expert_bundle(name, passages, version, expert_path, bundle_dir, manifest):
+    """把解析好的段落写入知识包（不引用共享段落库），并重新用 mmap 打开"""
+    avatar_path = os.path.join(expert_path, "head.png")
+    write_bundle(bundle_path(bundle_dir, name), name,
+                 [(text, tokens, None) for text, tokens in passages], version,
+                 avatar=make_avatar_thumbnail(avatar_path)
+                 if os.path.exists(avatar_path) else b"",
+                 sources=manifest)
+    return open_bundle(bundle_dir, name)
+
+
+def build_expert_bundle(name, expert_path, bundle_dir, force=False, report=None):
+    """构建专家的知识包；内容版本没有变化时跳过，返回 (知识包, 是否重建)
+
+    report 不为 None 时追加重建的每个文档规范化和去重前后的 token 数
+    """
+    bundle = open_bundle(bundle_dir, name)
+    version, manifest = expert_version(expert_path, bundle)
+    if bundle is not None and bundle.version == version and not force:
+        return bundle, False
+    passages = parse_expert(expert_path, report)
+    return write_expert_bundle(name, passages, version, expert_path, bundle_dir,
+                               manifest), True
+
+
+def share_expert_passages(names, bundle_dir, report=None):
+    """跨专家去重：多位专家共有的（近）重复段落只在共享段落库中保存一份，各专家的知识包引用它
+
+    第一次出现（按 names 的顺序）的段落作为共享的版本。只改变知识包的存储方式，
+    不改变专家的内容版本。返回重写了知识包的专家；report 不为 None 时追加每位专家
+    的段落数和引用的共享段落数、token 数
+    """
+    try:
+        shared = open_shared_bundle(bundle_dir)
+    except (BundleError, OSError, ValueError, KeyError) as e:
+        logger.warning(f"无法使用共享段落库，重新生成: {str(e)}")
+        shared = None
+    bundles = {}
+    for name in names:
+        bundles[name] = open_bundle(bundle_dir, name, shared=shared)
+        if bundles[name] is None:
+            raise BundleError(f"专家 {name} 的知识包不存在或无法使用，请先构建")
+
+    # 段落以 (专家名, 段落编号) 标识，只和其他专家的段落比较
+    index = PassageIndex()
+    layouts, matched = {}, set()
+    for name, bundle in bundles.items():
+        passages = bundle.passages()
+        matches = []
+        for position, (text, _) in enumerate(passages):
+            match = index.match(shingles(str(text, 'utf-8')), (name, position),
+                                exclude=lambda candidate: candidate[0] == name)
+            if match is not None:
+                matched.add(match)
+            matches.append(match)
+        layouts[name] = (passages, matches)
+
+    # 被其他专家的段落匹配到的段落进入共享段落库
+    shared_keys = sorted(matched, key=lambda key: (names.index(key[0]), key[1]))
+    store = [layouts[name][0][position] for name, position in shared_keys]
+    store_index = {key: i for i, key in enumerate(shared_keys)}
+    version = shared_version(store)
+    if not store:
+        shared = None
+    elif shared is None or shared.version != version:
+        write_bundle(bundle_path(bundle_dir, SHARED_BUNDLE_NAME), SHARED_BUNDLE_NAME,
+                     [(text, tokens, None) for text, tokens in store], version)
+        shared = open_shared_bundle(bundle_dir)
+
+    rewritten = []
+    for name, bundle in bundles.items():
+        passages, matches = layouts[name]
+        layout = []
+        for position, (text, tokens) in enumerate(passages):
+            key = matches[position] or (name, position)
+            if key in store_index:
+                text, tokens = store[store_index[key]]
+                layout.append((text, tokens, store_index[key]))
+            else:
+                layout.append((text, tokens, None))
+        references = [entry for entry in layout if entry[2] is not None]
+        if report is not None:
+            report.append({"expert": name, "passages": len(layout),
+                           "shared_passages": len(references),
+                           "shared_tokens": sum(len(tokens) for _, tokens, _ in references)})
+        if bundle.header["shared"] == (shared.version if references else None):
+            continue
+        write_bundle(bundle.path, name, layout, bundle.version,
+                     avatar=bundle.avatar_bytes(), sources=bundle.sources,
+                     shared=shared)
+        rewritten.append(name)
+
+    if not store and os.path.exists(bundle_path(bundle_dir, SHARED_BUNDLE_NAME)):
+        os.remove(bundle_path(bundle_dir, SHARED_BUNDLE_NAME))
+    logger.info(f"共享段落库：{len(store)} 个段落，重写知识包 {rewritten}")
+    return rewritten
+
+
+def load_expert_knowledge(name, expert_path, bundle_dir, current=None):
+    """加载单个专家的知识：版本未变时沿用 current，其次使用知识包，最后重新解析"""
+    bundle = open_bundle(bundle_dir, name)
+    version, manifest = expert_version(expert_path, bundle)
+    if current is not None and current.version == version:
+        return current
+    # 优先使用预编译的知识包（mmap 打开，不需要解析和编码）
+    if bundle is not None and bundle.version == version:
+        logger.info(f"从知识包加载专家 {name}（版本 {version}）")
+        return ExpertKnowledge.from_bundle(bundle, avatar=DEFAULT_AVATAR)
+
+    if bundle is not None:
+        logger.info(f"专家 {name} 的资料有变化（{bundle.version} -> {version}），重新构建")
+    passages = parse_expert(expert_path)
+    try:
+        # 写入知识包：之后启动的进程直接 mmap 打开，不再解析
+        bundle = write_expert_bundle(name, passages, version, expert_path, bundle_dir,
+                                     manifest)
+    except OSError as e:
+        logger.warning(f"写入专家 {name} 的知识包失败: {str(e)}")
+        bundle = None
+    if bundle is not None:
+        return ExpertKnowledge.from_bundle(bundle, avatar=DEFAULT_AVATAR)
+    avatar_path = os.path.join(expert_path, "head.png")
+    return ExpertKnowledge.from_passages(
+        name=name, passages=passages, version=version,
+        avatar=load_avatar_data_uri(avatar_path)
+        if os.path.exists(avatar_path) else DEFAULT_AVATAR)
+
+
+# 刷新资料期间可以沿用的知识（专家名 -> ExpertKnowledge），版本未变的专家不重新加载
+_reusable_knowledge = {}
+_refresh_lock = threading.Lock()
+
+
+@st.cache_resource
+def load_knowledge_store():
+    """
+    从data目录加载所有专家的只读知识，每个进程只加载一次，所有会话共享
+    """
+    store = {}
     try:
         # 从data目录读取所有专家文件夹
         data_dir = "./data"
@@ -117,30 +342,68 @@ def load_experts():
             expert_folders = [f for f in os.listdir(
                 data_dir) if os.path.isdir(os.path.join(data_dir, f))]
 
+            bundle_dir = get_setting("KNOWLEDGE_BUNDLE_DIR", DEFAULT_BUNDLE_DIR)
             for folder in expert_folders:
-                expert_path = os.path.join(data_dir, folder)
-                # 尝试加载头像
-                avatar_path = os.path.join(expert_path, "head.png")
-                if os.path.exists(avatar_path):
-                    avatar = load_image_as_base64(avatar_path)
-                else:
-                    avatar = f"data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg'/>"
-
-                # 读取专家信息
+                # 读取专家资料
                 try:
-                    expert = ExpertAgent(
-                        name=folder,
-                        knowledge_base=expert_path,
-                        avatar=avatar
-                    )
-                    experts.append(expert)
+                    store[folder] = load_expert_knowledge(
+                        folder, os.path.join(data_dir, folder), bundle_dir,
+                        current=_reusable_knowledge.get(folder))
+                    logger.info(f"加载专家 {folder} 的知识库："
+                                f"{store[folder].token_count} tokens")
                 except Exception as e:
                     logger.error(f"加载专家 {folder} 时出错: {str(e)}")
                     continue
     except Exception as e:
         logger.error(f"加载专家数据时出错: {str(e)}")
 
-    return experts
+    return MappingProxyType(store)
+
+
+def refresh_knowledge_store():
+    """资料更新后重新加载：只重建内容版本变化的专家，并清除它们的截断缓存
+
+    返回 {专家名: "added" / "changed" / "removed"}
+    """
+    with _refresh_lock:
+        previous = dict(load_knowledge_store())
+        _reusable_knowledge.update(previous)
+        try:
+            load_knowledge_store.clear()
+            store = load_knowledge_store()
+        finally:
+            _reusable_knowledge.clear()
+
+    changes = {}
+    for name in previous.keys() | store.keys():
+        old, new = previous.get(name), store.get(name)
+        if old is new:
+            continue
+        changes[name] = "added" if old is None else "removed" if new is None else "changed"
+    discarded = truncation_cache.discard(
+        [previous[name] for name in changes if name in previous])
+    logger.info(f"刷新专家资料：{len(changes)} 位专家有变化 {changes}，"
+                f"清除 {discarded} 条截断缓存")
+    return changes
+
+
+def sync_expert_knowledge(experts):
+    """让会话中的专家引用最新的知识（资料刷新后调用，版本未变的专家不受影响）"""
+    store = load_knowledge_store()
+    for expert in experts:
+        knowledge = store.get(expert.name)
+        if knowledge is not None and knowledge is not expert.knowledge:
+            expert.replace_knowledge(knowledge)
+
+
+def load_experts():
+    """
+    为当前会话创建专家代理，知识内容引用共享的知识库
+    """
+    return [
+        ExpertAgent(name=name, knowledge_base=knowledge)
+        for name, knowledge in load_knowledge_store().items()
+    ]
 
 
 def get_file_type(file_path):
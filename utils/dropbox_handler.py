@@ -1,5 +1,4 @@
 import os
-import requests
 import zipfile
 from pathlib import Path
 
@@ -12,6 +11,8 @@ def download_and_extract_dropbox(url, extract_path="./data"):
         url (str): Dropbox分享链接
         extract_path (str): 解压目标路径
     """
+    import requests
+
     # 确保URL是直接下载链接
     if "dl=0" in url:
         url = url.replace("dl=0", "dl=1")
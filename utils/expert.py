@@ -1,14 +1,11 @@
-from utils.quota import check_quota, use_quota, get_quota_display  # 使用新的函数名
-from openai import OpenAI
-from openai import APIError, APIConnectionError, RateLimitError, APITimeoutError
-from openai import AsyncOpenAI  # 改用异步客户端
+from utils.quota import check_quota, use_quota, get_quota_display, record_token_usage, \
+    settle_token_usage  # 使用新的函数名
 import logging
 import time
-import tiktoken
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import threading
 import streamlit as st
-import backoff  # 添加到导入列表
 from datetime import datetime, timedelta
 import sys
 import os
@@ -16,9 +13,23 @@ from tenacity import (
     retry,
     stop_after_attempt,
     wait_exponential,
+    retry_if_exception,
     retry_if_exception_type
 )
 import random
+import json
+from .admission import admission_ticket
+from .usage_ledger import get_usage_ledger
+from .tracing import trace_span, current_span, record_retry
+from .profiling import profiled_async_iter
+from .settings import get_setting, is_enabled
+from .knowledge_store import (
+    ExpertKnowledge,
+    SNIPPET_CHUNK_TOKENS,
+    get_encoding,
+    truncate_tokens
+)
+import re
 
 # 添加项目根目录到 Python 路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -30,19 +41,78 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-# X-AI API 配置
-client = AsyncOpenAI(  # 改用异步客户端
-    api_key=st.secrets.get("XAI_API_KEY", ""),
-    base_url=st.secrets.get("XAI_API_BASE", "https://api.x.ai/v1")
-)
+async def _on_request(request):
+    current_span().add("http.attempts")
+
+
+async def _on_response(response):
+    # 收到响应头时触发：记录首字节时间
+    current_span().set_attribute("http.ttfb_ms", current_span().elapsed_ms())
+
+
+# X-AI API 客户端（openai 导入较慢，首次调用时才创建）
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """获取进程内共享的 Grok 异步客户端"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+                from .cassette import get_cassette_transport
+                _client = AsyncOpenAI(  # 改用异步客户端
+                    api_key=get_setting("XAI_API_KEY", ""),
+                    base_url=get_setting("XAI_API_BASE", "https://api.x.ai/v1"),
+                    http_client=DefaultAsyncHttpxClient(
+                        transport=get_cassette_transport(),
+                        event_hooks={"request": [_on_request],
+                                     "response": [_on_response]})
+                )
+    return _client
+
+
+def _warm_up():
+    start_time = time.perf_counter()
+    try:
+        get_encoding()
+        import openai  # noqa: F401  首次 Grok 请求时就不用再等导入
+    except Exception as e:
+        logger.warning(f"后台预热失败: {str(e)}")
+        return
+    logger.info(f"后台预热完成，耗时 {time.perf_counter() - start_time:.2f}秒")
 
-# 创建线程池
-executor = ThreadPoolExecutor(max_workers=10)
 
-# 获取 token 计数器
-encoding = tiktoken.get_encoding("cl100k_base")  # GPT-4 使用的编码器
+@st.cache_resource
+def start_warmup():
+    """在后台线程加载编码表和 openai（每个进程一次），不阻塞首次页面渲染"""
+    if not is_enabled("BACKGROUND_WARMUP", True):
+        return None
+    thread = threading.Thread(target=_warm_up, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_retryable_error(exception):
+    """连接错误、超时和限流可以重试"""
+    if "openai" not in sys.modules:
+        return False  # 还没有发出过 Grok 请求，不可能是 openai 的异常
+    from openai import APIConnectionError, APITimeoutError, RateLimitError
+    return isinstance(exception,
+                      (APIConnectionError, APITimeoutError, RateLimitError))
+
 
 MAX_TOKENS = 131072  # Grok 最大 token 限制
+GEMINI_MODELS = ["gemini-2.0-flash-exp", "gemini-1.5-flash"]
+
+# 批量模式配置
+DEFAULT_BATCH_SIZE = 4  # 每个请求包含的专家数量
+BATCH_SNIPPET_TOKENS = 6000  # 每位专家的知识片段预算
+BATCH_TOKENS_PER_EXPERT = 1500  # 每位专家回答的输出 token 预算
+BATCH_MAX_OUTPUT_TOKENS = 8192
+BATCH_MISSING_ATTEMPTS = 2  # 批量回复缺少某些专家时，只为这些专家重新请求的总次数
 SYSTEM_PROMPT_TEMPLATE = """你是著名的投资专家 {name}。
 以下是你的投资理念和知识库内容。请始终基于这些内容来回答问题，确保每个回答都体现出你独特的投资思维和方法论：
 
@@ -65,37 +135,10 @@ SYSTEM_PROMPT_TEMPLATE = """你是著名的投资专家 {name}。
 
 def truncate_text(text, max_tokens):
     """截断文本以确保不超过最大 token 限制"""
-    tokens = encoding.encode(text)
+    tokens = get_encoding().encode(text)
     if len(tokens) <= max_tokens:
         return text
-
-    # 计算需要保留的中间部分的 token 数量
-    middle_tokens = max_tokens
-
-    # 计算开始和结束的位置
-    total_tokens = len(tokens)
-    remove_tokens = total_tokens - middle_tokens
-
-    # 前面保留更多内容（70%），后面少一些（30%）
-    remove_front = int(remove_tokens * 0.3)
-    remove_back = remove_tokens - remove_front
-
-    # 保留中间部分的 tokens
-    start_idx = remove_front
-    end_idx = total_tokens - remove_back
-
-    # 记录截断信息
-    logger.info(f"文本被截断：总tokens={total_tokens}, "
-                f"保留tokens={middle_tokens}, "
-                f"前面删除={remove_front}, "
-                f"后面删除={remove_back}")
-
-    # 返回截断后的文本
-    return (
-        f"...[前面已省略 {remove_front} tokens]...\n\n" +
-        encoding.decode(tokens[start_idx:end_idx]) +
-        f"\n\n...[后面已省略 {remove_back} tokens]..."
-    )
+    return truncate_tokens(tokens, max_tokens)
 
 
 logger = logging.getLogger(__name__)
@@ -131,28 +174,54 @@ rate_limiter = RateLimiter(requests_per_second=1)
 
 
 class ExpertAgent:
+    """专家代理：只保存会话相关的轻量状态，知识内容引用共享的 ExpertKnowledge"""
+
     def __init__(self, name, knowledge_base, avatar=None):
+        if not isinstance(knowledge_base, ExpertKnowledge):
+            knowledge_base = ExpertKnowledge.from_text(
+                name, knowledge_base, avatar)
         self.name = name
-        self.original_knowledge = knowledge_base  # 保存原始知识库
-        self.avatar = avatar or "🤖"
+        self.knowledge = knowledge_base  # 共享的只读知识，不在会话中复制
+        self.avatar = avatar or knowledge_base.avatar or "🤖"
         self.chat_history = []  # 保存对话历史
         self.max_history = 5  # 保存最近的5轮对话
         self.history_tokens = 0  # 追踪历史对话使用的 tokens
 
         # 计算系统提示的基本 token 数量（不包含知识库内容）
         base_prompt = SYSTEM_PROMPT_TEMPLATE.format(name=name, knowledge="")
-        base_tokens = len(encoding.encode(base_prompt))
+        base_tokens = len(get_encoding().encode(base_prompt))
 
         # 计算每轮对话预留的 token 数（包括问题和回答）
         self.tokens_per_turn = 2000
 
         # 为知识库内容预留的最大 token 数
         self.base_tokens = base_tokens
+        self.knowledge_tokens = 0
+        self.adjust_knowledge_base()
+
+    def replace_knowledge(self, knowledge):
+        """资料刷新后换用新版本的知识，保留对话历史"""
+        logger.info(f"专家 {self.name} 的知识更新为版本 {knowledge.version}")
+        self.knowledge = knowledge
+        if knowledge.avatar:
+            self.avatar = knowledge.avatar
         self.adjust_knowledge_base()
 
+    @property
+    def original_knowledge(self):
+        """原始知识库文本"""
+        return self.knowledge.text
+
+    @property
+    def knowledge_base(self):
+        """按当前预算截断后的知识库（截断结果在会话间共享）"""
+        with trace_span("knowledge.truncate", expert=self.name,
+                        budget=self.knowledge_tokens):
+            return self.knowledge.truncated(self.knowledge_tokens)
+
     def count_tokens(self, text):
         """计算文本的 token 数量"""
-        return len(encoding.encode(text))
+        return len(get_encoding().encode(text))
 
     def adjust_knowledge_base(self):
         """根据对话历史动态调整知识库大小"""
@@ -165,9 +234,8 @@ class ExpertAgent:
             80000, available_tokens)  # 提高最小保留量到80k tokens
         max_knowledge_tokens = max(min_knowledge_tokens, available_tokens)
 
-        # 截断知识库内容
-        self.knowledge_base = truncate_text(
-            self.original_knowledge, max_knowledge_tokens)
+        # 只记录预算，截断文本在使用时从共享缓存获取
+        self.knowledge_tokens = max_knowledge_tokens
 
         # 记录调整信息
         logger.info(f"知识库调整：历史tokens={self.history_tokens}, "
@@ -204,72 +272,387 @@ class ExpertAgent:
 
         self.adjust_knowledge_base()  # 重新调整知识库大小
 
+    def get_knowledge_snippets(self, query, max_tokens=BATCH_SNIPPET_TOKENS):
+        """根据问题检索与之最相关的知识片段，总量不超过 max_tokens"""
+        chunks = self.knowledge.chunks
+        max_chunks = max(1, max_tokens // SNIPPET_CHUNK_TOKENS)
+        if len(chunks) <= max_chunks:
+            return "\n\n".join(chunks)
+
+        # 按问题关键词的命中次数为片段打分，同分时保留靠前的片段
+        terms = extract_terms(query)
+        scores = [
+            (sum(chunk.lower().count(term) for term in terms), -idx)
+            for idx, chunk in enumerate(chunks)
+        ]
+        ranked = sorted(range(len(chunks)), key=lambda i: scores[i],
+                        reverse=True)
+        selected = sorted(ranked[:max_chunks])  # 恢复原文顺序
+
+        logger.info(f"{self.name} 检索知识片段：关键词={len(terms)}, "
+                    f"选中 {len(selected)}/{len(chunks)} 个片段")
+        return "\n\n...\n\n".join(chunks[i] for i in selected)
+
     # 修改装饰器
     @retry(
-        retry=retry_if_exception_type(
-            (APIConnectionError, APITimeoutError, RateLimitError)),
+        retry=retry_if_exception(is_retryable_error),
         wait=wait_exponential(multiplier=1, min=1, max=10),
-        stop=stop_after_attempt(3)
+        stop=stop_after_attempt(3),
+        before_sleep=record_retry
     )
     async def get_response(self, prompt):
         """获取专家回应"""
         try:
             logger.info(f"开始处理专家 {self.name} 的回应")
 
-            # 安全地获取当前模型
-            current_model = getattr(
-                st.session_state, 'current_model', 'grok-beta')
+            current_model = get_current_model()
 
-            if current_model in ["gemini-2.0-flash-exp", "gemini-1.5-flash"]:
-                from .gemini_handler import generate_gemini_response
-                expert_prompt = f"你现在扮演 {self.name}。请基于以下投资理念回答问题：\n\n{self.knowledge_base}\n\n问题：{prompt}"
+            if current_model in GEMINI_MODELS:
+                with trace_span("prompt.build", expert=self.name):
+                    expert_prompt = f"你现在扮演 {self.name}。请基于以下投资理念回答问题：\n\n{self.knowledge_base}\n\n问题：{prompt}"
                 logger.info(
                     f"发送到 {current_model} 的提示词: {expert_prompt[:200]}...")
+                answer = await call_model(
+                    current_model, expert_prompt, expert_name=self.name)
+            else:
+                with trace_span("prompt.build", expert=self.name):
+                    system_prompt = self.get_system_prompt()
+                answer = await call_model(
+                    current_model, prompt, system_prompt=system_prompt,
+                    expert_name=self.name)
 
-                try:
-                    # 获取当前事件循环
-                    current_loop = asyncio.get_running_loop()
-                except RuntimeError:
-                    # 如果没有事件循环，创建一个新的
-                    current_loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(current_loop)
+            self.update_chat_history(prompt, answer)
+            return answer
+
+        except Exception as e:
+            logger.error(f"{self.name} 处理失败: {str(e)}")
+            raise
+
+    @retry(
+        retry=retry_if_exception(is_retryable_error),
+        wait=wait_exponential(multiplier=1, min=1, max=10),
+        stop=stop_after_attempt(3),
+        before_sleep=record_retry
+    )
+    async def get_followup_response(self, question):
+        """单独追问该专家：带上自己的对话历史作为上下文"""
+        try:
+            logger.info(f"开始处理对专家 {self.name} 的追问，"
+                        f"历史对话 {len(self.chat_history)} 轮")
+
+            current_model = get_current_model()
+
+            with trace_span("prompt.build", expert=self.name):
+                if current_model in GEMINI_MODELS:
+                    system_prompt = f"你现在扮演 {self.name}。请基于以下投资理念回答问题：\n\n{self.knowledge_base}"
+                else:
+                    system_prompt = self.get_system_prompt()
+            answer = await call_model(
+                current_model, question, system_prompt=system_prompt,
+                history=self.chat_history, expert_name=self.name,
+                kind="followup")
+
+            self.update_chat_history(question, answer)
+            return answer
+
+        except Exception as e:
+            logger.error(f"{self.name} 追问处理失败: {str(e)}")
+            raise
 
+
+def get_current_model():
+    """安全地获取当前模型"""
+    return getattr(st.session_state, 'current_model', 'grok-beta')
+
+
+async def call_model(model_name, prompt, system_prompt=None, max_tokens=1000,
+                     history=None, expert_name=None, kind="expert"):
+    """调用指定模型生成回复（Gemini 走 REST 接口，其余走 Grok）
+
+    history 为 [(问题, 回答), ...]，作为多轮对话上下文发送
+    expert_name 和 kind 用于用量账本的统计
+    """
+    history = history or []
+
+    if model_name in GEMINI_MODELS:
+        if history:
+            turns = "\n\n".join(f"问：{q}\n答：{a}" for q, a in history)
+            prompt = f"此前的对话：\n\n{turns}\n\n现在的追问：{prompt}"
+        if system_prompt:
+            prompt = f"{system_prompt}\n\n{prompt}"
+        prompt_texts = [prompt]
+    else:
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        for question, answer in history:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        messages.append({"role": "user", "content": prompt})
+        prompt_texts = [message["content"] for message in messages]
+
+    with trace_span("llm.call", model=model_name, kind=kind,
+                    expert=expert_name or "") as call_span:
+        # 发送前预估 tokens：输入按实际编码计算，输出按上限计算
+        estimated_prompt_tokens = sum(len(get_encoding().encode(text))
+                                      for text in prompt_texts)
+        estimated_tokens = estimated_prompt_tokens + max_tokens
+        call_span.set_attribute("tokens.estimated", estimated_tokens)
+
+        # 排队模式下，每个请求发出前先领取一个配额和 token 预算
+        # 请求数记在票据的模型上，tokens 记在实际调用的模型上
+        ticket = admission_ticket.get()
+        reservation = None
+        if ticket is not None:
+            with trace_span("quota.wait", model=ticket.model_name):
+                reservation = await ticket.acquire(tokens=estimated_tokens,
+                                                   token_model=model_name)
+
+        usage = None
+        success = False
+        start_time = time.perf_counter()
+        try:
+            if model_name in GEMINI_MODELS:
+                from .gemini_handler import generate_gemini_content
                 try:
-                    answer = await current_loop.run_in_executor(
-                        None,
-                        lambda: generate_gemini_response(
-                            expert_prompt, current_model)
-                    )
+                    current_loop = asyncio.get_running_loop()
+                    with trace_span("llm.upstream", model=model_name):
+                        # 复制上下文，让线程池中的请求也挂在当前 span 下
+                        context = contextvars.copy_context()
+                        answer, usage = await current_loop.run_in_executor(
+                            None,
+                            lambda: context.run(
+                                generate_gemini_content,
+                                prompt, model_name, max_tokens=max_tokens)
+                        )
                 except Exception as e:
                     logger.error(f"Gemini API 调用失败: {str(e)}")
                     raise
             else:
                 try:
                     # 等待速率限制（只对 Grok 应用）
-                    await rate_limiter.acquire()
-
-                    # 直接调用 API，不使用 create_task
-                    response = await client.chat.completions.create(
-                        model="grok-beta",
-                        messages=[
-                            {"role": "system", "content": self.get_system_prompt()},
-                            {"role": "user", "content": prompt}
-                        ],
-                        temperature=0.7
-                    )
+                    with trace_span("ratelimit.wait"):
+                        await rate_limiter.acquire()
+
+                    # Grok 的输出不设上限，max_tokens 只用于预估 token 预算
+                    with trace_span("llm.upstream", model=model_name):
+                        response = await get_client().chat.completions.create(
+                            model="grok-beta",
+                            messages=messages,
+                            temperature=0.7
+                        )
                     answer = response.choices[0].message.content
+                    if response.usage:
+                        usage = {
+                            "prompt_tokens": response.usage.prompt_tokens,
+                            "completion_tokens": response.usage.completion_tokens
+                        }
                 except Exception as e:
                     logger.error(f"Grok API 调用失败: {str(e)}")
                     raise
+            success = True
+        finally:
+            latency_ms = (time.perf_counter() - start_time) * 1000
+            # 用 API 返回的实际用量修正预估；失败的请求按预估计入
+            if usage:
+                actual_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+                call_span.set_attribute("tokens.actual", actual_tokens)
+            else:
+                actual_tokens = estimated_tokens
+            if reservation is not None:
+                settle_token_usage(reservation, actual_tokens)
+            else:
+                record_token_usage(model_name, actual_tokens)
+            logger.info(f"{model_name} token 用量: 预估 {estimated_tokens}, "
+                        f"实际 {actual_tokens if usage else '未知'}")
 
-            self.update_chat_history(prompt, answer)
-            return answer
+            try:
+                get_usage_ledger().record(
+                    model_name, kind, estimated_prompt_tokens, latency_ms,
+                    usage=usage, session_id=st.session_state.get("session_id"),
+                    expert=expert_name, success=success)
+            except Exception as e:
+                logger.error(f"记录用量失败: {str(e)}")
+
+    return answer
+
+
+def find_mentioned_expert(text, experts):
+    """解析 "@专家名 问题" 形式的追问，返回 (专家, 问题)；未提及时返回 (None, text)"""
+    stripped = text.lstrip()
+    if not stripped.startswith("@"):
+        return None, text
+
+    body = stripped[1:]
+    # 优先匹配最长的名字，避免 "Charlie" 抢先匹配 "Charlie Munger"
+    for expert in sorted(experts, key=lambda e: len(e.name), reverse=True):
+        if body.lower().startswith(expert.name.lower()):
+            question = body[len(expert.name):].lstrip(" ：:,，")
+            return expert, question
+    return None, text
+
+
+async def get_followup_response_async(expert, question):
+    """追问模式：只请求一位专家，不生成总结"""
+    start_time = time.time()
+    try:
+        with trace_span("expert.response", expert=expert.name, kind="followup"):
+            response = await expert.get_followup_response(question)
+    except Exception as e:
+        logger.error(f"专家 {expert.name} 追问失败: {str(e)}")
+        response = f"抱歉，生成回应时出现错误: {str(e)}"
+    logger.info(f"专家 {expert.name} 追问完成，耗时: {time.time() - start_time:.2f}秒")
+    yield expert, response
+
+
+def extract_terms(text):
+    """提取检索用关键词：英文单词与中文双字词"""
+    text = text.lower()
+    terms = set(re.findall(r"[a-z0-9]{3,}", text))
+    for run in re.findall(r"[\u4e00-\u9fff]+", text):
+        terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def build_batch_prompt(experts, prompt):
+    """构建一次请求中包含多位专家的批量提示词"""
+    sections = []
+    with trace_span("prompt.build", experts=len(experts)):
+        for expert in experts:
+            sections.append(f"=== 大师：{expert.name} ===\n"
+                            f"{expert.get_knowledge_snippets(prompt)}")
+
+    names = "、".join(expert.name for expert in experts)
+    return f"""你将同时扮演以下几位投资大师：{names}。
+每位大师只能基于自己下面的资料片段，独立回答同一个问题，并保持各自独特的投资理念、思维方式和表达风格。
+
+{chr(10).join(sections)}
 
+问题：{prompt}
+
+请严格按照以下 JSON 格式输出，不要输出任何其他内容：
+{{"answers": [{{"name": "大师名字", "answer": "该大师的完整回答"}}]}}
+"""
+
+
+def normalize_expert_name(name):
+    """比较专家名时忽略大小写、空白和标点"""
+    return re.sub(r"[\W_]+", "", str(name).casefold())
+
+
+def parse_batch_response(text, experts):
+    """解析批量回复，返回 {专家名: 回答}
+
+    名字按忽略大小写、空白和标点的方式匹配；对不上的回答按其在列表中的位置对应专家
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError(f"批量回复不是有效的 JSON: {text[:200]}")
+    data = json.loads(text[start:end + 1])
+
+    by_name = {normalize_expert_name(e.name): e.name for e in experts}
+    answers = {}
+    unmatched = []
+    for position, item in enumerate(data.get("answers", [])):
+        if not isinstance(item, dict) or not item.get("answer"):
+            continue
+        name = by_name.get(normalize_expert_name(item.get("name", "")))
+        if name and name not in answers:
+            answers[name] = str(item["answer"])
+        else:
+            unmatched.append((position, str(item["answer"])))
+
+    for position, answer in unmatched:
+        if position < len(experts) and experts[position].name not in answers:
+            answers[experts[position].name] = answer
+    return answers
+
+
+@retry(
+    # 与单个专家的请求相同的重试策略；回复无法解析时也重新请求
+    retry=retry_if_exception(is_retryable_error) | retry_if_exception_type(ValueError),
+    wait=wait_exponential(multiplier=1, min=1, max=10),
+    stop=stop_after_attempt(3),
+    before_sleep=record_retry
+)
+async def request_batch(model_name, batch, prompt):
+    """发送一个批量请求并解析回复，返回 {专家名: 回答}"""
+    text = await call_model(
+        model_name, build_batch_prompt(batch, prompt),
+        max_tokens=min(BATCH_MAX_OUTPUT_TOKENS,
+                       BATCH_TOKENS_PER_EXPERT * len(batch)),
+        expert_name="、".join(expert.name for expert in batch),
+        kind="batch")
+    return parse_batch_response(text, batch)
+
+
+async def request_batch_answers(model_name, batch, prompt):
+    """请求一批专家的回答；回复中缺少的专家只为他们重新请求，返回 {专家名: 回答}"""
+    answers = {}
+    pending = batch
+    for _ in range(BATCH_MISSING_ATTEMPTS):
+        answers.update(await request_batch(model_name, pending, prompt))
+        pending = [expert for expert in pending if expert.name not in answers]
+        if not pending:
+            break
+        logger.warning(f"批量回复缺少专家: {[e.name for e in pending]}")
+    return answers
+
+
+@profiled_async_iter("get_batched_responses_async")
+async def get_batched_responses_async(experts, prompt, batch_size=DEFAULT_BATCH_SIZE):
+    """批量模式：每个请求包含 batch_size 位专家，按完成顺序逐个产出回应"""
+    start_time = time.time()
+    batches = [experts[i:i + batch_size]
+               for i in range(0, len(experts), batch_size)]
+    logger.info(f"批量模式：{len(experts)} 位专家分为 {len(batches)} 个请求")
+
+    current_model = get_current_model()
+
+    async def get_batch_response(batch):
+        try:
+            with trace_span("expert.response", experts=len(batch),
+                            kind="batch") as batch_span:
+                answers = await request_batch_answers(current_model, batch, prompt)
+                batch_span.set_attribute("answers", len(answers))
         except Exception as e:
-            logger.error(f"{self.name} 处理失败: {str(e)}")
-            raise
+            logger.error(f"批量请求处理失败: {str(e)}")
+            answers = {}
+            error = f"抱歉，生成回应时出现错误: {str(e)}"
+        else:
+            error = "抱歉，批量回复中没有该专家的回答。"
+
+        results = []
+        for expert in batch:
+            if expert.name in answers:
+                expert.update_chat_history(prompt, answers[expert.name])
+                results.append((expert, answers[expert.name]))
+            else:
+                results.append((expert, error))
+        return results
+
+    current_loop = asyncio.get_running_loop()
+    tasks = [current_loop.create_task(get_batch_response(batch))
+             for batch in batches]
+
+    responses = {}
+    for response_task in asyncio.as_completed(tasks):
+        for expert, response in await response_task:
+            responses[expert.name] = response
+            yield expert, response
+        logger.info(f"批量请求完成，耗时: {time.time() - start_time:.2f}秒")
+
+    # 生成总结
+    try:
+        summary = await generate_summary(
+            prompt, [responses[e.name] for e in experts], experts)
+        yield st.session_state.titans, summary
+    except Exception as e:
+        logger.error(f"生成总结时出错: {str(e)}")
+        yield st.session_state.titans, "抱歉，生成总结时出现错误。"
 
 
+@profiled_async_iter("get_responses_async")
 async def get_responses_async(experts, prompt):
     start_time = time.time()
     logger.info(f"开始并发处理所有专家回应，时间: {start_time}")
@@ -284,7 +667,8 @@ async def get_responses_async(experts, prompt):
 
     async def get_expert_response(expert):
         try:
-            response = await expert.get_response(prompt)
+            with trace_span("expert.response", expert=expert.name):
+                response = await expert.get_response(prompt)
             return expert, response, time.time()
         except Exception as e:
             logger.error(f"专家 {expert.name} 处理失败: {str(e)}")
@@ -350,6 +734,11 @@ async def get_responses_async(experts, prompt):
 
 async def generate_summary(prompt, responses, experts):
     """生成总结"""
+    with trace_span("summary", experts=len(experts)):
+        return await _generate_summary(prompt, responses, experts)
+
+
+async def _generate_summary(prompt, responses, experts):
     logger.info("开始生成总结...")
 
     # 动态构建专家回应列表
@@ -374,18 +763,16 @@ async def generate_summary(prompt, responses, experts):
     logger.info(f"生成总结的提示词: {summary_prompt[:200]}...")
 
     try:
-        # 使用异步 API 调用
-        summary_response = await client.chat.completions.create(
-            model="grok-beta",
-            messages=[{"role": "user", "content": summary_prompt}],
-            temperature=0.7
-        )
-        summary = summary_response.choices[0].message.content
-        return summary
+        # 总结固定使用 Grok
+        return await call_model("grok-beta", summary_prompt,
+                                expert_name="Investment Masters",
+                                kind="summary")
     except Exception as e:
         error_msg = "生成总结时出错"
         logger.error(error_msg)
         logger.exception(e)
         return "抱歉，无法生成总结。"
 
-__all__ = ['ExpertAgent', 'get_responses_async', 'generate_summary']
+__all__ = ['ExpertAgent', 'get_responses_async', 'get_batched_responses_async',
+           'get_followup_response_async', 'find_mentioned_expert',
+           'generate_summary', 'start_warmup', 'DEFAULT_BATCH_SIZE']
@@ -1,17 +1,38 @@
-import requests
 import logging
-import streamlit as st
+from .settings import get_setting
+from .tracing import current_span
 
 logger = logging.getLogger(__name__)
 
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+
+_http_session = None
+
+
+def get_http_session():
+    """Gemini 请求共用的 HTTP 会话（复用连接；开启录制 / 回放时经过 cassette）"""
+    global _http_session
+    if _http_session is None:
+        # cassette 依赖 requests 和 httpx，首次请求时才导入
+        from .cassette import create_http_session
+        _http_session = create_http_session()
+    return _http_session
+
 
 def generate_gemini_response(prompt, model_name, max_tokens=1000):
     """使用 Gemini API 生成回复"""
+    text, _ = generate_gemini_content(prompt, model_name, max_tokens)
+    return text
+
+
+def generate_gemini_content(prompt, model_name, max_tokens=1000):
+    """使用 Gemini API 生成回复，返回 (回复文本, token 用量)"""
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
+        base_url = get_setting("GEMINI_API_BASE", GEMINI_API_BASE)
+        url = f"{base_url}/models/{model_name}:generateContent"
         headers = {
             "Content-Type": "application/json",
-            "x-goog-api-key": st.secrets["GOOGLE_API_KEY"]
+            "x-goog-api-key": get_setting("GOOGLE_API_KEY", "")
         }
         data = {
             "contents": [{
@@ -25,14 +46,29 @@ def generate_gemini_response(prompt, model_name, max_tokens=1000):
             }
         }
 
-        response = requests.post(url, headers=headers, json=data)
+        response = get_http_session().post(url, headers=headers, json=data)
+        # elapsed 为发出请求到解析完响应头的时间，即首字节时间
+        current_span().set_attribute(
+            "http.ttfb_ms", response.elapsed.total_seconds() * 1000)
         response.raise_for_status()
         result = response.json()
 
         if 'candidates' in result:
-            return result['candidates'][0]['content']['parts'][0]['text']
+            text = result['candidates'][0]['content']['parts'][0]['text']
+            return text, parse_gemini_usage(result)
         else:
             raise Exception(f"API 错误: {result}")
     except Exception as e:
         logger.error(f"Gemini API 错误: {str(e)}")
         raise
+
+
+def parse_gemini_usage(result):
+    """从 Gemini 响应的 usageMetadata 中提取 token 用量"""
+    usage = result.get('usageMetadata')
+    if not usage:
+        return None
+    return {
+        "prompt_tokens": usage.get('promptTokenCount', 0),
+        "completion_tokens": usage.get('candidatesTokenCount', 0)
+    }
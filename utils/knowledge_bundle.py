@@ -0,0 +1,395 @@
+from array import array
+import base64
+from bisect import bisect_right
+from functools import lru_cache
+import hashlib
+from importlib import metadata
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from .avatar import AVATAR_FORMAT
+from .knowledge_store import ENCODING_NAME, SNIPPET_CHUNK_TOKENS, get_encoding
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 预编译知识包：每位专家一个文件，运行时用 mmap 打开，多个进程通过页缓存共享
+#
+#   | magic (8) | 格式版本 uint32 | 头部长度 uint32 | 头部 JSON | 各数据段（8 字节对齐）|
+#
+# 数据段：text（UTF-8 文本）、tokens（uint32 数组）、chunk_offsets（每个知识片段
+# 在全文中的起止字节偏移，uint64 数组）、passages（段落表）、avatar（头像缩略图）
+#
+# 段落表每行 5 个 uint64：(来源, token 起, token 止, 字节起, 字节止)。来源为 0 时
+# 段落保存在本知识包中，为 1 时引用共享段落库（多位专家共有的段落只保存一份）
+BUNDLE_MAGIC = b"KBUNDLE\0"
+BUNDLE_FORMAT_VERSION = 3
+BUNDLE_SUFFIX = ".kb"
+DEFAULT_BUNDLE_DIR = os.path.join(".cache", "knowledge")
+SHARED_BUNDLE_NAME = "_shared"  # 共享段落库，与专家知识包格式相同
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGNMENT = 8
+_ROW_SIZE = 5
+_OWN, _SHARED = 0, 1
+
+
+class BundleError(Exception):
+    """知识包损坏、版本不符或与当前环境不兼容"""
+
+
+def bundle_path(bundle_dir, name):
+    return os.path.join(bundle_dir, f"{name}{BUNDLE_SUFFIX}")
+
+
+def source_files(expert_path, extensions):
+    """参与构建的源文件（知识文档和头像），按文件名排序"""
+    return [
+        file_name for file_name in sorted(os.listdir(expert_path))
+        if os.path.splitext(file_name)[1].lower() in extensions
+        or file_name == "head.png"
+    ]
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_manifest(expert_path, extensions, previous=None):
+    """源文件清单 [{file, size, mtime_ns, sha256}, ...]
+
+    previous 为上次构建时记录的清单：文件大小和修改时间都没变时直接沿用其哈希，不重新读取
+    """
+    known = {(entry["file"], entry["size"], entry["mtime_ns"]): entry["sha256"]
+             for entry in previous or []}
+    manifest = []
+    for file_name in source_files(expert_path, extensions):
+        path = os.path.join(expert_path, file_name)
+        stat = os.stat(path)
+        sha256 = known.get((file_name, stat.st_size, stat.st_mtime_ns)) \
+            or file_sha256(path)
+        manifest.append({"file": file_name, "size": stat.st_size,
+                         "mtime_ns": stat.st_mtime_ns, "sha256": sha256})
+    return manifest
+
+
+@lru_cache(maxsize=None)
+def tokenizer_version():
+    try:
+        return metadata.version("tiktoken")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def content_version(manifest, parser_version):
+    """专家资料的内容版本：源文件内容哈希 + 解析器、编码器和切分参数
+
+    只比较内容，Dropbox 重新解压导致修改时间变化时版本不变
+    """
+    payload = {
+        "files": [[entry["file"], entry["sha256"]] for entry in manifest],
+        "parser": parser_version,
+        "encoding": ENCODING_NAME,
+        "tokenizer": tokenizer_version(),
+        "chunk_tokens": SNIPPET_CHUNK_TOKENS,
+    }
+    encoded = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def chunk_byte_offsets(tokens, chunk_tokens=SNIPPET_CHUNK_TOKENS):
+    """每个知识片段的起止字节偏移：片段按 chunk_tokens 个 token 切分"""
+    encoding = get_encoding()
+    offsets = array("Q", [0])
+    for i in range(0, len(tokens), chunk_tokens):
+        chunk = encoding.decode_bytes(tokens[i:i + chunk_tokens].tolist())
+        offsets.append(offsets[-1] + len(chunk))
+    return offsets
+
+
+def _token_array(tokens):
+    if isinstance(tokens, array):
+        return tokens
+    result = array("I")
+    if isinstance(tokens, memoryview):
+        result.frombytes(tokens.cast("B"))
+    else:
+        result.extend(tokens)
+    return result
+
+
+def shared_version(passages):
+    """共享段落库的版本：各段落内容的哈希"""
+    digest = hashlib.sha256()
+    for text, _ in passages:
+        digest.update(hashlib.sha256(bytes(text)).digest())
+    return digest.hexdigest()[:16]
+
+
+def write_bundle(path, name, passages, version, avatar=b"", sources=None,
+                 shared=None):
+    """写入知识包（先写临时文件再原子替换，运行中的进程不会读到半个文件）
+
+    passages 为 [(UTF-8 文本, token 数组, 共享段落编号), ...]，共享段落编号不为 None 的
+    段落引用共享段落库 shared 中的段落，只记录位置，不再保存文本和 token
+    """
+    text_parts, tokens, all_tokens = [], array("I"), array("I")
+    rows = array("Q")
+    text_length = total_length = 0
+    references = False
+    for text, passage_tokens, shared_index in passages:
+        passage_tokens = _token_array(passage_tokens)
+        all_tokens.extend(passage_tokens)
+        total_length += len(text)
+        if shared_index is None:
+            rows.extend((_OWN, len(tokens), len(tokens) + len(passage_tokens),
+                         text_length, text_length + len(text)))
+            tokens.extend(passage_tokens)
+            text_parts.append(text)
+            text_length += len(text)
+        else:
+            rows.extend((_SHARED, *shared.passage_span(shared_index)))
+            references = True
+    offsets = chunk_byte_offsets(all_tokens)
+    if offsets[-1] != total_length:
+        raise BundleError(f"{name} 的 token 无法还原出原文，不能生成片段偏移")
+
+    sections = [("text", b"".join(text_parts)), ("tokens", tokens.tobytes()),
+                ("chunk_offsets", offsets.tobytes()), ("passages", rows.tobytes()),
+                ("avatar", avatar)]
+    header = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "name": name,
+        "version": version,
+        "encoding": ENCODING_NAME,
+        "chunk_tokens": SNIPPET_CHUNK_TOKENS,
+        "byteorder": sys.byteorder,
+        "token_count": len(all_tokens),
+        "passage_count": len(rows) // _ROW_SIZE,
+        "shared": shared.version if references else None,
+        "avatar_format": AVATAR_FORMAT.lower() if avatar else None,
+        "sources": sources or [],
+        "built_at": time.time(),
+    }
+
+    # 头部中的段偏移依赖头部本身的长度，反复计算直到长度不再变化
+    header["sections"] = {key: [0, len(data)] for key, data in sections}
+    header_bytes = b""
+    while True:
+        position = _align(_PREAMBLE.size + len(header_bytes))
+        for key, data in sections:
+            header["sections"][key] = [position, len(data)]
+            position = _align(position + len(data))
+        encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        stable = len(encoded) == len(header_bytes)
+        header_bytes = encoded
+        if stable:
+            break
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp-{os.getpid()}"
+    with open(temp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(BUNDLE_MAGIC, BUNDLE_FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for key, data in sections:
+            f.write(b"\0" * (header["sections"][key][0] - f.tell()))
+            f.write(data)
+    os.replace(temp_path, path)
+    return header
+
+
+def _align(position):
+    return (position + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class TokenSegments:
+    """由多个 token 数组片段（分属各自映射的知识包）拼成的只读序列，切片时才复制"""
+
+    def __init__(self, segments):
+        self._segments = segments
+        self._starts = [0]
+        for segment in segments:
+            self._starts.append(self._starts[-1] + len(segment))
+
+    def __len__(self):
+        return self._starts[-1]
+
+    @property
+    def nbytes(self):
+        return sum(segment.nbytes for segment in self._segments)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("token 下标越界")
+            position = bisect_right(self._starts, index) - 1
+            return self._segments[position][index - self._starts[position]]
+        start, stop, step = index.indices(len(self))
+        result = array("I")
+        position = bisect_right(self._starts, start) - 1
+        while start < stop and position < len(self._segments):
+            offset = self._starts[position]
+            end = min(stop, self._starts[position + 1])
+            result.frombytes(
+                self._segments[position][start - offset:end - offset].cast("B"))
+            start = end
+            position += 1
+        return result[::step] if step != 1 else result
+
+
+class KnowledgeBundle:
+    """用 mmap 打开的知识包：token 数组和片段偏移直接引用映射的页，不复制"""
+
+    def __init__(self, path, shared=None):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _PREAMBLE.size:
+            raise BundleError(f"知识包文件不完整: {path}")
+        magic, version, header_length = _PREAMBLE.unpack_from(self._map)
+        if magic != BUNDLE_MAGIC:
+            raise BundleError(f"不是知识包文件: {path}")
+        if version != BUNDLE_FORMAT_VERSION:
+            raise BundleError(f"知识包格式版本 {version} 与当前版本 "
+                              f"{BUNDLE_FORMAT_VERSION} 不符: {path}")
+        self.header = json.loads(
+            self._map[_PREAMBLE.size:_PREAMBLE.size + header_length])
+        if self.header["byteorder"] != sys.byteorder:
+            raise BundleError(f"知识包的字节序与本机不同: {path}")
+        if self.header["encoding"] != ENCODING_NAME \
+                or self.header["chunk_tokens"] != SNIPPET_CHUNK_TOKENS:
+            raise BundleError(f"知识包的编码器或片段大小与当前配置不符: {path}")
+        self.shared = None
+        if self.header["shared"] is not None:
+            # 引用了共享段落库：与本知识包在同一目录，版本必须与写入时一致
+            if shared is None:
+                shared = open_shared_bundle(os.path.dirname(path))
+            if shared is None or shared.version != self.header["shared"]:
+                raise BundleError(f"知识包引用的共享段落库 {self.header['shared']} "
+                                  f"不存在或已更新: {path}")
+            self.shared = shared
+
+    @property
+    def name(self):
+        return self.header["name"]
+
+    @property
+    def version(self):
+        return self.header["version"]
+
+    @property
+    def sources(self):
+        return self.header["sources"]
+
+    def _section(self, key):
+        offset, length = self.header["sections"][key]
+        return memoryview(self._map)[offset:offset + length]
+
+    def _own_tokens(self):
+        return self._section("tokens").cast("I")
+
+    def _rows(self):
+        rows = self._section("passages").cast("Q")
+        return [rows[i:i + _ROW_SIZE] for i in range(0, len(rows), _ROW_SIZE)]
+
+    def passage_span(self, index):
+        """第 index 个段落在本知识包中的 (token 起, token 止, 字节起, 字节止)"""
+        source, *span = self._section("passages").cast("Q")[
+            index * _ROW_SIZE:(index + 1) * _ROW_SIZE]
+        if source != _OWN:
+            raise BundleError(f"段落 {index} 不在知识包 {self.path} 中")
+        return tuple(span)
+
+    def _spans(self, merge=False):
+        """各段落的 (所在知识包, token 起, token 止, 字节起, 字节止)；merge 时合并相邻的段落"""
+        spans = []
+        for source, token_start, token_end, byte_start, byte_end in self._rows():
+            bundle = self if source == _OWN else self.shared
+            if merge and spans and spans[-1][0] is bundle \
+                    and spans[-1][2] == token_start and spans[-1][4] == byte_start:
+                spans[-1][2], spans[-1][4] = token_end, byte_end
+            else:
+                spans.append([bundle, token_start, token_end, byte_start, byte_end])
+        return spans
+
+    def passages(self):
+        """各段落的 (UTF-8 文本, token 数组)，共享段落从共享段落库中读取"""
+        return [
+            (bundle._section("text")[byte_start:byte_end],
+             bundle._own_tokens()[token_start:token_end])
+            for bundle, token_start, token_end, byte_start, byte_end in self._spans()
+        ]
+
+    def _text_bytes(self):
+        if self.shared is None:
+            return self._section("text")
+        return b"".join(
+            bundle._section("text")[byte_start:byte_end]
+            for bundle, _, _, byte_start, byte_end in self._spans(merge=True))
+
+    @property
+    def tokens(self):
+        """全文的 token 数组；引用了共享段落时按段拼接，仍然直接引用映射的页"""
+        if self.shared is None:
+            return self._own_tokens()
+        return TokenSegments([
+            bundle._own_tokens()[token_start:token_end]
+            for bundle, token_start, token_end, _, _ in self._spans(merge=True)])
+
+    @property
+    def chunk_offsets(self):
+        return self._section("chunk_offsets").cast("Q")
+
+    def text(self):
+        """解码后的全文（Python 字符串无法直接引用映射的页，每个进程一份）"""
+        return str(self._text_bytes(), "utf-8")
+
+    def chunks(self):
+        """按片段偏移从映射的文本中切出知识片段，不需要重新解码 token"""
+        text = self._text_bytes()
+        offsets = self.chunk_offsets
+        return tuple(
+            str(text[offsets[i]:offsets[i + 1]], "utf-8", "replace")
+            for i in range(len(offsets) - 1)
+        )
+
+    def avatar_bytes(self):
+        return bytes(self._section("avatar"))
+
+    def avatar_data_uri(self):
+        if not self.header["avatar_format"]:
+            return None
+        encoded = base64.b64encode(self._section("avatar")).decode()
+        return f"data:image/{self.header['avatar_format']};base64,{encoded}"
+
+
+def open_bundle(bundle_dir, name, shared=None):
+    """打开专家的知识包；不存在或无法使用时返回 None（是否过期由调用方按内容版本判断）
+
+    引用了共享段落库的知识包会一并打开共享段落库（shared 为已打开的共享段落库时直接使用）
+    """
+    path = bundle_path(bundle_dir, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        return KnowledgeBundle(path, shared=shared)
+    except (BundleError, OSError, ValueError, KeyError) as e:
+        logger.warning(f"无法使用知识包 {path}: {str(e)}")
+        return None
+
+
+def open_shared_bundle(bundle_dir):
+    """打开共享段落库；不存在时返回 None"""
+    path = bundle_path(bundle_dir, SHARED_BUNDLE_NAME)
+    if not os.path.exists(path):
+        return None
+    return KnowledgeBundle(path)
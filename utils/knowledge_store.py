@@ -0,0 +1,153 @@
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import cached_property
+import logging
+import threading
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+ENCODING_NAME = "cl100k_base"  # GPT-4 使用的编码器
+
+SNIPPET_CHUNK_TOKENS = 500  # 知识片段切分粒度
+
+# 截断预算按此步长向下取整，使不同会话可以复用同一份截断结果
+KNOWLEDGE_BUDGET_STEP = 4096
+TRUNCATION_CACHE_SIZE = 128
+
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """获取 token 计数器（首次使用时才导入 tiktoken 并加载编码表，expert.py 共用）"""
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(ENCODING_NAME)
+    return _encoding
+
+
+@dataclass(frozen=True, eq=False)
+class ExpertKnowledge:
+    """单个专家的只读知识（文本、token 数组、头像），在所有会话间共享"""
+    name: str
+    text: str
+    tokens: array = field(repr=False)  # 紧凑的 uint32 token 数组（或映射知识包的 memoryview、TokenSegments）
+    avatar: str = None
+    bundle: object = field(default=None, repr=False)  # 来源知识包（mmap），没有时为 None
+    version: str = None  # 内容版本（源文件哈希 + 解析器 / 编码器版本），资料刷新时据此判断是否变化
+
+    @classmethod
+    def from_text(cls, name, text, avatar=None, version=None):
+        """由原始文本构建知识对象（只在加载时编码一次）"""
+        return cls(name=name, text=text,
+                   tokens=array("I", get_encoding().encode(text)), avatar=avatar,
+                   version=version)
+
+    @classmethod
+    def from_passages(cls, name, passages, avatar=None, version=None):
+        """由逐段编码的段落 [(UTF-8 文本, token 数组), ...] 构建知识对象（token 首尾相接）"""
+        tokens = array("I")
+        for _, passage_tokens in passages:
+            tokens.extend(passage_tokens)
+        text = b"".join(text for text, _ in passages).decode("utf-8")
+        return cls(name=name, text=text, tokens=tokens, avatar=avatar, version=version)
+
+    @classmethod
+    def from_bundle(cls, bundle, avatar=None):
+        """由预编译的知识包构建知识对象：token 数组直接引用映射的页，不需要编码"""
+        return cls(name=bundle.name, text=bundle.text(), tokens=bundle.tokens,
+                   avatar=bundle.avatar_data_uri() or avatar, bundle=bundle,
+                   version=bundle.version)
+
+    @property
+    def token_count(self):
+        return len(self.tokens)
+
+    @cached_property
+    def chunks(self):
+        """按固定 token 数切分的知识片段（批量模式检索使用）"""
+        if self.bundle is not None:
+            return self.bundle.chunks()
+        encoding = get_encoding()
+        return tuple(
+            encoding.decode(self.tokens[i:i + SNIPPET_CHUNK_TOKENS].tolist())
+            for i in range(0, len(self.tokens), SNIPPET_CHUNK_TOKENS)
+        )
+
+    def truncated(self, max_tokens):
+        """获取不超过 max_tokens 的截断文本（跨会话缓存）"""
+        if len(self.tokens) <= max_tokens:
+            return self.text
+        # 按步长向下取整以便复用；不足一个步长时直接使用 max_tokens，绝不超出预算
+        budget = max_tokens // KNOWLEDGE_BUDGET_STEP * KNOWLEDGE_BUDGET_STEP \
+            or max(0, max_tokens)
+        return truncation_cache.get(self, budget)
+
+
+def truncate_tokens(tokens, max_tokens):
+    """截断 token 序列并解码，保留中间部分（前面删 30%，后面删 70%）"""
+    total_tokens = len(tokens)
+    remove_tokens = total_tokens - max_tokens
+
+    # 前面保留更多内容（70%），后面少一些（30%）
+    remove_front = int(remove_tokens * 0.3)
+    remove_back = remove_tokens - remove_front
+
+    # 记录截断信息
+    logger.info(f"文本被截断：总tokens={total_tokens}, "
+                f"保留tokens={max_tokens}, "
+                f"前面删除={remove_front}, "
+                f"后面删除={remove_back}")
+
+    kept = tokens[remove_front:total_tokens - remove_back]
+    if isinstance(kept, (array, memoryview)):
+        kept = kept.tolist()
+
+    return (
+        f"...[前面已省略 {remove_front} tokens]...\n\n" +
+        get_encoding().decode(kept) +
+        f"\n\n...[后面已省略 {remove_back} tokens]..."
+    )
+
+
+class TruncationCache:
+    """截断结果的 LRU 缓存，按知识对象和预算区分；资料刷新时只清除被替换专家的条目"""
+
+    def __init__(self, maxsize=TRUNCATION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (知识对象, 预算) -> 截断文本
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, knowledge, budget):
+        key = (knowledge, budget)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        text = truncate_tokens(knowledge.tokens, budget)
+        with self._lock:
+            self._entries[key] = text
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return text
+
+    def discard(self, knowledges):
+        """清除指定知识对象（已被新版本替换的旧对象）的截断结果，返回清除的条目数"""
+        stale = {id(knowledge) for knowledge in knowledges}
+        with self._lock:
+            keys = [key for key in self._entries if id(key[0]) in stale]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+
+truncation_cache = TruncationCache()
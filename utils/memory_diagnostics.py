@@ -0,0 +1,192 @@
+from array import array
+from collections import deque
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from types import FunctionType, ModuleType
+import streamlit as st
+from .document_loader import load_knowledge_store
+from .knowledge_store import truncation_cache
+from .messages import _AVATARS, message_html_cache_size
+from .settings import is_enabled
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# tracemalloc 为每次分配保存的调用栈深度（越深开销越大）
+TRACEMALLOC_FRAMES = 1
+# 超过这么久没有重跑的会话不再显示
+SESSION_STALE_SECONDS = 3600
+# 快照对比中显示的分配位置数量
+TOP_SITES = 15
+
+# 只包含自身大小、不需要继续展开的类型
+_ATOMIC_TYPES = (str, bytes, bytearray, int, float, bool, type(None), array)
+# 不计入对象大小的类型（共享的代码对象）
+_SKIP_TYPES = (type, ModuleType, FunctionType)
+
+
+def deep_sizeof(obj, seen):
+    """递归计算对象占用的字节数；seen 中的对象（包括共享对象）不重复计算"""
+    if id(obj) in seen or isinstance(obj, _SKIP_TYPES):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, _ATOMIC_TYPES):
+        return size  # array 的 getsizeof 已包含数据缓冲区
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    else:
+        attributes = getattr(obj, "__dict__", None)
+        if attributes is not None:
+            size += deep_sizeof(attributes, seen)
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def shared_object_ids():
+    """进程内共享对象的 id：统计会话占用时不计入这些对象"""
+    ids = {id(knowledge) for knowledge in load_knowledge_store().values()}
+    ids.update(id(avatar) for avatar in _AVATARS.values())
+    return ids
+
+
+def shared_footprint():
+    """进程内共享数据的占用（所有会话共用一份）"""
+    store = load_knowledge_store()
+    text_bytes = sum(sys.getsizeof(k.text) for k in store.values())
+    # 来自知识包的 token 数组映射在页缓存中，由所有进程共享，单独统计
+    token_bytes = sum(sys.getsizeof(k.tokens) for k in store.values()
+                      if k.bundle is None)
+    mapped_bytes = sum(k.tokens.nbytes for k in store.values()
+                       if k.bundle is not None)
+    chunk_bytes = sum(
+        deep_sizeof(k.__dict__["chunks"], set())
+        for k in store.values() if "chunks" in k.__dict__)
+    avatar_bytes = sum(sys.getsizeof(avatar) for avatar in _AVATARS.values()
+                       if isinstance(avatar, str))
+    return [
+        {"item": "知识文本", "entries": len(store), "bytes": text_bytes},
+        {"item": "token 数组",
+         "entries": sum(k.bundle is None for k in store.values()),
+         "bytes": token_bytes},
+        {"item": "token 数组（mmap 知识包）",
+         "entries": sum(k.bundle is not None for k in store.values()),
+         "bytes": mapped_bytes},
+        {"item": "知识片段", "entries": len(store), "bytes": chunk_bytes},
+        {"item": "头像", "entries": len(_AVATARS), "bytes": avatar_bytes},
+        {"item": "截断缓存", "entries": len(truncation_cache),
+         "bytes": None},
+        {"item": "消息 HTML 缓存",
+         "entries": message_html_cache_size(),
+         "bytes": None},
+    ]
+
+
+def session_footprint(experts, messages, shared_ids):
+    """单个会话独占的内存：专家状态、对话历史和内存中的消息"""
+    seen = set(shared_ids)
+    history_bytes = sum(deep_sizeof(expert.chat_history, seen)
+                        for expert in experts)
+    # 对话历史已经计入，剩下的是专家对象本身（不含共享知识）
+    expert_bytes = sum(deep_sizeof(expert, seen) for expert in experts)
+    message_bytes = deep_sizeof(messages, seen)
+    return {
+        "experts": len(experts),
+        "expert_state_bytes": expert_bytes,
+        "chat_history_bytes": history_bytes,
+        "messages": len(messages),
+        "message_bytes": message_bytes,
+        "total_bytes": expert_bytes + history_bytes + message_bytes,
+    }
+
+
+def process_memory():
+    """进程当前和峰值常驻内存（字节），不支持的平台返回 None"""
+    try:
+        import resource  # Windows 上没有该模块
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == "darwin" else 1024  # Linux 以 KB 为单位
+    except ImportError:
+        peak = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = None
+    return {"rss_bytes": current, "peak_rss_bytes": peak}
+
+
+class MemoryDiagnostics:
+    """内存诊断：按会话记录占用，并用 tracemalloc 快照对比定位增长位置"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._sessions = {}  # 会话 id -> 最近一次测量结果
+        self._last_snapshot = None
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            logger.info("内存诊断已开启：tracemalloc 开始跟踪内存分配")
+
+    def record_session(self, session_id, experts, messages):
+        """在每次重跑时记录会话的内存占用（关闭时不做任何事）"""
+        if not self.enabled:
+            return
+        footprint = session_footprint(experts, messages, shared_object_ids())
+        footprint["last_seen"] = time.time()
+        with self._lock:
+            self._sessions[session_id] = footprint
+
+    def sessions(self):
+        """所有活跃会话的占用，按总字节数从高到低"""
+        cutoff = time.time() - SESSION_STALE_SECONDS
+        with self._lock:
+            for session_id in [s for s, f in self._sessions.items()
+                               if f["last_seen"] < cutoff]:
+                del self._sessions[session_id]
+            rows = [{"session": session_id, **footprint}
+                    for session_id, footprint in self._sessions.items()]
+        return sorted(rows, key=lambda row: row["total_bytes"], reverse=True)
+
+    def take_snapshot(self, limit=TOP_SITES):
+        """拍摄 tracemalloc 快照，返回 (当前占用最多的位置, 与上次快照相比增长最多的位置)"""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        top = [
+            {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+             "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:limit]
+        ]
+
+        with self._lock:
+            previous, self._last_snapshot = self._last_snapshot, snapshot
+        growth = []
+        if previous is not None:
+            growth = [
+                {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                 "size_diff_kb": round(stat.size_diff / 1024, 1),
+                 "count_diff": stat.count_diff,
+                 "size_kb": round(stat.size / 1024, 1)}
+                for stat in snapshot.compare_to(previous, "lineno")[:limit]
+                if stat.size_diff > 0
+            ]
+        return top, growth
+
+
+@st.cache_resource
+def get_memory_diagnostics():
+    """获取进程内共享的内存诊断（MEMORY_DIAGNOSTICS_ENABLED 开启时才跟踪）"""
+    return MemoryDiagnostics(is_enabled("MEMORY_DIAGNOSTICS_ENABLED"))
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import html
+import re
+import threading
+
+# 渲染前从消息中移除的 HTML 标签（会破坏外层消息框的结构）
+_STRIP_TAGS_RE = re.compile(r"</?(?:div|code|span)>")
+
+# 渲染后的消息 HTML 缓存：(消息 id, 颜色) -> HTML，按最近使用淘汰
+MESSAGE_HTML_CACHE_SIZE = 2048
+_MESSAGE_HTML = OrderedDict()
+_MESSAGE_HTML_LOCK = threading.Lock()
+
+# 进程级共享的头像表：专家 id -> 头像（data URI、图片路径或 emoji）
+# 消息只保存专家 id，避免每条消息都复制一份 base64 头像
+_AVATARS = {}
+
+
+def register_avatar(expert_id, avatar):
+    """登记专家头像，返回消息中使用的专家 id"""
+    if _AVATARS.get(expert_id) is not avatar:
+        _AVATARS[expert_id] = avatar
+    return expert_id
+
+
+def get_avatar(expert_id):
+    """按专家 id 获取头像"""
+    return _AVATARS.get(expert_id)
+
+
+@dataclass(frozen=True, slots=True)
+class ChatMessage:
+    """紧凑的聊天消息：内存占用只取决于消息文本"""
+    role: str
+    content: str
+    expert_id: str = None  # 用户消息为 None
+    id: int = None  # 持久化后的消息 id
+    created_at: float = None
+
+    @classmethod
+    def from_user(cls, content):
+        return cls(role="user", content=content)
+
+    @classmethod
+    def from_expert(cls, expert, content):
+        return cls(role=expert.name, content=content,
+                   expert_id=register_avatar(expert.name, expert.avatar))
+
+    @property
+    def avatar(self):
+        return get_avatar(self.expert_id) if self.expert_id else None
+
+
+def sanitize_content(content):
+    """清理消息内容中的 HTML 标签（一次正则替换）"""
+    return _STRIP_TAGS_RE.sub("", content)
+
+
+def render_message_html(message, color):
+    """渲染专家消息的 HTML 片段，按消息 id 缓存，每条消息只清理和拼接一次"""
+    if message.id is None:
+        return _build_message_html(message.role, message.content, color)
+    key = (message.id, color)
+    with _MESSAGE_HTML_LOCK:
+        if key in _MESSAGE_HTML:
+            _MESSAGE_HTML.move_to_end(key)
+            return _MESSAGE_HTML[key]
+    html = _build_message_html(message.role, message.content, color)
+    with _MESSAGE_HTML_LOCK:
+        _MESSAGE_HTML[key] = html
+        while len(_MESSAGE_HTML) > MESSAGE_HTML_CACHE_SIZE:
+            _MESSAGE_HTML.popitem(last=False)
+    return html
+
+
+def render_user_message_html(message):
+    """渲染折叠历史中的用户消息（内容按纯文本转义）"""
+    return f"""<div class="chat-message user-message">
+                        <div class="expert-name">🧑 你</div>
+                        <div class="divider"></div>
+                        {html.escape(message.content)}
+                    </div>"""
+
+
+def message_html_cache_size():
+    return len(_MESSAGE_HTML)
+
+
+def _build_message_html(role, content, color):
+    return f"""<div style="background-color: {color};" class="chat-message">
+                        <div class="expert-name">{role}</div>
+                        <div class="divider"></div>
+                        {sanitize_content(content)}
+                    </div>"""
@@ -0,0 +1,205 @@
+from collections import Counter
+from datetime import datetime
+import cProfile
+import functools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from .settings import get_setting, is_enabled
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_DIR = os.path.join(".cache", "profiles")
+DEFAULT_SAMPLE_RATE = 0.1  # 开启后默认每 10 次重跑采样 1 次
+DEFAULT_RETENTION = 20  # 最多保留的采样次数
+STACK_SAMPLE_INTERVAL = 0.005  # 调用栈采样间隔（秒）
+
+# 当前线程是否正在采样：嵌套的采样点直接并入外层
+_local = threading.local()
+
+
+class StackSampler:
+    """后台线程定时抓取目标线程的调用栈，输出火焰图用的折叠栈"""
+
+    def __init__(self, thread_id, interval=STACK_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="stack-sampler")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}:"
+                             f"{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+
+class Profiler:
+    """按采样率对重跑和专家并发流程做 cProfile + 调用栈采样，写入本地目录"""
+
+    def __init__(self, output_dir, sample_rate, retention):
+        self.enabled = True
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.retention = retention
+        self._lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+        logger.info(f"性能采样已开启: 采样率 {sample_rate}, "
+                    f"保留 {retention} 次, 输出到 {output_dir}")
+
+    def should_sample(self):
+        return random.random() < self.sample_rate
+
+    def profile(self, name, func, *args, **kwargs):
+        """采样一次同步调用"""
+        if getattr(_local, "active", False) or not self.should_sample():
+            return func(*args, **kwargs)
+        profile = self._start()
+        if profile is None:
+            return func(*args, **kwargs)
+        sampler, start_time = profile
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._finish(name, sampler, start_time)
+
+    async def profile_async_iter(self, name, iterator):
+        """采样一个异步生成器从开始到耗尽的全过程（事件循环所在线程）"""
+        if getattr(_local, "active", False) or not self.should_sample():
+            async for item in iterator:
+                yield item
+            return
+        profile = self._start()
+        if profile is None:
+            async for item in iterator:
+                yield item
+            return
+        sampler, start_time = profile
+        try:
+            async for item in iterator:
+                yield item
+        finally:
+            self._finish(name, sampler, start_time)
+
+    def _start(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # 其他线程正在使用 cProfile（Python 3.12 起同时只能有一个）
+            logger.debug(f"跳过本次采样: {str(e)}")
+            return None
+        _local.active = True
+        _local.profiler = profiler
+        sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        return sampler, time.perf_counter()
+
+    def _finish(self, name, sampler, start_time):
+        profiler = _local.profiler
+        profiler.disable()
+        _local.active = False
+        stacks = sampler.stop()
+        elapsed = time.perf_counter() - start_time
+
+        prefix = os.path.join(
+            self.output_dir,
+            f"{datetime.now():%Y%m%d-%H%M%S-%f}-{name}")
+        try:
+            profiler.dump_stats(f"{prefix}.prof")
+            with open(f"{prefix}.collapsed", "w", encoding="utf-8") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logger.error(f"写入性能采样失败: {str(e)}")
+            return
+        logger.info(f"性能采样 {name}: 耗时 {elapsed:.2f}秒, "
+                    f"{sum(stacks.values())} 个调用栈样本 -> {prefix}.prof")
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        """只保留最近 retention 次采样的文件"""
+        with self._lock:
+            try:
+                names = os.listdir(self.output_dir)
+            except OSError:
+                return
+            runs = sorted({os.path.splitext(name)[0] for name in names
+                           if name.endswith((".prof", ".collapsed"))})
+            for run in runs[:-self.retention]:
+                for extension in (".prof", ".collapsed"):
+                    try:
+                        os.remove(os.path.join(self.output_dir, run + extension))
+                    except FileNotFoundError:
+                        pass
+
+
+class NoopProfiler:
+    """默认关闭：直接调用，不产生任何开销"""
+
+    enabled = False
+
+    def profile(self, name, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+_profiler = None
+
+
+def get_profiler():
+    """获取进程内共享的采样器（PROFILING_ENABLED 未开启时返回空实现）"""
+    global _profiler
+    if _profiler is None:
+        if is_enabled("PROFILING_ENABLED"):
+            _profiler = Profiler(
+                get_setting("PROFILE_DIR", DEFAULT_PROFILE_DIR),
+                float(get_setting("PROFILE_SAMPLE_RATE", DEFAULT_SAMPLE_RATE)),
+                int(get_setting("PROFILE_RETENTION", DEFAULT_RETENTION)))
+        else:
+            _profiler = NoopProfiler()
+    return _profiler
+
+
+def profiled(name):
+    """装饰同步函数：按采样率记录每次调用的性能数据"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_profiler().profile(name, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled_async_iter(name):
+    """装饰异步生成器函数：按采样率记录整个生成过程的性能数据"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = get_profiler()
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            return profiler.profile_async_iter(name, func(*args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,322 @@
+from collections import deque
+from datetime import datetime, timedelta
+import logging
+import sqlite3
+import threading
+import time
+import streamlit as st
+from .settings import get_setting
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 滑动窗口长度（秒）
+WINDOW_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_reservations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    ts REAL NOT NULL,
+    units INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_quota_model_ts
+    ON quota_reservations (model, ts);
+CREATE TABLE IF NOT EXISTS token_reservations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    ts REAL NOT NULL,
+    tokens INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tokens_model_ts
+    ON token_reservations (model, ts);
+"""
+
+
+class SlidingWindowLimiter:
+    """滑动窗口限流器：基于单调时钟，准入、过期和批量预留都是均摊 O(1)"""
+
+    def __init__(self, limit, window_seconds=WINDOW_SECONDS):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self._entries = deque()  # [单调时钟时间戳, 请求数]，按时间递增
+        self._count = 0
+
+    def _expire(self, now):
+        """移除窗口外的记录，返回移除的请求数"""
+        cutoff = now - self.window_seconds
+        removed = 0
+        while self._entries and self._entries[0][0] <= cutoff:
+            removed += self._entries.popleft()[1]
+        self._count -= removed
+        return removed
+
+    def count(self, now=None):
+        """当前窗口内的请求数"""
+        self._expire(time.monotonic() if now is None else now)
+        return self._count
+
+    def available(self, now=None):
+        """当前窗口内剩余的请求数"""
+        return self.limit - self.count(now)
+
+    def reserve(self, n=1, partial=False):
+        """预留 n 个请求；partial 为 False 时不足则一个也不预留。返回实际预留数"""
+        now = time.monotonic()
+        removed = self._expire(now)
+        if removed:
+            logger.info(f"🧹 清理了 {removed} 个过期请求")
+
+        granted = min(n, self.limit - self._count)
+        if granted <= 0 or (granted < n and not partial):
+            return 0
+
+        self._entries.append([now, granted])
+        self._count += granted
+        return granted
+
+    def reserve_entry(self, n):
+        """预留 n 个单位（不足时不预留），返回窗口中的记录，之后可以用 adjust 修改其数量"""
+        if self.reserve(n) != n:
+            return None
+        return self._entries[-1]
+
+    def adjust(self, entry, n):
+        """把预留记录的数量改为 n（不小于 0）；记录已移出窗口时不再计入"""
+        n = max(0, n)
+        now = time.monotonic()
+        self._expire(now)
+        if entry[0] > now - self.window_seconds:
+            self._count += n - entry[1]
+        entry[1] = n
+
+    def add(self, n):
+        """无条件记录 n 个单位（没有预留的用量）"""
+        if n <= 0:
+            return
+        now = time.monotonic()
+        self._expire(now)
+        self._entries.append([now, n])
+        self._count += n
+
+    def oldest(self):
+        """窗口内最早一条记录的单调时钟时间戳"""
+        return self._entries[0][0] if self._entries else None
+
+    def request_times(self):
+        """窗口内每个请求的时间（转换为 datetime，供显示使用）"""
+        now_mono, now = time.monotonic(), datetime.now()
+        return [
+            now - timedelta(seconds=now_mono - ts)
+            for ts, n in self._entries for _ in range(n)
+        ]
+
+
+class InProcessLedger:
+    """进程内共享的配额账本：同一服务进程的所有会话共用一组限流器"""
+
+    def __init__(self, window_seconds=WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._limiters = {}
+        self._token_limiters = {}
+
+    def _get_limiter(self, model_name, limit, limiters=None):
+        limiters = self._limiters if limiters is None else limiters
+        limiter = limiters.get(model_name)
+        if limiter is None:
+            limiter = SlidingWindowLimiter(limit, self.window_seconds)
+            limiters[model_name] = limiter
+        limiter.limit = limit
+        return limiter
+
+    def reserve(self, model_name, count, limit, partial=False):
+        """原子地预留多个请求，返回实际预留数"""
+        with self._lock:
+            return self._get_limiter(model_name, limit).reserve(
+                count, partial=partial)
+
+    def reserve_entry(self, model_name, count, limit):
+        """原子地预留 count 个请求（不足时不预留），返回预留记录的句柄，失败返回 None"""
+        with self._lock:
+            return self._get_limiter(model_name, limit).reserve_entry(count)
+
+    def adjust(self, model_name, handle, count, limit):
+        """把预留的请求数改为 count（例如 0：归还没有用到的请求）"""
+        with self._lock:
+            self._get_limiter(model_name, limit).adjust(handle, count)
+
+    def snapshot(self, model_name, limit):
+        """返回 (窗口内请求数, 每个请求的时间)"""
+        with self._lock:
+            limiter = self._get_limiter(model_name, limit)
+            return limiter.count(), limiter.request_times()
+
+    def reserve_tokens(self, model_name, tokens, token_limit):
+        """原子地预留 tokens（不足时不预留），返回预留记录的句柄，失败返回 None"""
+        with self._lock:
+            limiter = self._get_limiter(
+                model_name, token_limit, self._token_limiters)
+            return limiter.reserve_entry(tokens)
+
+    def adjust_tokens(self, model_name, handle, tokens, token_limit):
+        """把预留记录改为实际用量 tokens（原地修改，不追加新记录）"""
+        with self._lock:
+            self._get_limiter(
+                model_name, token_limit, self._token_limiters).adjust(handle, tokens)
+
+    def record_tokens(self, model_name, tokens, token_limit):
+        """无条件记录没有预留的 tokens 用量"""
+        with self._lock:
+            self._get_limiter(
+                model_name, token_limit, self._token_limiters).add(tokens)
+
+    def token_usage(self, model_name, token_limit):
+        """当前窗口内已使用的 tokens"""
+        with self._lock:
+            return self._get_limiter(
+                model_name, token_limit, self._token_limiters).count()
+
+
+class SQLiteLedger:
+    """基于 SQLite 的配额账本：多个 worker 进程共享，重启后仍然保留
+
+    跨进程无法共享单调时钟，因此这里使用墙上时钟时间戳。
+    """
+
+    def __init__(self, path, window_seconds=WINDOW_SECONDS):
+        self.path = path
+        self.window_seconds = window_seconds
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        logger.info(f"配额账本已打开: {path}")
+
+    def _connect(self):
+        # sqlite 连接不能跨线程使用，每个线程各自打开一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    def reserve(self, model_name, count, limit, partial=False):
+        """原子地预留多个请求，返回实际预留数"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")  # 获取写锁，保证检查和写入之间不被其他进程插入
+        try:
+            conn.execute(
+                "DELETE FROM quota_reservations WHERE model = ? AND ts <= ?",
+                (model_name, now - self.window_seconds))
+            used = conn.execute(
+                "SELECT COALESCE(SUM(units), 0) FROM quota_reservations WHERE model = ?",
+                (model_name,)).fetchone()[0]
+
+            granted = min(count, limit - used)
+            if granted <= 0 or (granted < count and not partial):
+                granted = 0
+            else:
+                conn.execute(
+                    "INSERT INTO quota_reservations (model, ts, units) VALUES (?, ?, ?)",
+                    (model_name, now, granted))
+            conn.execute("COMMIT")
+            return granted
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def reserve_entry(self, model_name, count, limit):
+        """原子地预留 count 个请求（不足时不预留），返回预留记录的 rowid，失败返回 None"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM quota_reservations WHERE model = ? AND ts <= ?",
+                (model_name, now - self.window_seconds))
+            used = conn.execute(
+                "SELECT COALESCE(SUM(units), 0) FROM quota_reservations WHERE model = ?",
+                (model_name,)).fetchone()[0]
+            rowid = None
+            if used + count <= limit:
+                rowid = conn.execute(
+                    "INSERT INTO quota_reservations (model, ts, units) VALUES (?, ?, ?)",
+                    (model_name, now, count)).lastrowid
+            conn.execute("COMMIT")
+            return rowid
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def adjust(self, model_name, handle, count, limit):
+        """把预留的请求数改为 count（例如 0：归还没有用到的请求）"""
+        self._connect().execute(
+            "UPDATE quota_reservations SET units = ? WHERE id = ?",
+            (max(0, count), handle))
+
+    def reserve_tokens(self, model_name, tokens, token_limit):
+        """原子地预留 tokens（不足时不预留），返回预留记录的 rowid，失败返回 None"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM token_reservations WHERE model = ? AND ts <= ?",
+                (model_name, now - self.window_seconds))
+            used = conn.execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM token_reservations WHERE model = ?",
+                (model_name,)).fetchone()[0]
+            rowid = None
+            if used + tokens <= token_limit:
+                rowid = conn.execute(
+                    "INSERT INTO token_reservations (model, ts, tokens) VALUES (?, ?, ?)",
+                    (model_name, now, tokens)).lastrowid
+            conn.execute("COMMIT")
+            return rowid
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def adjust_tokens(self, model_name, handle, tokens, token_limit):
+        """把预留记录改为实际用量 tokens（原地修改，不追加新记录；已过期删除的记录不受影响）"""
+        self._connect().execute(
+            "UPDATE token_reservations SET tokens = ? WHERE id = ?",
+            (max(0, tokens), handle))
+
+    def record_tokens(self, model_name, tokens, token_limit):
+        """无条件记录没有预留的 tokens 用量"""
+        if tokens <= 0:
+            return
+        self._connect().execute(
+            "INSERT INTO token_reservations (model, ts, tokens) VALUES (?, ?, ?)",
+            (model_name, time.time(), tokens))
+
+    def token_usage(self, model_name, token_limit):
+        """当前窗口内已使用的 tokens"""
+        return self._connect().execute(
+            "SELECT COALESCE(SUM(tokens), 0) FROM token_reservations "
+            "WHERE model = ? AND ts > ?",
+            (model_name, time.time() - self.window_seconds)).fetchone()[0]
+
+    def snapshot(self, model_name, limit):
+        """返回 (窗口内请求数, 每个请求的时间)"""
+        rows = self._connect().execute(
+            "SELECT ts, units FROM quota_reservations "
+            "WHERE model = ? AND ts > ? ORDER BY ts",
+            (model_name, time.time() - self.window_seconds)).fetchall()
+        request_times = [
+            datetime.fromtimestamp(ts) for ts, units in rows for _ in range(units)
+        ]
+        return len(request_times), request_times
+
+
+@st.cache_resource
+def get_quota_ledger():
+    """获取进程内共享的配额账本（QUOTA_BACKEND = "memory" 或 "sqlite"）"""
+    backend = get_setting("QUOTA_BACKEND", "memory")
+    if backend == "sqlite":
+        return SQLiteLedger(get_setting("QUOTA_DB_PATH", "quota.db"))
+    return InProcessLedger()
@@ -0,0 +1,28 @@
+import logging
+import os
+import streamlit as st
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+
+
+def get_setting(key, default=None):
+    """读取配置：环境变量优先，其次 st.secrets"""
+    value = os.environ.get(key)
+    if value is not None:
+        return value
+    try:
+        return st.secrets.get(key, default)
+    except Exception:
+        # 没有 secrets.toml 时 st.secrets 会抛出异常
+        return default
+
+
+def is_enabled(key, default=False):
+    """读取开关类配置（环境变量中的 "1" / "true" / "on" 等视为开启）"""
+    value = get_setting(key, default)
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
@@ -0,0 +1,86 @@
+from collections import Counter
+import logging
+import re
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 页眉页脚只在每页开头和结尾的这几行（非空行）中查找
+EDGE_LINES = 2
+# 同一行（忽略数字）出现在至少这么多比例的页面边缘时视为页眉 / 页脚
+REPEAT_RATIO = 0.3
+MIN_REPEAT_PAGES = 3
+
+_DIGITS_RE = re.compile(r"\d+")
+_SPACES_RE = re.compile(r"[ \t\f\v\u00a0\u3000]+")
+# 单独一行的页码：12、- 12 -、Page 12、12 / 300、12 of 300、第 12 页
+PAGE_NUMBER_RE = re.compile(
+    r"^(?:page\s*)?[-–—]?\s*\d+\s*[-–—]?(?:\s*(?:/|of)\s*\d+)?$|^第\s*\d+\s*页$",
+    re.IGNORECASE)
+# 行尾连字符断词：invest-\nment -> investment（下一行以小写字母开头才合并）
+HYPHENATION_RE = re.compile(r"([A-Za-z])-\n([a-z])")
+# 段落内的折行：前一行以小写字母或逗号结尾、下一行以小写字母开头时接成一行
+WRAPPED_LINE_RE = re.compile(r"(?<=[a-z,;])\n(?=[a-z])")
+# 中文折行：前后都是汉字（前一行不以句末标点结尾）时直接相连
+CJK_WRAPPED_LINE_RE = re.compile(r"(?<=[\u4e00-\u9fff，、；])\n(?=[\u4e00-\u9fff])")
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def line_signature(line):
+    """比较页眉页脚用的行签名：忽略大小写、空白和数字（页码不同的页眉视为同一行）"""
+    return _DIGITS_RE.sub("#", _SPACES_RE.sub(" ", line.strip().lower()))
+
+
+def _edge_lines(lines):
+    nonempty = [line for line in lines if line.strip()]
+    return nonempty[:EDGE_LINES] + nonempty[-EDGE_LINES:]
+
+
+def _strip_edge(lines, repeated, from_end):
+    """从一页的开头或结尾剥离页眉页脚，遇到正文行即停止，返回删除的行数"""
+    removed = checked = 0
+    while lines and checked < EDGE_LINES:
+        line = lines[-1] if from_end else lines[0]
+        if line.strip():
+            checked += 1
+            if line_signature(line) not in repeated \
+                    and not PAGE_NUMBER_RE.match(line.strip()):
+                break
+            removed += 1
+        lines.pop(-1 if from_end else 0)
+    return removed
+
+
+def strip_page_furniture(pages):
+    """去掉各页开头 / 结尾重复出现的页眉、页脚和单独的页码，返回 (各页文本, 删除的行数)"""
+    page_lines = [page.splitlines() for page in pages]
+    counts = Counter()
+    for lines in page_lines:
+        counts.update({line_signature(line) for line in _edge_lines(lines)})
+    threshold = max(MIN_REPEAT_PAGES, REPEAT_RATIO * len(pages))
+    repeated = {signature for signature, count in counts.items()
+                if count >= threshold}
+
+    removed = 0
+    for lines in page_lines:
+        removed += _strip_edge(lines, repeated, from_end=False)
+        removed += _strip_edge(lines, repeated, from_end=True)
+    return ["\n".join(lines) for lines in page_lines], removed
+
+
+def normalize_text(text):
+    """合并连字符断词和段落内折行，压缩多余的空白"""
+    text = text.replace("\u00ad", "")  # 软连字符
+    text = "\n".join(_SPACES_RE.sub(" ", line).strip() for line in text.splitlines())
+    text = HYPHENATION_RE.sub(r"\1\2", text)
+    text = WRAPPED_LINE_RE.sub(" ", text)
+    text = CJK_WRAPPED_LINE_RE.sub("", text)
+    return BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def normalize_pages(pages):
+    """PDF 各页的规范化：去掉页眉页脚后合并（跨页的段落也能接上）"""
+    pages, removed = strip_page_furniture(pages)
+    if removed:
+        logger.debug(f"去掉页眉页脚 {removed} 行（共 {len(pages)} 页）")
+    return normalize_text("\n".join(pages))
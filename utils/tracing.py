@@ -0,0 +1,332 @@
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import streamlit as st
+from .settings import get_setting, is_enabled
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "investment-titans"
+
+# 耗时直方图的分桶上限（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10, 30, 60)
+
+# Prometheus 指标端点默认只监听本机，需要对外暴露时设置 METRICS_HOST
+DEFAULT_METRICS_HOST = "127.0.0.1"
+
+# OTLP 中的 span 类型和状态码
+SPAN_KIND_INTERNAL = 1
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+# 当前异步任务 / 线程所在的 span，子 span 以它为父节点
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    """一个计时区间：用 with 语句包裹，结束时交给 tracer 汇总和导出"""
+
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id",
+                 "attributes", "start_ns", "end_ns", "error", "_token")
+
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start_ns = None
+        self.end_ns = None
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add(self, key, amount=1):
+        """累加一个计数属性（如重试次数）"""
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def elapsed_ms(self):
+        """从 span 开始到现在的毫秒数"""
+        return (time.time_ns() - self.start_ns) / 1e6
+
+    @property
+    def duration(self):
+        """span 的耗时（秒）"""
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        self.tracer._start(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        self.tracer._finish(self)
+        return False
+
+
+class NoopSpan:
+    """关闭追踪时使用的空 span：所有操作都不做任何事"""
+
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+    def elapsed_ms(self):
+        return 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class SpanMetrics:
+    """按 span 名称汇总耗时直方图、错误数和重试数，输出 Prometheus 文本格式"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}  # span 名称 -> [各分桶计数..., 总数, 总耗时]
+        self._errors = {}
+        self._retries = {}
+
+    def observe(self, span):
+        duration = span.duration
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                span.name, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += duration
+            if span.error:
+                self._errors[span.name] = self._errors.get(span.name, 0) + 1
+            retries = span.attributes.get("retries")
+            if retries:
+                self._retries[span.name] = \
+                    self._retries.get(span.name, 0) + retries
+
+    def render(self):
+        """生成 Prometheus 文本格式（text/plain; version=0.0.4）"""
+        lines = [
+            "# HELP titans_span_duration_seconds Duration of traced stages.",
+            "# TYPE titans_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(f'titans_span_duration_seconds_bucket'
+                                 f'{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'titans_span_duration_seconds_bucket'
+                             f'{{span="{name}",le="+Inf"}} {histogram[-2]}')
+                lines.append(f'titans_span_duration_seconds_sum'
+                             f'{{span="{name}"}} {histogram[-1]:.6f}')
+                lines.append(f'titans_span_duration_seconds_count'
+                             f'{{span="{name}"}} {histogram[-2]}')
+
+            lines.append("# HELP titans_span_errors_total Traced stages that raised.")
+            lines.append("# TYPE titans_span_errors_total counter")
+            for name, count in sorted(self._errors.items()):
+                lines.append(f'titans_span_errors_total{{span="{name}"}} {count}')
+
+            lines.append("# HELP titans_retries_total Retries recorded on traced stages.")
+            lines.append("# TYPE titans_retries_total counter")
+            for name, count in sorted(self._retries.items()):
+                lines.append(f'titans_retries_total{{span="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def otlp_value(value):
+    """转换为 OTLP JSON 的 AnyValue"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}  # OTLP JSON 中 int64 以字符串表示
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes):
+    return [{"key": key, "value": otlp_value(value)}
+            for key, value in attributes.items()]
+
+
+class Tracer:
+    """收集 span：根 span 结束时把整条链路写成一行 OTLP JSON，同时汇总指标"""
+
+    enabled = True
+
+    def __init__(self, export_path):
+        self.export_path = export_path
+        self.metrics = SpanMetrics()
+        self._lock = threading.Lock()
+        self._pending = {}  # 根 span 尚未结束的 trace id -> 已结束的 span
+        directory = os.path.dirname(export_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        logger.info(f"链路追踪已开启，导出到: {export_path}")
+
+    def span(self, name, **attributes):
+        return Span(self, name, _current_span.get(), attributes)
+
+    def _start(self, span):
+        if span.parent_id is None:
+            with self._lock:
+                self._pending[span.trace_id] = []
+
+    def _finish(self, span):
+        self.metrics.observe(span)
+        with self._lock:
+            if span.parent_id is None:
+                spans = self._pending.pop(span.trace_id, [])
+                spans.append(span)
+            elif span.trace_id in self._pending:
+                self._pending[span.trace_id].append(span)
+                return
+            else:
+                # 根 span 导出后才结束的 span（如仍在运行的后台任务）：单独导出，不再等待
+                spans = [span]
+        self._export(spans)
+
+    def _export(self, spans):
+        """按 OTLP/JSON（ExportTraceServiceRequest）格式追加一行"""
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes(
+                {"service.name": SERVICE_NAME})},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [self._to_otlp(span) for span in spans],
+            }],
+        }]}
+        try:
+            with self._lock, open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(f"导出链路失败: {str(e)}")
+
+    def _to_otlp(self, span):
+        data = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": otlp_attributes(span.attributes),
+        }
+        if span.parent_id:
+            data["parentSpanId"] = span.parent_id
+        if span.error:
+            data["status"] = {"code": STATUS_CODE_ERROR, "message": span.error}
+        else:
+            data["status"] = {"code": STATUS_CODE_OK}
+        return data
+
+    def prometheus_text(self):
+        return self.metrics.render()
+
+
+class NoopTracer:
+    """关闭追踪时使用：不计时、不分配对象、不导出"""
+
+    enabled = False
+
+    def span(self, name, **attributes):
+        return NOOP_SPAN
+
+    def prometheus_text(self):
+        return ""
+
+
+def start_metrics_server(tracer, port, host=DEFAULT_METRICS_HOST):
+    """在后台线程启动 Prometheus 指标端点（GET /metrics）"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = tracer.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logger.error(f"指标端点启动失败（{host}:{port}）: {str(e)}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name="metrics-server").start()
+    logger.info(f"Prometheus 指标端点: http://{host}:{port}/metrics")
+    return server
+
+
+@st.cache_resource
+def create_tracer():
+    """按配置创建 tracer（TRACING_ENABLED 未开启时返回空实现）"""
+    if not is_enabled("TRACING_ENABLED"):
+        return NoopTracer()
+    tracer = Tracer(get_setting(
+        "TRACE_EXPORT_PATH", os.path.join("traces", "spans.otlp.jsonl")))
+    port = get_setting("METRICS_PORT")
+    if port:
+        start_metrics_server(tracer, int(port),
+                             get_setting("METRICS_HOST", DEFAULT_METRICS_HOST))
+    return tracer
+
+
+_tracer = None
+
+
+def get_tracer():
+    """获取进程内共享的 tracer（首次调用后不再查询配置）"""
+    global _tracer
+    if _tracer is None:
+        _tracer = create_tracer()
+    return _tracer
+
+
+def trace_span(name, **attributes):
+    """创建一个 span，用法：with trace_span("llm.call", model=...) as span:"""
+    return get_tracer().span(name, **attributes)
+
+
+def current_span():
+    """当前所在的 span；没有时返回空 span"""
+    return _current_span.get() or NOOP_SPAN
+
+
+def record_retry(retry_state):
+    """tenacity before_sleep 回调：在当前 span 上累计重试次数"""
+    current_span().add("retries")
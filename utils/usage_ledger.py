@@ -0,0 +1,106 @@
+import logging
+import sqlite3
+import threading
+import time
+import streamlit as st
+from .settings import get_setting
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 每百万 tokens 的价格（美元）：(输入, 输出)
+MODEL_PRICING = {
+    "grok-beta": (5.0, 15.0),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-2.0-flash-exp": (0.0, 0.0),  # 实验模型免费
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    session_id TEXT,
+    expert TEXT,
+    model TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    estimated_prompt_tokens INTEGER NOT NULL,
+    latency_ms REAL NOT NULL,
+    cost_usd REAL NOT NULL,
+    success INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_usage_ts ON usage_events (ts);
+"""
+
+# 聚合维度 -> SQL 分组表达式
+GROUP_BY_COLUMNS = {
+    "day": "strftime('%Y-%m-%d', ts, 'unixepoch', 'localtime')",
+    "expert": "expert",
+    "model": "model",
+    "session": "session_id",
+}
+
+
+def calculate_cost(model_name, prompt_tokens, completion_tokens):
+    """按模型价格计算费用（美元）"""
+    input_price, output_price = MODEL_PRICING.get(model_name, (0.0, 0.0))
+    return ((prompt_tokens or 0) * input_price +
+            (completion_tokens or 0) * output_price) / 1000000
+
+
+class UsageLedger:
+    """token 与费用账本：只追加写入，按天、专家、模型、会话聚合查询"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        logger.info(f"用量账本已打开: {path}")
+
+    def record(self, model, kind, estimated_prompt_tokens, latency_ms,
+               usage=None, session_id=None, expert=None, success=True):
+        """记录一次模型调用的用量"""
+        prompt_tokens = usage["prompt_tokens"] if usage else None
+        completion_tokens = usage["completion_tokens"] if usage else None
+        cost = calculate_cost(model, prompt_tokens, completion_tokens)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO usage_events (ts, session_id, expert, model, kind, "
+                "prompt_tokens, completion_tokens, estimated_prompt_tokens, "
+                "latency_ms, cost_usd, success) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), session_id, expert, model, kind, prompt_tokens,
+                 completion_tokens, estimated_prompt_tokens, latency_ms, cost,
+                 int(success))
+            )
+
+    def aggregate(self, group_by="day", since=None):
+        """按指定维度聚合用量，返回字典列表（按费用和 tokens 从高到低）"""
+        column = GROUP_BY_COLUMNS[group_by]
+        query = f"""
+            SELECT {column} AS key,
+                   COUNT(*) AS calls,
+                   SUM(1 - success) AS errors,
+                   COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+                   COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+                   SUM(estimated_prompt_tokens) AS estimated_prompt_tokens,
+                   ROUND(AVG(latency_ms), 1) AS avg_latency_ms,
+                   ROUND(SUM(cost_usd), 6) AS cost_usd
+            FROM usage_events
+            WHERE ts >= ?
+            GROUP BY key
+            ORDER BY cost_usd DESC, prompt_tokens DESC
+        """
+        with self._lock:
+            cursor = self._conn.execute(query, (since or 0,))
+            names = [description[0] for description in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+@st.cache_resource
+def get_usage_ledger():
+    """获取进程内共享的用量账本"""
+    return UsageLedger(get_setting("USAGE_DB_PATH", "usage.db"))